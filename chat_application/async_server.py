@@ -0,0 +1,374 @@
+# async_server.py
+# Event-loop server mode: every client socket is multiplexed on one asyncio loop
+# instead of getting its own OS thread. Command handling is shared with the
+# threaded server through message_handler.MessageHandler.feed().
+import asyncio
+import collections
+import ssl
+import time
+import compression
+import media
+import metrics
+import tracing
+import frame_codec
+from file_relay import FILE_WINDOW
+import message_handler
+from message_handler import MessageHandler, TransferStreamHandler
+from client_registry import ClientRegistry
+from outbound_queue import OVERFLOW_POLICIES, coalesced_messages, dropped_messages, skipped_notice
+from connection_manager import HandshakeStats, hello_options, register_metrics
+from logger_utility import Logger
+
+logger = Logger()
+
+
+def raise_fd_limit():
+    # 20k+ idle connections need far more descriptors than the usual soft limit of 1024
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except Exception:
+        return None
+
+
+class ClientConnection(asyncio.Protocol):
+    """
+    One client on the event loop. It stands in for the socket object the threaded
+    server stores in the registry, so MessageHandler can call send/sendall/close on it
+    without knowing which server mode it runs under.
+
+    It is also the client's outbound queue (same put()/begin_stream()/end_stream()
+    contract as outbound_queue.OutboundQueue): the transport's write buffer is the
+    queue and the loop is the writer, bounded by the server's outbound_max_bytes.
+    Text frames are compressed as they are handed to the transport (deflater).
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.address = None
+        self.handler = None
+        self.closed = False
+        self.username_deadline = None
+        self.connected_at = None
+        self.protocol = frame_codec.LINE
+        self.hello = b""
+        self.deflater = None        # compression.Deflater once the client negotiated compression
+
+        # outbound counters (see OutboundQueue)
+        self.dropped = 0
+        self.skipped = 0
+        self.coalesced = 0
+
+        # exclusive file stream to a newline-protocol client (see OutboundQueue.begin_stream)
+        self.stream_owner = None
+        self.held = collections.deque()
+        self.held_size = 0
+
+        # file relay backpressure: the connections we stopped reading until they drain,
+        # and the senders waiting for us to drain
+        self.waiting_on = set()
+        self.drain_waiters = []
+
+    # ---------- socket-like interface used by MessageHandler ----------
+    def send(self, data):
+        if self.closed:
+            raise ConnectionError("Connection closed")
+        self.transport.write(data)
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.transport.close()
+
+    def getpeername(self):
+        return self.address
+
+    # ---------- outbound queue interface used by MessageHandler ----------
+    # bytes waiting to go out (OutboundQueue.size)
+    @property
+    def size(self):
+        transport = self.transport
+        return (transport.get_write_buffer_size() if transport and not self.closed else 0) + self.held_size
+
+    # on_write: called once the message is handed to the transport (see OutboundQueue.put)
+    def put(self, data, droppable=True, owner=None, on_write=None):
+        if self.closed:
+            return False
+        size = sum(len(piece) for piece in data) if isinstance(data, tuple) else len(data)
+        if self.stream_owner is not None and owner is not self.stream_owner:
+            # park it until the stream is done; chat is dropped once the parking space is full
+            if droppable and self.held_size + size > self.server.outbound_max_bytes:
+                self.dropped += 1
+                dropped_messages.inc()
+            else:
+                self.held.append(data)
+                self.held_size += size
+            return True
+        if self.transport.get_write_buffer_size() + size > self.server.outbound_max_bytes:
+            policy = self.server.overflow_policy
+            if policy == "disconnect":
+                logger.log_event(f"[SLOW CLIENT] outbound queue full, disconnecting {self.address}")
+                self.closed = True
+                self.transport.abort()
+                return False
+            if droppable:
+                # already-buffered bytes can't be evicted, so coalesce drops the newest
+                # message and reports it in the skipped notice
+                if policy == "coalesce":
+                    self.skipped += 1
+                    self.coalesced += 1
+                    coalesced_messages.inc()
+                else:
+                    self.dropped += 1
+                    dropped_messages.inc()
+                return True
+            # must be delivered: buffered anyway, the loop never blocks on one client
+
+        if self.skipped and self.stream_owner is None:
+            self._write(skipped_notice(self.skipped, self.protocol))
+            self.skipped = 0
+        if on_write:
+            on_write()
+        self._write(data)
+        return True
+
+    def _write(self, data):
+        if self.deflater:
+            data = self.deflater.pack(data if isinstance(data, tuple) else (data,))
+        if isinstance(data, tuple):
+            self.transport.writelines(data)
+        else:
+            self.transport.write(data)
+
+    def begin_stream(self, owner):
+        if self.stream_owner is not None or self.closed:
+            return False
+        self.stream_owner = owner
+        return True
+
+    def end_stream(self, owner):
+        if self.stream_owner is not owner:
+            return
+        self.stream_owner = None
+        held, self.held = self.held, collections.deque()
+        self.held_size = 0
+        if not self.closed:
+            for data in held:
+                self._write(data)
+
+    def pending_bytes(self):
+        return self.transport.get_write_buffer_size()
+
+    def abort(self, reason):
+        if not self.closed:
+            logger.log_event(f"[SLOW CLIENT] {reason}, disconnecting {self.address}")
+            self.closed = True
+            self.transport.abort()
+
+    # ---------- file relay backpressure ----------
+    # stop reading from this (sending) client until every congested recipient has drained
+    def throttle(self, outbounds):
+        fresh = [conn for conn in outbounds if not conn.closed and conn not in self.waiting_on]
+        if not fresh:
+            return
+        if not self.waiting_on:
+            self.transport.pause_reading()
+        for conn in fresh:
+            self.waiting_on.add(conn)
+            conn.drain_waiters.append(self)
+
+    def _recipient_drained(self, conn):
+        self.waiting_on.discard(conn)
+        if not self.waiting_on and not self.closed:
+            self.transport.resume_reading()
+
+    # write buffer went back under the low-water mark (asyncio flow control)
+    def resume_writing(self):
+        waiters, self.drain_waiters = self.drain_waiters, []
+        for sender in waiters:
+            sender._recipient_drained(self)
+
+    # ---------- asyncio.Protocol callbacks ----------
+    def connection_made(self, transport):
+        # called once the TLS handshake has completed
+        self.transport = transport
+        self.address = transport.get_extra_info("peername")
+        self.connected_at = time.monotonic()
+        logger.log_event(f"[TLS OK] Handshake completed with {self.address}")
+
+        # pause_writing/resume_writing fire around the file relay window
+        transport.set_write_buffer_limits(high=self.server.file_window)
+
+        # the username has to arrive within the handshake deadline too
+        loop = asyncio.get_running_loop()
+        self.username_deadline = loop.call_later(self.server.handshake_timeout, self._username_timeout)
+
+    # TLS never completed: the loop aborts the transport itself, we only count it
+    def _tls_timeout(self):
+        if self.transport is None:
+            self.server.handshake_stats.record_timeout()
+
+    def _username_timeout(self):
+        if self.handler is None and not self.closed:
+            self.server.handshake_stats.record_timeout()
+            logger.log_event(f"[HANDSHAKE TIMEOUT] {self.address} sent no username")
+            self.close()
+
+    def data_received(self, data):
+        if self.handler is None:
+            # First message = username (bare, legacy) or a framed hello
+            self.hello += data
+            try:
+                hello = frame_codec.parse_client_hello(self.hello)
+                if hello is None and len(self.hello) > frame_codec.MAX_HELLO:
+                    raise frame_codec.FrameError("Client hello too large")
+            except frame_codec.FrameError as e:
+                logger.log_event(f"[HANDSHAKE ERROR] {self.address} {e}")
+                hello = (frame_codec.LINE, "", {}, b"")
+            if hello is None:
+                return
+
+            self.username_deadline.cancel()
+            self.protocol, username, options, leftover = hello
+            if not username:
+                self.server.handshake_stats.record_failure()
+                self.close()
+                return
+            self.server.handshake_stats.record_success(time.monotonic() - self.connected_at)
+            self.handler = self.server.register(self, username, options)
+            if not leftover:
+                return
+            data = leftover
+
+        try:
+            if not self.handler.feed(data):
+                self.handler.stop()
+        except Exception as e:
+            logger.log_event(f"[DISCONNECTED] {self.handler.username} ({e})")
+            self.handler.stop()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if self.username_deadline:
+            self.username_deadline.cancel()
+        # senders throttled on us must not wait forever
+        self.resume_writing()
+        if self.handler:
+            self.handler.stop()
+
+
+class AsyncServer:
+    def __init__(self, host='127.0.0.1', port=5557, backlog=4096, handshake_timeout=10.0,
+                 outbound_max_bytes=1 << 20, overflow_policy="drop", file_window=FILE_WINDOW, compress=True):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+
+        # Per-client outbound limit (bytes waiting in the transport) and overflow policy
+        self.outbound_max_bytes = outbound_max_bytes
+        self.overflow_policy = overflow_policy
+        # Bytes of a relayed file allowed in a recipient's buffer before the sender is paused
+        self.file_window = file_window
+        # Accept compression from framed clients that offer it (see compression.py)
+        self.compress = compress
+
+        # TLS runs inside the loop's transport and is bound by ssl_handshake_timeout;
+        # the username must follow within another handshake_timeout.
+        # Latency here is counted from TLS completion to username.
+        self.handshake_timeout = handshake_timeout
+        self.handshake_stats = HandshakeStats()
+
+        # SSL setup
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(certfile="server.crt", keyfile="server.key")
+
+        # Clients (ClientConnection <-> username)
+        self.registry = ClientRegistry()
+        register_metrics(self.registry)
+
+        self.server = None
+
+    # protocol factory: called by the loop for every accepted socket, before TLS starts
+    def _new_connection(self):
+        self.handshake_stats.record_accept()
+        conn = ClientConnection(self)
+        loop = asyncio.get_running_loop()
+        loop.call_later(self.handshake_timeout, conn._tls_timeout)
+        return conn
+
+    # called from the loop once a client has sent its username
+    def register(self, conn, username, options=None):
+        if conn.protocol == frame_codec.FRAME and (options or {}).get("transfer"):
+            # data connection of a parallel upload: not a chat user, never registered
+            return TransferStreamHandler(conn, conn.address, self.registry, options["transfer"], start_thread=False,
+                                         file_window=self.file_window)
+
+        # Register (the registry keeps usernames unique)
+        codec = compression.accept(options) if self.compress and conn.protocol == frame_codec.FRAME else None
+        udp_media = (conn.protocol == frame_codec.FRAME and message_handler.media_relay.enabled
+                     and media.accept(options))
+        trace = conn.protocol == frame_codec.FRAME and message_handler.tracer.enabled and tracing.accepted(options)
+        username = self.registry.add(conn, username, conn.address, outbound=conn, protocol=conn.protocol,
+                                     compression=codec, media=udp_media, trace=trace)
+        if conn.protocol == frame_codec.FRAME:
+            # confirm the framed protocol and tell the client its final username (and what it may use)
+            conn.put(frame_codec.server_hello(username, hello_options(codec, udp_media, trace)), droppable=False)
+            if codec:
+                conn.deflater = compression.Deflater()
+
+        logger.log_event("[NEW USER] %s (%s) connected (%s protocol).", username, conn.address, conn.protocol,
+                         user=username, peer=conn.address)
+
+        handler = MessageHandler(conn, conn.address, self.registry, start_thread=False,
+                                 file_window=self.file_window)
+        logger.log_event("[CONNECTED] %s (%s)", username, conn.address, user=username, peer=conn.address)
+        return handler
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(
+            self._new_connection,
+            self.host, self.port,
+            ssl=self.context,
+            ssl_handshake_timeout=self.handshake_timeout,
+            backlog=self.backlog,
+            reuse_address=True,
+        )
+        logger.log_event(f"[SECURE SERVER STARTED] Listening on {self.host}:{self.port} (async mode)")
+        # UDP media relay for voice calls, on the same loop
+        await message_handler.media_relay.start_async(self.host)
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start(self):
+        limit = raise_fd_limit()
+        if limit:
+            logger.log_event(f"[FD LIMIT] {limit} open files allowed")
+        asyncio.run(self.serve())
+
+    def stop(self):
+        logger.log_event("[SERVER STOPPING] Closing all connections...")
+        logger.log_event(f"[HANDSHAKE STATS] {self.handshake_stats.snapshot()}")
+        logger.log_event(f"[FILE CACHE STATS] {message_handler.file_cache.stats()}")
+        logger.log_event(f"[METRICS] {metrics.registry.summary()}")
+        message_handler.media_relay.stop()
+        message_handler.tracer.close()
+
+        for conn in self.registry.clear():
+            try:
+                conn.close()
+            except:
+                pass
+
+        logger.log_event("[SERVER STOPPED]")
+        logger.flush()
@@ -0,0 +1,301 @@
+# audio_codec.py
+# Codecs for call audio, negotiated per call in the signalling:
+#
+#   caller:  /call_request:<callee>:<codec names, preferred first>
+#   callee:  /call_accept:<caller>:<chosen codec>
+#
+# A client that sends no list (or an older client that ignores it) gets "pcm",
+# the 44.1 kHz 16-bit format calls have always used. Everything else runs at
+# 16 kHz (8 kHz for G.711), so the audio device is opened at the codec's rate;
+# where a device won't do that rate, Resampler converts in Python.
+#
+# Each codec frames audio in `frame` samples (20 ms for the new ones) and every
+# packet decodes on its own: ADPCM packets carry the encoder state they start
+# from, so a lost packet doesn't throw the ones after it off. The media packet's
+# payload type (media.py) says which codec a packet is in.
+#
+# Opus is offered only if the opuslib package (and libopus) is installed.
+import array
+import media
+
+SAMPLE_WIDTH = 2
+
+
+class Codec:
+    """A call audio format: `frame` samples of 16-bit mono PCM at `rate` per packet."""
+
+    def __init__(self, name, ptype, rate, frame, encoder, decoder):
+        self.name = name
+        self.ptype = ptype                # media.py payload type
+        self.rate = rate
+        self.frame = frame
+        self.encoder = encoder            # () -> object with encode(pcm) -> payload
+        self.decoder = decoder            # () -> object with decode(payload) -> pcm
+
+    def __repr__(self):
+        return f"<Codec {self.name} {self.rate} Hz>"
+
+
+# helper: PCM bytes (native byte order, like the audio device) <-> array of samples
+def _samples(pcm, typecode="h"):
+    samples = array.array(typecode)
+    samples.frombytes(pcm[:len(pcm) - len(pcm) % SAMPLE_WIDTH])
+    return samples
+
+
+# ---------- PCM ----------
+
+class _Raw:
+    def encode(self, pcm):
+        return pcm
+
+    def decode(self, payload):
+        return payload
+
+
+# ---------- G.711 mu-law ----------
+
+_ULAW_BIAS = 0x84
+_ULAW_CLIP = 32635
+_ulaw_encode_table = None           # 65536 entries, indexed by the sample as unsigned 16-bit
+_ulaw_decode_table = None
+
+
+def _ulaw_byte(sample):
+    sign = 0x80 if sample < 0 else 0
+    magnitude = min(-sample if sample < 0 else sample, _ULAW_CLIP) + _ULAW_BIAS
+    exponent = max(magnitude.bit_length() - 8, 0)
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    return ~(sign | (exponent << 4) | mantissa) & 0xFF
+
+
+def _ulaw_sample(byte):
+    byte = ~byte & 0xFF
+    magnitude = ((((byte & 0x0F) << 3) + _ULAW_BIAS) << ((byte >> 4) & 0x07)) - _ULAW_BIAS
+    return -magnitude if byte & 0x80 else magnitude
+
+
+def _ulaw_tables():
+    global _ulaw_encode_table, _ulaw_decode_table
+    if _ulaw_encode_table is None:
+        _ulaw_decode_table = array.array("h", [_ulaw_sample(b) for b in range(256)])
+        _ulaw_encode_table = bytes(_ulaw_byte(u - 65536 if u >= 32768 else u) for u in range(65536))
+    return _ulaw_encode_table, _ulaw_decode_table
+
+
+class _Ulaw:
+    def __init__(self):
+        self.encode_table, self.decode_table = _ulaw_tables()
+
+    def encode(self, pcm):
+        return bytes(map(self.encode_table.__getitem__, _samples(pcm, "H")))
+
+    def decode(self, payload):
+        return array.array("h", map(self.decode_table.__getitem__, payload)).tobytes()
+
+
+# ---------- IMA ADPCM ----------
+# 4 bits per sample. Packet: predictor (int16 little-endian), step index (u8),
+# one zero byte, then two samples per byte, low nibble first.
+
+_STEPS = (
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88, 97,
+    107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796,
+    876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428,
+    4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899, 15289, 16818, 18500, 20350,
+    22385, 24623, 27086, 29794, 32767,
+)
+_INDEX_ADJUST = (-1, -1, -1, -1, 2, 4, 6, 8) * 2
+
+
+class _AdpcmEncoder:
+    def __init__(self):
+        self.predicted = 0
+        self.index = 0
+
+    def encode(self, pcm):
+        predicted, index = self.predicted, self.index
+        out = bytearray(((predicted & 0xFFFF).to_bytes(2, "little")) + bytes((index, 0)))
+        steps, adjust = _STEPS, _INDEX_ADJUST
+        low = None
+        for sample in _samples(pcm):
+            step = steps[index]
+            diff = sample - predicted
+            code = 0
+            if diff < 0:
+                code = 8
+                diff = -diff
+            delta = step >> 3
+            if diff >= step:
+                code |= 4
+                diff -= step
+                delta += step
+            step >>= 1
+            if diff >= step:
+                code |= 2
+                diff -= step
+                delta += step
+            step >>= 1
+            if diff >= step:
+                code |= 1
+                delta += step
+            predicted = predicted - delta if code & 8 else predicted + delta
+            if predicted > 32767:
+                predicted = 32767
+            elif predicted < -32768:
+                predicted = -32768
+            index += adjust[code]
+            if index < 0:
+                index = 0
+            elif index > 88:
+                index = 88
+            if low is None:
+                low = code
+            else:
+                out.append(low | (code << 4))
+                low = None
+        if low is not None:
+            out.append(low)
+        self.predicted, self.index = predicted, index
+        return bytes(out)
+
+
+class _AdpcmDecoder:
+    def decode(self, payload):
+        if len(payload) < 4:
+            return b""
+        predicted = int.from_bytes(payload[:2], "little", signed=True)
+        index = min(payload[2], 88)
+        steps, adjust = _STEPS, _INDEX_ADJUST
+        out = array.array("h")
+        for byte in payload[4:]:
+            for code in (byte & 0x0F, byte >> 4):
+                step = steps[index]
+                delta = step >> 3
+                if code & 4:
+                    delta += step
+                if code & 2:
+                    delta += step >> 1
+                if code & 1:
+                    delta += step >> 2
+                predicted = predicted - delta if code & 8 else predicted + delta
+                if predicted > 32767:
+                    predicted = 32767
+                elif predicted < -32768:
+                    predicted = -32768
+                index += adjust[code]
+                if index < 0:
+                    index = 0
+                elif index > 88:
+                    index = 88
+                out.append(predicted)
+        return out.tobytes()
+
+
+# ---------- Opus (optional) ----------
+
+try:
+    import opuslib
+except Exception:       # not installed, or libopus missing
+    opuslib = None
+
+OPUS_BITRATE = 24000
+
+
+class _OpusEncoder:
+    def __init__(self, rate, frame):
+        self.frame = frame
+        self.encoder = opuslib.Encoder(rate, 1, opuslib.APPLICATION_VOIP)
+        self.encoder.bitrate = OPUS_BITRATE
+
+    def encode(self, pcm):
+        return self.encoder.encode(pcm, self.frame)
+
+
+class _OpusDecoder:
+    def __init__(self, rate, frame):
+        self.frame = frame
+        self.decoder = opuslib.Decoder(rate, 1)
+
+    def decode(self, payload):
+        return self.decoder.decode(bytes(payload), self.frame)
+
+
+# ---------- registry ----------
+# PCM goes on the wire in the device's byte order (little-endian on everything we run on)
+
+PCM = Codec("pcm", media.PCM16, 44100, 1024, _Raw, _Raw)        # what calls used before negotiation
+L16 = Codec("l16", 2, 16000, 320, _Raw, _Raw)
+PCMU = Codec("pcmu", 3, 8000, 160, _Ulaw, _Ulaw)
+ADPCM = Codec("adpcm", 4, 16000, 320, _AdpcmEncoder, _AdpcmDecoder)
+OPUS = Codec("opus", 5, 16000, 320, lambda: _OpusEncoder(16000, 320), lambda: _OpusDecoder(16000, 320))
+
+# in order of preference
+CODECS = tuple(c for c in (OPUS if opuslib else None, ADPCM, PCMU, L16, PCM) if c)
+BY_NAME = {c.name: c for c in CODECS}
+BY_PTYPE = {c.ptype: c for c in CODECS}
+
+
+# the codec list a caller puts in /call_request
+def offer():
+    return ",".join(c.name for c in CODECS)
+
+
+# callee: the first codec in the caller's list we support (PCM if there is no list)
+def choose(offered):
+    for name in (offered or "").split(","):
+        codec = BY_NAME.get(name.strip())
+        if codec:
+            return codec
+    return PCM
+
+
+# caller: the codec named in /call_accept (PCM if none)
+def by_name(name):
+    return BY_NAME.get((name or "").strip(), PCM)
+
+
+# ---------- sample rate conversion ----------
+
+class Resampler:
+    """
+    Linear-interpolation rate converter for a stream of 16-bit mono chunks, for
+    devices that can't be opened at the codec's rate. Downsampling averages the
+    input over each output step first, which keeps most aliasing out of speech.
+    """
+
+    def __init__(self, src_rate, dst_rate):
+        self.step = src_rate / dst_rate
+        self.pos = 0.0          # position of the next output sample, 0 = the last sample of the previous chunk
+        self.last = 0
+        self.width = max(1, int(self.step))     # input samples averaged per output sample when downsampling
+        self.history = [0] * (self.width - 1)   # raw input the average still needs
+
+    def convert(self, pcm):
+        samples = _samples(pcm)
+        if self.width > 1:
+            # moving average over `width` samples (a crude low-pass)
+            w = self.width
+            raw = self.history + samples.tolist()
+            total = sum(raw[:w - 1])
+            smoothed = array.array("h")
+            for j in range(len(samples)):
+                total += raw[j + w - 1]
+                smoothed.append(total // w)
+                total -= raw[j]
+            self.history = raw[len(raw) - (w - 1):]
+            samples = smoothed
+        extended = array.array("h", [self.last])
+        extended.extend(samples)
+        out = array.array("h")
+        pos, step, n = self.pos, self.step, len(samples)
+        while pos < n:
+            i = int(pos)
+            frac = pos - i
+            a = extended[i]
+            out.append(int(a + (extended[i + 1] - a) * frac))
+            pos += step
+        self.pos = pos - n
+        if n:
+            self.last = samples[-1]
+        return out.tobytes()
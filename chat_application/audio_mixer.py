@@ -0,0 +1,82 @@
+# audio_mixer.py
+# Mixing for conference calls (see ConferenceCall in media_relay.py).
+#
+# Every participant should hear everybody but themselves. Instead of summing the
+# other N-1 streams once per participant (N^2 work), the mixer sums all streams
+# once and subtracts each talker's own frame from the total. Sums are done in
+# 32 bits and clipped back to 16-bit at the end, so a loud moment in a big room
+# saturates instead of wrapping around into a crack.
+#
+# Participants that sent nothing this frame aren't in the sum and hear the plain
+# total: the caller can encode that one mix once and send it to all of them.
+#
+# NumPy does the sums when it's installed; otherwise the same arithmetic runs on
+# Python lists, which is fine for a handful of participants (bench_mixer.py has
+# the numbers).
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SAMPLE_WIDTH = 2                # 16-bit mono PCM, native byte order like the audio devices
+INT16_MIN = -32768
+INT16_MAX = 32767
+
+
+class Mixer:
+    """Mixes frames of `frame` samples; one mix per talker with its own voice left out."""
+
+    def __init__(self, frame, use_numpy=None):
+        self.frame = frame
+        self.frame_bytes = frame * SAMPLE_WIDTH
+        self.use_numpy = numpy is not None if use_numpy is None else use_numpy and numpy is not None
+        self.silence = bytes(self.frame_bytes)
+
+    # helper: exactly one frame of PCM (decoders may hand back a bit more or less)
+    def _fit(self, pcm):
+        if len(pcm) == self.frame_bytes:
+            return pcm
+        return bytes(pcm[:self.frame_bytes]).ljust(self.frame_bytes, b"\0")
+
+    # frames: one PCM frame per participant, None for those that sent nothing.
+    # Returns (total, mixes): total is everyone mixed (what the silent ones hear),
+    # mixes[i] is total without frames[i] (None where frames[i] is None).
+    # total is None when nobody sent anything.
+    def mix(self, frames):
+        talking = [i for i, pcm in enumerate(frames) if pcm is not None]
+        mixes = [None] * len(frames)
+        if not talking:
+            return None, mixes
+        pcm = [self._fit(frames[i]) for i in talking]
+        if self.use_numpy:
+            total, own = self._mix_numpy(pcm)
+        else:
+            total, own = self._mix_python(pcm)
+        for i, mixed in zip(talking, own):
+            mixes[i] = mixed
+        return total, mixes
+
+    def _mix_numpy(self, pcm):
+        block = numpy.frombuffer(b"".join(pcm), dtype=numpy.int16).reshape(len(pcm), self.frame)
+        total = block.sum(axis=0, dtype=numpy.int32)
+        # everyone minus themselves, all rows at once
+        own = numpy.clip(total - block, INT16_MIN, INT16_MAX).astype(numpy.int16)
+        total = numpy.clip(total, INT16_MIN, INT16_MAX).astype(numpy.int16)
+        return total.tobytes(), [row.tobytes() for row in own]
+
+    def _mix_python(self, pcm):
+        streams = []
+        for frame in pcm:
+            samples = array.array("h")
+            samples.frombytes(frame)
+            streams.append(samples)
+        if len(streams) == 1:
+            # one talker: the others hear just them, they hear nothing
+            return pcm[0], [self.silence]
+        total = [sum(column) for column in zip(*streams)]
+        own = [array.array("h", [INT16_MIN if t - s < INT16_MIN else INT16_MAX if t - s > INT16_MAX else t - s
+                                 for t, s in zip(total, samples)]).tobytes() for samples in streams]
+        clipped = array.array("h", [INT16_MIN if t < INT16_MIN else INT16_MAX if t > INT16_MAX else t for t in total])
+        return clipped.tobytes(), own
@@ -0,0 +1,118 @@
+# bench_broadcast.py
+# Fan-out cost of one broadcast: per-recipient encoding (old _broadcast) versus
+# encode-once + shared memoryview (MessageHandler._fan_out).
+#
+#   python3 bench_broadcast.py --recipients 1000
+#
+# No sockets are involved: recipients get an in-memory queue, so the numbers are
+# the server-side CPU and the bytes copied per broadcast.
+import argparse
+import time
+from client_registry import ClientRegistry
+from message_handler import MessageHandler
+
+
+class CollectingQueue:
+    """Stands in for an OutboundQueue; just keeps what was put."""
+
+    def __init__(self):
+        self.items = []
+
+    def put(self, data, droppable=True):
+        self.items.append(data)
+        return True
+
+
+def build_room(recipients):
+    registry = ClientRegistry()
+    sender = object()
+    registry.add(sender, "sender", ("127.0.0.1", 1), CollectingQueue())
+    queues = []
+    for i in range(recipients):
+        q = CollectingQueue()
+        registry.add(object(), f"user{i}", ("127.0.0.1", 1000 + i), q)
+        queues.append(q)
+    handler = MessageHandler(sender, ("127.0.0.1", 1), registry, start_thread=False)
+    return registry, handler, queues
+
+
+# bytes held by distinct buffers across all queues that did not exist before the
+# fan-out (= bytes the fan-out had to produce)
+def bytes_materialised(queues, preexisting=()):
+    skip = {id(obj) for obj in preexisting}
+    seen = {}
+    for q in queues:
+        for item in q.items:
+            for piece in (item if isinstance(item, tuple) else (item,)):
+                base = piece.obj if isinstance(piece, memoryview) else piece
+                if id(base) not in skip:
+                    seen[id(base)] = len(base)
+    return sum(seen.values())
+
+
+def reset(queues):
+    for q in queues:
+        q.items.clear()
+
+
+# the old _broadcast: encode inside the per-recipient loop
+def legacy_broadcast(handler, message):
+    for entry in handler.registry.entries():
+        if entry.sock != handler.client_socket and entry.outbound:
+            entry.outbound.put((message + "\n").encode('utf-8'), droppable=True)
+
+
+def measure(label, fn, queues, rounds, preexisting=()):
+    fn()
+    copied = bytes_materialised(queues, preexisting)
+    reset(queues)
+
+    start = time.process_time()
+    for _ in range(rounds):
+        fn()
+        reset(queues)
+    cpu = (time.process_time() - start) / rounds
+    print(f"  {label:<28} {cpu * 1e6:10.1f} us CPU   {copied:>12,} bytes copied")
+    return cpu, copied
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recipients", type=int, default=1000)
+    parser.add_argument("--message-bytes", type=int, default=512)
+    parser.add_argument("--file-bytes", type=int, default=1 << 20)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    registry, handler, queues = build_room(args.recipients)
+    message = "x" * args.message_bytes
+
+    print(f"broadcast of a {args.message_bytes}-byte chat line to {args.recipients} recipients")
+    old = measure("encode per recipient", lambda: legacy_broadcast(handler, message), queues, args.rounds)
+    new = measure("encode once (memoryview)", lambda: handler._broadcast(message), queues, args.rounds)
+    print(f"  -> {old[0] / new[0]:.1f}x less CPU, {old[1] / max(new[1], 1):.0f}x fewer bytes\n")
+
+    # /file all: the old path sliced a private copy out of the receive buffer first
+    received = b"/file header already parsed" + bytes(args.file_bytes)
+    offset = len(received) - args.file_bytes
+    meta = f"[FILE] sender big.bin {args.file_bytes}\n".encode('utf-8')
+
+    def legacy_file_all():
+        filebytes = received[offset:]
+        for entry in registry.entries():
+            if entry.sock != handler.client_socket:
+                entry.outbound.put(meta, droppable=False)
+                entry.outbound.put(filebytes, droppable=False)
+
+    def file_all():
+        handler._fan_out(lambda protocol: (meta, memoryview(received)[offset:]), droppable=False)
+
+    print(f"/file all of {args.file_bytes:,} bytes to {args.recipients} recipients")
+    rounds = max(1, args.rounds // 10)
+    old = measure("slice copy + per-socket send", legacy_file_all, queues, rounds, (received, meta))
+    new = measure("shared memoryview", file_all, queues, rounds, (received, meta))
+    print(f"  -> {old[1] - new[1]:,} fewer bytes copied, {(old[0] - new[0]) * 1e6:+.1f} us CPU saved")
+
+
+if __name__ == "__main__":
+    main()
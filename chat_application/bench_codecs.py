@@ -0,0 +1,109 @@
+# bench_codecs.py
+# What each call codec (audio_codec.py) costs and buys: bandwidth per call on
+# the relay, encode/decode CPU per 20 ms, the relay's CPU per packet, and how
+# close the decoded audio stays to the original.
+#
+#   python3 bench_codecs.py --seconds 10 --uplink-mbit 100
+#
+# The input is a synthetic voice-like signal (a wandering pitch with harmonics,
+# syllable-shaped loudness and some noise), generated at 44.1 kHz for "pcm" and
+# at each codec's own rate for the others, as the audio device would capture it.
+# "wire" counts what one direction of a call puts on the network over UDP: the
+# codec payload plus the media header and tag (media.py) plus UDP/IPv4 headers.
+# The relay sends every participant the other's stream, so a two-party call
+# costs it 2 x wire of uplink; "calls" is how many fit in --uplink-mbit.
+# "relay" is MediaRelay.datagram() per packet (open, re-seal, hand to the
+# socket), and "calls/core" how many calls one core of it can forward.
+import argparse
+import array
+import math
+import random
+import time
+import audio_codec
+import media
+from media_relay import MediaRelay
+
+IP_UDP_HEADERS = 28
+
+
+def voice(rate, seconds, seed):
+    rng = random.Random(seed)
+    out = array.array("h")
+    phase = 0.0
+    pitch = 140.0
+    for i in range(int(rate * seconds)):
+        t = i / rate
+        if i % (rate // 50) == 0:
+            pitch = min(260.0, max(90.0, pitch + rng.gauss(0, 6)))
+        phase += 2 * math.pi * pitch / rate
+        envelope = 0.5 + 0.5 * math.sin(2 * math.pi * 3.3 * t) ** 2      # ~6 syllables a second
+        sample = sum(math.sin(k * phase) / k for k in range(1, 8)) * 5000 * envelope + rng.gauss(0, 150)
+        out.append(max(-32768, min(32767, int(sample))))
+    return out.tobytes()
+
+
+def snr(original, decoded):
+    a, b = array.array("h"), array.array("h")
+    a.frombytes(original)
+    b.frombytes(decoded[:len(original)])
+    noise = sum((x - y) ** 2 for x, y in zip(a, b))
+    signal = sum(x * x for x in a)
+    return float("inf") if not noise else 10 * math.log10(signal / noise)
+
+
+def relay_cost(payload, packets):
+    relay = MediaRelay()
+    call = relay.open_call("a", "b")
+    a, b = call.legs
+    b.addr = ("127.0.0.1", 2)
+    sent = []
+    packet = media.seal(a.key, media.UP, 1, 1, 0, a.token, payload)
+    start = time.process_time()
+    for i in range(packets):
+        relay.datagram(packet, ("127.0.0.1", 1), lambda data, addr: sent.append(len(data)))
+    return (time.process_time() - start) / packets
+
+
+def bench(codec, seconds, uplink_mbit, seed):
+    pcm = voice(codec.rate, seconds, seed)
+    frame_bytes = codec.frame * audio_codec.SAMPLE_WIDTH
+    frames = [pcm[i:i + frame_bytes] for i in range(0, len(pcm) - frame_bytes + 1, frame_bytes)]
+
+    encoder, decoder = codec.encoder(), codec.decoder()
+    start = time.process_time()
+    packets = [encoder.encode(f) for f in frames]
+    encode_cpu = (time.process_time() - start) / len(frames)
+    start = time.process_time()
+    decoded = b"".join(decoder.decode(p) for p in packets)
+    decode_cpu = (time.process_time() - start) / len(frames)
+
+    per_second = codec.rate / codec.frame
+    payload = sum(len(p) for p in packets) / len(packets)
+    wire = (payload + media.HEADER.size + media.TAG_SIZE + IP_UDP_HEADERS) * per_second * 8 / 1000
+    relay = relay_cost(packets[len(packets) // 2], 2000)
+    calls = uplink_mbit * 1000 / (2 * wire)
+    frame_ms = codec.frame / codec.rate * 1000
+    print(f"  {codec.name:<6} {codec.rate / 1000:4.1f} kHz  {frame_ms:4.1f} ms  {payload:6.0f} B/packet"
+          f"  payload {payload * per_second * 8 / 1000:6.1f} kbit/s  wire {wire:6.1f} kbit/s  calls {calls:6.0f}"
+          f"  encode {encode_cpu * 1e6:5.0f} us  decode {decode_cpu * 1e6:5.0f} us  SNR {snr(pcm, decoded):5.1f} dB"
+          f"  relay {relay * 1e6:5.1f} us/packet  calls/core {1 / (relay * per_second * 2):6.0f}")
+    return wire
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--uplink-mbit", type=float, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"one direction of a call, {args.seconds:.0f} s of voice-like audio; calls in {args.uplink_mbit:.0f} Mbit/s "
+          f"of relay uplink (opus {'available' if audio_codec.opuslib else 'not installed'})")
+    wires = {c.name: bench(c, args.seconds, args.uplink_mbit, args.seed) for c in audio_codec.CODECS}
+    for name, wire in wires.items():
+        if name != "pcm":
+            print(f"  {name}: {wires['pcm'] / wire:.1f}x the calls of pcm on the same uplink")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# bench_compression.py
+# Bandwidth saved versus CPU spent by frame compression (compression.py) on the
+# traffic we mostly carry: chat lines, pasted server logs and CSV files.
+#
+#   python3 bench_compression.py --messages 20000 --file-mb 32
+#
+# No sockets: the messages and files are generated, framed as the server would
+# send them and run through the same Deflater / ChunkPacker a connection uses.
+# "per message" compresses every text frame on its own, for comparison with the
+# per-connection stream. A file's "pays off below" is the link speed under which
+# compressing (one core, overlapped with sending) beats sending raw.
+import argparse
+import random
+import time
+import zlib
+import compression
+import frame_codec
+
+
+def chat_lines(rng, count):
+    words = ("ok", "deploy", "is", "the", "build", "green", "again", "lunch?", "ship", "it", "looks", "fine",
+             "can", "you", "check", "staging", "logs", "please", "thanks", "on", "my", "way")
+    return [f"[user{rng.randrange(12)}] (10.0.0.{rng.randrange(2, 40)}:{rng.randrange(40000, 60000)}): "
+            + " ".join(rng.choice(words) for _ in range(rng.randrange(3, 14))) for _ in range(count)]
+
+
+def log_lines(rng, count):
+    events = ("[CONNECTED]", "[DISCONNECTED]", "[BROADCAST]", "[FILE RELAYED]", "[PRIVATE]", "[TLS OK]")
+    return [f"[2026-10-17 12:{i // 60 % 60:02d}:{i % 60:02d}] {rng.choice(events)} user{rng.randrange(50)} "
+            f"(('10.0.{rng.randrange(4)}.{rng.randrange(255)}', {rng.randrange(30000, 65000)})) "
+            f"took {rng.random() * 20:.3f} ms" for i in range(count)]
+
+
+# pastes of 5-60 log lines sent as one message
+def log_pastes(rng, count):
+    lines = log_lines(rng, count * 30)
+    pastes, i = [], 0
+    for _ in range(count):
+        n = rng.randrange(5, 60)
+        pastes.append("\n".join(lines[i:i + n]))
+        i = (i + n) % (len(lines) - 60)
+    return pastes
+
+
+def csv_file(rng, size):
+    rows, total, i = [], 0, 0
+    rows.append("id,timestamp,sensor,region,value,status\n")
+    while total < size:
+        row = (f"{i},2026-10-17T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}Z,sensor-{rng.randrange(500)},"
+               f"{rng.choice(('eu-west', 'us-east', 'ap-south'))},{rng.gauss(20, 5):.3f},{rng.choice(('ok', 'ok', 'ok', 'warn'))}\n")
+        rows.append(row)
+        total += len(row)
+        i += 1
+    return "".join(rows).encode()[:size]
+
+
+def bench_text(label, messages):
+    frames = [frame_codec.encode_text(frame_codec.FRAME, m) for m in messages]
+    raw = sum(len(f[0]) for f in frames)
+
+    deflater = compression.Deflater()
+    start = time.process_time()
+    packed = [deflater.pack(f)[0] for f in frames]
+    cpu = time.process_time() - start
+    streamed = sum(len(p) for p in packed)
+
+    inflater = compression.Inflater()
+    start = time.process_time()
+    for p in packed:
+        _, _, flags, _, _ = frame_codec.HEADER.unpack_from(p)
+        if flags & frame_codec.FLAG_COMPRESSED:
+            inflater.text(memoryview(p)[frame_codec.HEADER.size:])
+    inflate_cpu = time.process_time() - start
+
+    # every message on its own, same settings
+    alone = 0
+    for f in frames:
+        payload = f[0][frame_codec.HEADER.size:]
+        if len(payload) < compression.TEXT_MIN:
+            alone += len(f[0])
+            continue
+        c = zlib.compressobj(compression.TEXT_LEVEL, zlib.DEFLATED, -compression.TEXT_WBITS, compression.TEXT_MEMLEVEL)
+        alone += frame_codec.HEADER.size + len(c.compress(payload) + c.flush())
+
+    n = len(frames)
+    print(f"  {label:<14} {raw / n:7.0f} B/msg  stream {streamed / raw:6.1%}  per message {alone / raw:6.1%}"
+          f"  deflate {cpu / n * 1e6:6.1f} us/msg  inflate {inflate_cpu / n * 1e6:5.1f} us/msg")
+
+
+def bench_file(label, filename, data, chunk_size):
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    packer = compression.ChunkPacker(filename, len(data))
+    start = time.process_time()
+    packed = [packer.pack(c) for c in chunks]
+    cpu = time.process_time() - start
+    wire = sum(len(p) if p is not None else len(c) for p, c in zip(packed, chunks))
+
+    start = time.process_time()
+    for p in packed:
+        if p is not None:
+            compression.inflate_chunk(p)
+    inflate_cpu = time.process_time() - start
+
+    mb = len(data) / (1 << 20)
+    if not compression.worth_compressing(filename, len(data)):
+        print(f"  {label:<14} {mb:6.1f} MB -> {wire / len(data):6.1%}  skipped by extension, no CPU spent")
+        return
+    if not packer.saved:
+        print(f"  {label:<14} {mb:6.1f} MB -> {wire / len(data):6.1%}  gave up after "
+              f"{compression.GIVE_UP_AFTER} chunks ({cpu * 1e3:.1f} ms)")
+        return
+    rate = mb / cpu
+    print(f"  {label:<14} {mb:6.1f} MB -> {wire / len(data):6.1%}  deflate {rate:6.1f} MB/s"
+          f"  inflate {mb / inflate_cpu:6.1f} MB/s  pays off below {rate:4.0f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--file-mb", type=int, default=32)
+    parser.add_argument("--chunk-kb", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    print(f"text frames, one connection (wire bytes as % of raw, zlib level {compression.TEXT_LEVEL}, "
+          f"{1 << compression.TEXT_WBITS >> 10} KiB window, frames under {compression.TEXT_MIN} B raw)")
+    bench_text("chat lines", chat_lines(rng, args.messages))
+    bench_text("log lines", log_lines(rng, args.messages))
+    bench_text("log pastes", log_pastes(rng, args.messages // 10))
+
+    size = args.file_mb << 20
+    print(f"\nfiles in {args.chunk_kb} KiB chunks (zlib level {compression.FILE_LEVEL}, each chunk on its own)")
+    bench_file("CSV", "readings.csv", csv_file(rng, size), args.chunk_kb * 1024)
+    logs = "\n".join(log_lines(rng, size // 70)).encode()[:size]
+    bench_file("server log", "server_log.txt", logs, args.chunk_kb * 1024)
+    noise = rng.randbytes(size)
+    bench_file("random .bin", "blob.bin", noise, args.chunk_kb * 1024)
+    bench_file("random .zip", "blob.zip", noise, args.chunk_kb * 1024)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# bench_event_log.py
+# Answering "everything user X did between T1 and T2" from the structured event
+# log (event_log.py) against scanning the text log for it.
+#
+#   python3 bench_event_log.py --events 1000000 --days 30 --users 200
+#
+# Writes --events chat-like events from --users users spread over --days days,
+# once as a text log (the server_log.txt format) and once as event segments,
+# into a temporary directory. Then one user's events in a one-hour window are
+# looked up --queries times:
+#   text scan - read the whole text log, match timestamp range and user per line
+#   indexed   - event_log.query(): segments whose summary can't match are
+#               skipped, the others are entered at the time index
+import argparse
+import os
+import random
+import re
+import tempfile
+import time
+from datetime import datetime
+import event_log
+
+
+def generate(count, days, users, seed):
+    rng = random.Random(seed)
+    start = time.mktime(time.strptime("2025-10-01", "%Y-%m-%d"))
+    step = days * 86400 / count
+    names = [f"user{i}" for i in range(users)]
+    for i in range(count):
+        name = rng.choice(names)
+        yield start + i * step, f"[BROADCAST] [{name}] (10.0.0.{rng.randrange(1, 255)}:{rng.randrange(30000, 60000)}): message {i}", name
+
+
+def text_scan(path, user, since, until):
+    pattern = re.compile(r"^\[([^\]]+)\] \[BROADCAST\] \[([^\]]+)\]")
+    lo = datetime.fromtimestamp(since).strftime("%Y-%m-%d %H:%M:%S")
+    hi = datetime.fromtimestamp(until).strftime("%Y-%m-%d %H:%M:%S")
+    found = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            match = pattern.match(line)
+            if match and lo <= match.group(1) <= hi and match.group(2) == user:
+                found += 1
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=1000000)
+    parser.add_argument("--days", type=float, default=30)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=5)
+    parser.add_argument("--segment-mb", type=int, default=event_log.SEGMENT_BYTES >> 20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        text_path = os.path.join(directory, "server_log.txt")
+        events_dir = os.path.join(directory, "events")
+        log = event_log.EventLog(events_dir, segment_bytes=args.segment_mb << 20)
+        batch = []
+        write_time = 0.0
+        with open(text_path, "w", encoding="utf-8") as text:
+            for when, event, name in generate(args.events, args.days, args.users, args.seed):
+                text.write(f"[{datetime.fromtimestamp(when).strftime('%Y-%m-%d %H:%M:%S')}] {event}\n")
+                batch.append(event_log.record(when, event, {"user": name}))
+                if len(batch) == 1024:
+                    start = time.perf_counter()
+                    log.append(batch)
+                    write_time += time.perf_counter() - start
+                    batch = []
+        log.append(batch)
+        log.close()
+        segments = len(event_log.segment_numbers(events_dir))
+        size = sum(os.path.getsize(os.path.join(events_dir, f)) for f in os.listdir(events_dir))
+        print(f"{args.events} events: text log {os.path.getsize(text_path) >> 20} MiB, "
+              f"event log {size >> 20} MiB in {segments} segments "
+              f"(appending {args.events / write_time:.0f} records/s)")
+
+        rng = random.Random(args.seed + 1)
+        first = time.mktime(time.strptime("2025-10-01", "%Y-%m-%d"))
+        scan = indexed = 0.0
+        for _ in range(args.queries):
+            user = f"user{rng.randrange(args.users)}"
+            since = first + rng.uniform(0, args.days * 86400 - 3600)
+            until = since + 3600
+            start = time.perf_counter()
+            expected = text_scan(text_path, user, since, until)
+            scan += time.perf_counter() - start
+            start = time.perf_counter()
+            found = sum(1 for _ in event_log.query(events_dir, user, since, until))
+            indexed += time.perf_counter() - start
+            if found != expected:
+                print(f"  mismatch for {user}: text scan {expected}, indexed {found}")
+        print(f"  one user, one hour: text scan {scan / args.queries * 1000:8.1f} ms   "
+              f"indexed {indexed / args.queries * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
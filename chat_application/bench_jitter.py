@@ -0,0 +1,155 @@
+# bench_jitter.py
+# Call playback under network jitter and loss: writing each chunk to the audio
+# device as it arrives (what the client used to do) versus the jitter buffer
+# (jitter_buffer.py) with a fixed and an adaptive delay.
+#
+#   python3 bench_jitter.py                           # built-in network profiles
+#   python3 bench_jitter.py --jitter-ms 30 --loss 0.02
+#   python3 bench_jitter.py --trace delays.txt        # one delay in ms per packet, "lost" for a lost one
+#
+# No sockets or audio device: a sender captures one CHUNK every chunk duration,
+# each packet gets the trace's network delay, and the device plays one chunk per
+# chunk duration on the same virtual clock. Mouth-to-ear is from the first sample
+# of a chunk being spoken to it being played (so it includes the chunk's own
+# duration); device and OS buffers come on top of that in real life.
+#   underruns - chunks the device had nothing to play for (gaps)
+#   concealed - chunks filled in by the jitter buffer (lost ones and underruns)
+#   late      - chunks that arrived after their turn and were thrown away
+import argparse
+import random
+import statistics
+from jitter_buffer import JitterBuffer
+
+RATE = 44100
+CHUNK = 1024                    # same as client_handler
+
+# base delay (ms), jitter (ms, exponential), loss, spike probability per packet, spike (ms)
+PROFILES = {
+    "lan": (2, 1, 0.0, 0.0, 0),
+    "wifi": (8, 6, 0.005, 0.01, 120),
+    "mobile": (45, 25, 0.02, 0.005, 300),
+}
+
+
+# network delay in seconds per packet (None = lost). Packets leave in order and
+# mostly arrive in order: a delayed one holds up the ones behind it.
+def make_trace(rng, seconds, base_ms, jitter_ms, loss, spike_prob, spike_ms):
+    chunk_s = CHUNK / RATE
+    trace = []
+    prev_arrival = 0.0
+    for i in range(int(seconds / chunk_s)):
+        if rng.random() < loss:
+            trace.append(None)
+            continue
+        delay = (base_ms + rng.expovariate(1 / jitter_ms) if jitter_ms else base_ms) / 1000
+        if rng.random() < spike_prob:
+            delay += spike_ms / 1000
+        sent = (i + 1) * chunk_s
+        arrival = max(sent + delay, prev_arrival)
+        prev_arrival = arrival
+        trace.append(arrival - sent)
+    return trace
+
+
+def load_trace(path):
+    trace = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line:
+                trace.append(None if line in ("lost", "-") else float(line) / 1000)
+    return trace
+
+
+# (chunk index, arrival time) in arrival order; chunk i is captured over [i, i+1) chunk durations
+def arrivals(trace):
+    chunk_s = CHUNK / RATE
+    return sorted(((i, (i + 1) * chunk_s + d) for i, d in enumerate(trace) if d is not None), key=lambda a: a[1])
+
+
+# the old client: every chunk goes to the device as soon as it arrives
+def simulate_direct(trace):
+    chunk_s = CHUNK / RATE
+    device_free = 0.0
+    delays, underruns, out_of_order, last = [], 0, 0, -1
+    for i, arrival in arrivals(trace):
+        if arrival > device_free:
+            # the device ran dry in between
+            underruns += round((arrival - device_free) / chunk_s) if device_free else 0
+            device_free = arrival
+        delays.append(device_free - i * chunk_s)
+        device_free += chunk_s
+        if i < last:
+            out_of_order += 1
+        last = max(last, i)
+    return {"underruns": underruns, "concealed": 0, "late": 0, "dropped": 0, "misordered": out_of_order,
+            "delays": delays}
+
+
+def simulate_buffer(trace, min_delay, max_delay):
+    chunk_s = CHUNK / RATE
+    jitter = JitterBuffer(RATE, CHUNK, min_delay, max_delay)
+    pcm = bytes(CHUNK * 2)
+    pending = arrivals(trace)
+    end = len(trace) * chunk_s + 2 * max_delay + 1
+    delays, k, tick = [], 0, 0.0
+    while tick < end and (k < len(pending) or jitter.packets):
+        while k < len(pending) and pending[k][1] <= tick:
+            i, arrival = pending[k]
+            jitter.put(pcm, (i * CHUNK) & 0xFFFFFFFF, arrival)
+            k += 1
+        ts, _ = jitter.pop()
+        if ts is not None:
+            delays.append(tick - ts / RATE)
+        tick += chunk_s
+    return {"underruns": jitter.underruns, "concealed": jitter.underruns + jitter.lost, "late": jitter.late,
+            "dropped": jitter.dropped, "misordered": 0, "delays": delays}
+
+
+def report(label, result, sent):
+    d = sorted(result["delays"]) or [0.0]
+    played = len(result["delays"])
+    p95 = d[int(len(d) * 0.95) - 1] if len(d) > 1 else d[0]
+    print(f"  {label:<16} played {played / sent:6.1%}  underruns {result['underruns']:5d}  "
+          f"concealed {result['concealed']:5d}  late {result['late']:4d}  dropped {result['dropped']:4d}  "
+          f"mouth-to-ear mean {statistics.mean(d) * 1000:6.1f} ms  p95 {p95 * 1000:6.1f} ms  max {d[-1] * 1000:6.1f} ms"
+          + (f"  ({result['misordered']} out of order)" if result["misordered"] else ""))
+
+
+def run(label, trace, fixed_ms):
+    lost = sum(d is None for d in trace)
+    print(f"{label}: {len(trace)} chunks of {CHUNK / RATE * 1000:.1f} ms, {lost} lost in the network")
+    report("direct write", simulate_direct(trace), len(trace))
+    report(f"fixed {fixed_ms} ms", simulate_buffer(trace, fixed_ms / 1000, fixed_ms / 1000), len(trace))
+    report("adaptive", simulate_buffer(trace, 0.04, 0.4), len(trace))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=120)
+    parser.add_argument("--profile", choices=sorted(PROFILES), action="append",
+                        help="network profile(s) to simulate (default: all)")
+    parser.add_argument("--jitter-ms", type=float, help="custom profile: mean jitter on top of --base-ms")
+    parser.add_argument("--base-ms", type=float, default=20)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--spike-prob", type=float, default=0.0)
+    parser.add_argument("--spike-ms", type=float, default=0.0)
+    parser.add_argument("--trace", help="file with one network delay in ms per packet ('lost' = lost)")
+    parser.add_argument("--fixed-ms", type=int, default=60, help="delay of the fixed jitter buffer")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    if args.trace:
+        run(args.trace, load_trace(args.trace), args.fixed_ms)
+    elif args.jitter_ms is not None:
+        run("custom", make_trace(rng, args.seconds, args.base_ms, args.jitter_ms, args.loss, args.spike_prob,
+                                 args.spike_ms), args.fixed_ms)
+    else:
+        for name in args.profile or PROFILES:
+            run(name, make_trace(rng, args.seconds, *PROFILES[name]), args.fixed_ms)
+            print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# bench_logging.py
+# What a log_event() call costs the thread that makes it: the old logger (lock,
+# print, open/append/close per line) against logger_utility's queued writer.
+#
+#   python3 bench_logging.py --threads 8 --lines 20000
+#
+# Each of --threads threads logs --lines "[BROADCAST]"-like lines as fast as it
+# can, into a temporary directory (stdout echo off for both, so the terminal
+# doesn't set the pace). Reported per call: mean and 99th percentile latency as
+# the calling thread sees it, then the time until every line is on disk.
+# --max-kb makes the writer rotate files that size.
+#
+# The second part is one thread logging [BROADCAST] lines the way the chat
+# handler does, per call including the writer's share of the CPU (this is what
+# a broadcast-heavy room pays per message):
+#   eager      - f-string built by the caller, every line logged
+#   lazy       - %-template, formatted on the writer thread
+#   sampled    - lazy, with --sample of [BROADCAST] kept
+#   level off  - [BROADCAST] below the log level: nothing is formatted or queued
+import argparse
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+import logger_utility
+
+
+class OldLogger:
+    """log_event as it was before the queued writer (without the print)."""
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.lock = threading.Lock()
+
+    def log_event(self, event):
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        log_line = f"[{timestamp}] {event}"
+        with self.lock:
+            with open(self.log_file, "a", encoding="utf-8") as f:
+                f.write(log_line + "\n")
+
+    def flush(self):
+        pass
+
+
+def run(name, logger, threads, lines):
+    latencies = []
+
+    def worker(n):
+        times = []
+        clock = time.perf_counter
+        for i in range(lines):
+            start = clock()
+            logger.log_event(f"[BROADCAST] user{n}: message number {i} in the general chat")
+            times.append(clock() - start)
+        latencies.extend(times)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    logged = time.perf_counter() - start
+    logger.flush()
+    on_disk = time.perf_counter() - start
+
+    latencies.sort()
+    mean = sum(latencies) / len(latencies)
+    p99 = latencies[int(len(latencies) * 0.99)]
+    total = threads * lines
+    print(f"  {name:<7} per call {mean * 1e6:7.1f} us mean, {p99 * 1e6:7.1f} us p99   "
+          f"{total / logged:9.0f} lines/s logged, all on disk after {on_disk:.2f}s")
+
+
+def per_message(logger, lines, lazy):
+    uname, address, text = "alice", ("127.0.0.1", 50123), "see you all at the standup in five minutes"
+    start = time.process_time()
+    for i in range(lines):
+        full_msg = f"[{uname}] ({address[0]}:{address[1]}): {text}"
+        if lazy:
+            logger.log_event("[BROADCAST] %s", full_msg, user=uname, peer=address)
+        else:
+            logger.log_event(f"[BROADCAST] {full_msg}", user=uname, peer=address)
+    logger.flush()
+    return (time.process_time() - start) / lines
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--lines", type=int, default=20000, help="per thread")
+    parser.add_argument("--max-kb", type=int, default=1024, help="rotate the queued writer's file at this size")
+    parser.add_argument("--policy", choices=logger_utility.LOG_POLICIES, default="block")
+    parser.add_argument("--sample", type=float, default=0.01, help="share of [BROADCAST] kept when sampled")
+    args = parser.parse_args()
+
+    print(f"{args.threads} threads x {args.lines} lines")
+    with tempfile.TemporaryDirectory() as directory:
+        run("old", OldLogger(os.path.join(directory, "old_log.txt")), args.threads, args.lines)
+
+        logger_utility.configure(echo=False, max_bytes=args.max_kb << 10, backups=3, policy=args.policy)
+        logger = logger_utility.Logger(os.path.join(directory, "queued_log.txt"))
+        run("queued", logger, args.threads, args.lines)
+        stats = logger.stats()
+        files = sorted(f for f in os.listdir(directory) if f.startswith("queued_log"))
+        print(f"  queued writer: {stats['written']} lines written, {stats['dropped']} dropped "
+              f"({args.policy} policy), {stats['rotations']} rotations; files kept: {', '.join(files)}")
+
+        print(f"[BROADCAST] per message, 1 thread x {args.lines} lines, CPU incl. the writer")
+        runs = (("eager", {}, False), ("lazy", {}, True),
+                ("sampled", {"sample": {"BROADCAST": args.sample}}, True),
+                ("level off", {"level": "warning"}, True))
+        for name, options, lazy in runs:
+            logger_utility.configure(level="info", sample={})
+            logger_utility.configure(**options)
+            cost = per_message(logger, args.lines, lazy)
+            print(f"  {name:<10} {cost * 1e6:6.2f} us/message")
+        logger_utility.close_all()
+
+
+if __name__ == "__main__":
+    main()
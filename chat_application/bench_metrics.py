@@ -0,0 +1,70 @@
+# bench_metrics.py
+# What instrumenting a call with metrics.py costs, and what a scrape costs.
+#
+#   python3 bench_metrics.py --calls 1000000 --threads 4
+#
+#   counter.inc        - one counter increment
+#   histogram.observe  - one duration recorded (value already measured)
+#   timed call         - perf_counter() before and after + observe, as the
+#                        instrumented server paths do
+# With --threads the same calls run from several threads at once (the GIL
+# serializes them; the lock adds contention on top). The scrape renders the
+# whole registry of a running server (all chat_* metrics, histograms full).
+import argparse
+import random
+import threading
+import time
+import metrics
+
+
+def per_call(fn, calls, threads):
+    def worker():
+        for _ in range(calls // threads):
+            fn()
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return (time.perf_counter() - start) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=1000000)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    # the server's metrics, as a running server registers them
+    import message_handler, media_relay, outbound_queue, connection_manager   # noqa: F401 (registration)
+    counter = metrics.counter("bench_calls_total", "bench")
+    histogram = metrics.histogram("bench_seconds", "bench")
+    clock = time.perf_counter
+
+    def timed():
+        start = clock()
+        histogram.observe(clock() - start)
+
+    empty = per_call(lambda: None, args.calls, args.threads)
+    print(f"{args.calls} calls, {args.threads} thread(s), per call on top of an empty call ({empty * 1e9:.0f} ns):")
+    for name, fn in (("counter.inc", counter.inc),
+                     ("histogram.observe", lambda: histogram.observe(0.000123)),
+                     ("timed call", timed)):
+        cost = per_call(fn, args.calls, args.threads) - empty
+        print(f"  {name:<18} {cost * 1e9:6.0f} ns")
+
+    rng = random.Random(1)
+    for metric in metrics.registry.metrics.values():
+        for series in metric[2].values():
+            if isinstance(series, metrics.Histogram):
+                for _ in range(10000):
+                    series.observe(rng.expovariate(1 / 0.002))
+    start = time.perf_counter()
+    text = metrics.registry.render()
+    print(f"  scrape             {(time.perf_counter() - start) * 1000:6.2f} ms for {len(text.splitlines())} lines")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# bench_mixer.py
+# CPU the server spends on a conference room (ConferenceCall in media_relay.py)
+# per frame of audio, at a few room sizes.
+#
+#   python3 bench_mixer.py --participants 4 16 64 --talkers 3 --codec adpcm
+#
+# "mix" is audio_mixer.Mixer alone: everyone's frames summed once, each talker's
+# own frame taken back out, clipped to 16-bit. It runs with NumPy (if installed)
+# and with the pure-Python fallback. "room" is a whole ConferenceCall.tick():
+# decoding what each talker sent, mixing, encoding one stream per talker plus
+# the one everybody else shares, sealing a packet per participant. Both are
+# timed with everyone talking and with --talkers talking (the usual case: most
+# of a big room listens).
+#   budget - share of one core a room takes (time per frame / frame duration)
+#   rooms  - how many such rooms one core keeps up with
+# The last columns compare what the relay sends per frame when it mixes (one
+# packet per participant) with forwarding every stream to every other
+# participant as a two-party call does (N x (N-1) packets).
+import argparse
+import math
+import random
+import time
+import array
+import audio_codec
+import audio_mixer
+import media
+from media_relay import ConferenceCall
+
+
+def frames_of(codec, n, seed):
+    rng = random.Random(seed)
+    frames = []
+    for i in range(n):
+        pitch = rng.uniform(90, 260)
+        frames.append(array.array("h", [int(4000 * math.sin(2 * math.pi * pitch * t / codec.rate)
+                                            + rng.gauss(0, 200)) for t in range(codec.frame)]).tobytes())
+    return frames
+
+
+def time_mixer(mixer, frames, talking, repeat):
+    inputs = [frame if i < talking else None for i, frame in enumerate(frames)]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        mixer.mix(inputs)
+    return (time.perf_counter() - start) / repeat
+
+
+def time_room(codec, frames, talking, repeat):
+    call = ConferenceCall("bench", codec)
+    encoder = codec.encoder()
+    payloads = [encoder.encode(frame) for frame in frames]
+    for i in range(len(frames)):
+        leg = call.new_leg(f"user{i}")
+        leg.addr = ("127.0.0.1", 10000 + i)
+        leg.primed = True
+        call.legs.append(leg)
+    sent = []
+    sendto = lambda data, addr: sent.append(len(data))
+    elapsed = 0.0
+    for _ in range(repeat):
+        for leg, payload in zip(call.legs[:talking], payloads):
+            leg.inbox.append(payload)
+        start = time.perf_counter()
+        call.tick(sendto)
+        elapsed += time.perf_counter() - start
+    return elapsed / repeat, sum(sent) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--participants", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--talkers", type=int, default=3, help="talkers in the 'usual' case")
+    parser.add_argument("--codec", default="adpcm", choices=sorted(audio_codec.BY_NAME))
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    codec = audio_codec.BY_NAME[args.codec]
+    frame_s = codec.frame / codec.rate
+
+    print(f"{codec.name}: {codec.frame} samples = {frame_s * 1000:.1f} ms per frame; "
+          f"numpy {'available' if audio_mixer.numpy else 'not installed'}")
+    for n in args.participants:
+        frames = frames_of(codec, n, n)
+        print(f"{n} participants")
+        for talking in sorted({n, min(args.talkers, n)}, reverse=True):
+            label = f"{talking} talking"
+            for name, use_numpy in (("numpy", True), ("python", False)):
+                if use_numpy and not audio_mixer.numpy:
+                    continue
+                mixer = audio_mixer.Mixer(codec.frame, use_numpy)
+                mix = time_mixer(mixer, frames, talking, args.repeat)
+                print(f"  {label:<12} mix {name:<6} {mix * 1e6:8.1f} us/frame  budget {mix / frame_s:6.1%}  "
+                      f"rooms {frame_s / mix:7.0f}")
+            room, sent = time_room(codec, frames, talking, max(args.repeat // 10, 10))
+            pairwise = talking * (n - 1) * (sent / n)
+            print(f"  {label:<12} room {'':<5} {room * 1e6:8.1f} us/frame  budget {room / frame_s:6.1%}  "
+                  f"rooms {frame_s / room:7.0f}  sends {n} packets ({sent * 8 / frame_s / 1000:.0f} kbit/s), "
+                  f"forwarding would send {talking * (n - 1)} ({pairwise * 8 / frame_s / 1000:.0f} kbit/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+# bench_parallel_upload.py
+# End-to-end loopback throughput of one large file, sender -> server -> recipient:
+# a single checksummed stream (FILE_RESUME) versus parallel uploads (FILE_PARALLEL)
+# over 1, 2, 4 and 8 data connections.
+#
+#   python3 bench_parallel_upload.py --file-mb 512 --mode threaded
+#
+# The server runs as a subprocess (connection_manager.py, so it has its own GIL);
+# the sender and a recipient that reads and discards every frame run here. The
+# time is taken until the recipient has the last byte. Needs server.crt/server.key.
+# In async mode the server handles every connection on one thread, so only the
+# sender side can gain from more streams.
+import argparse
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import file_upload
+import frame_codec
+from frame_codec import FrameDecoder
+
+
+def connect(port, name, options=None):
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    sock = ctx.wrap_socket(socket.create_connection(("127.0.0.1", port)), server_hostname="localhost")
+    sock.sendall(frame_codec.client_hello(name, options))
+    return sock
+
+
+class Receiver(threading.Thread):
+    """Counts the file bytes arriving in FILE_DATA frames; `done` is set once `size` have arrived."""
+
+    def __init__(self, sock):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.size = None
+        self.received = 0
+        self.done = threading.Event()
+
+    def expect(self, size):
+        self.size = size
+        self.received = 0
+        self.done.clear()
+
+    def run(self):
+        decoder = FrameDecoder(copy=False)
+        while decoder.recv_into(self.sock):
+            for frame in decoder.frames():
+                if frame.type != frame_codec.FILE_DATA:
+                    continue
+                n = len(frame.payload)
+                if frame.flags & frame_codec.FLAG_OFFSET:
+                    n -= frame_codec.OFFSET.size
+                self.received += n
+                if self.received >= self.size:
+                    self.done.set()
+
+
+class Sender(threading.Thread):
+    """The sender's chat connection: sends the file headers, reads FILE_ACKs."""
+
+    def __init__(self, sock):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.acks = {}
+        self.cond = threading.Condition()
+
+    def run(self):
+        decoder = FrameDecoder()
+        while decoder.recv_into(self.sock):
+            for frame in decoder.frames():
+                if frame.type == frame_codec.FILE_ACK:
+                    transfer_id, offset, _ = frame_codec.parse_file_ack(frame.payload)
+                    with self.cond:
+                        self.acks[transfer_id] = offset
+                        self.cond.notify_all()
+
+    def request(self, ftype, recipient, size, chunk_size):
+        transfer_id = uuid.uuid4().hex
+        # FILE_RESUME also carries the upload's key
+        prefix = f"{transfer_id} benchkey" if ftype == frame_codec.FILE_RESUME else transfer_id
+        meta = f"{prefix} {recipient} {size} {chunk_size} bench.bin".encode('utf-8')
+        self.sock.sendall(frame_codec.encode_frame(ftype, meta, 1))
+        with self.cond:
+            if not self.cond.wait_for(lambda: transfer_id in self.acks, 10):
+                raise TimeoutError("server did not accept the upload")
+        return transfer_id
+
+
+def run(label, receiver, size, send, baseline=None):
+    receiver.expect(size)
+    start = time.perf_counter()
+    send()
+    if not receiver.done.wait(300):
+        raise TimeoutError(f"{label}: recipient got {receiver.received} of {size} bytes")
+    elapsed = time.perf_counter() - start
+    rate = size / (1 << 20) / elapsed
+    speedup = f"  x{rate / baseline:.2f}" if baseline else ""
+    print(f"  {label:<32} {elapsed:7.2f} s  {rate:8.1f} MB/s{speedup}")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file-mb", type=int, default=512)
+    parser.add_argument("--chunk-kb", type=int, default=256)
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--mode", choices=["threaded", "async"], default="threaded")
+    parser.add_argument("--port", type=int, default=5599)
+    args = parser.parse_args()
+
+    size = args.file_mb << 20
+    chunk_size = args.chunk_kb * 1024
+    here = os.path.dirname(os.path.abspath(__file__))
+    # the server runs in a scratch directory, so its log and file cache don't end up in the source tree
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ("server.crt", "server.key"):
+            shutil.copy(os.path.join(here, name), directory)
+        path = os.path.join(directory, "bench.bin")
+        with open(path, 'wb') as f:
+            block = os.urandom(1 << 20)
+            for _ in range(args.file_mb):
+                f.write(block)
+
+        server = subprocess.Popen([sys.executable, os.path.join(here, "connection_manager.py"), "--port", str(args.port),
+                                   "--mode", args.mode, "--file-window-kb", "4096"],
+                                  cwd=directory, stdout=subprocess.DEVNULL)
+        try:
+            time.sleep(1.0)
+            receiver = Receiver(connect(args.port, "bench_rx"))
+            sender = Sender(connect(args.port, "bench_tx"))
+            receiver.start()
+            sender.start()
+            time.sleep(0.3)
+
+            print(f"{args.file_mb} MB over loopback TLS, {args.chunk_kb} KiB chunks, {args.mode} server, "
+                  f"{os.cpu_count()} CPUs (streams can only help with several)")
+
+            def single():
+                sender.request(frame_codec.FILE_RESUME, "bench_rx", size, chunk_size)
+                with open(path, 'rb') as f:
+                    file_upload.upload(sender.sock, f, size, 1, threading.Lock(), chunk_size, checksum=True)
+
+            baseline = run("single stream (FILE_RESUME)", receiver, size, single)
+
+            for streams in args.streams:
+                socks = []
+
+                def parallel(streams=streams):
+                    transfer_id = sender.request(frame_codec.FILE_PARALLEL, "bench_rx", size, chunk_size)
+                    socks.extend(file_upload.upload_ranges(
+                        lambda: connect(args.port, "bench_tx", {"transfer": transfer_id}), path, size, chunk_size, streams))
+
+                run(f"parallel, {streams} stream{'s' if streams > 1 else ''}", receiver, size, parallel, baseline)
+                for sock in socks:
+                    sock.close()
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# bench_receive_buffer.py
+# Receive-side parsing cost: the old bytes buffering (buffer += chunk, split per
+# line, data += chunk for files) versus receive_buffer.ReceiveBuffer.
+#
+#   python3 bench_receive_buffer.py --file-mb 100 --lines 100000
+#
+# No sockets are involved: a replay socket hands out pre-built data in recv-sized
+# pieces, so the numbers are the parsing/copying cost only. The old file path is
+# quadratic, so it is timed on --legacy-file-mb and extrapolated to --file-mb.
+import argparse
+import time
+from receive_buffer import ReceiveBuffer
+
+
+class ReplaySocket:
+    """Plays back data in pieces of at most `chunk` bytes (like a kernel socket buffer)."""
+
+    def __init__(self, data, chunk):
+        self.view = memoryview(data)
+        self.pos = 0
+        self.chunk = chunk
+
+    def recv(self, n):
+        data = bytes(self.view[self.pos:self.pos + min(n, self.chunk)])
+        self.pos += len(data)
+        return data
+
+    def recv_into(self, buf, nbytes=0):
+        n = min(nbytes or len(buf), len(buf), self.chunk, len(self.view) - self.pos)
+        buf[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+# ---------- old code paths ----------
+
+def legacy_lines(sock, count):
+    buffer = b""
+    seen = 0
+    while seen < count:
+        buffer += sock.recv(65536)
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            line.decode('utf-8').strip()
+            seen += 1
+
+
+def legacy_file(sock, size):
+    data = b""
+    remaining = size
+    while remaining > 0:
+        chunk = sock.recv(min(4096, remaining))
+        data += chunk
+        remaining -= len(chunk)
+    return data
+
+
+# ---------- ReceiveBuffer ----------
+
+def buffered_lines(sock, count):
+    rbuf = ReceiveBuffer()
+    seen = 0
+    while seen < count:
+        rbuf.recv_into(sock)
+        while True:
+            line = rbuf.readline()
+            if line is None:
+                break
+            str(line, 'utf-8').strip()
+            seen += 1
+
+
+# what MessageHandler does for a legacy /file: bytes after the header go into
+# one buffer of the announced size, straight from the socket
+def buffered_file(sock, size):
+    rbuf = ReceiveBuffer()
+    rbuf.recv_into(sock)
+    target = bytearray(size)
+    filled = rbuf.read_into(target)
+    view = memoryview(target)
+    while filled < size:
+        filled += sock.recv_into(view[filled:])
+    return target
+
+
+def timed(fn, data, chunk, arg):
+    sock = ReplaySocket(data, chunk)
+    start = time.perf_counter()
+    fn(sock, arg)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file-mb", type=int, default=100)
+    parser.add_argument("--legacy-file-mb", type=int, default=8)
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--line-bytes", type=int, default=40)
+    parser.add_argument("--recv-bytes", type=int, default=65536,
+                        help="bytes per recv (asyncio hands over up to 256 KiB at once)")
+    args = parser.parse_args()
+
+    # ---------- 100k small lines arriving in one burst ----------
+    line = b"m" * (args.line_bytes - 1) + b"\n"
+    burst = line * args.lines
+    print(f"{args.lines:,} lines of {args.line_bytes} bytes in one burst, {args.recv_bytes:,}-byte reads")
+    old = timed(legacy_lines, burst, args.recv_bytes, args.lines)
+    new = timed(buffered_lines, burst, args.recv_bytes, args.lines)
+    print(f"  {'bytes += / split':<28} {old * 1e3:10.1f} ms")
+    print(f"  {'ReceiveBuffer.readline':<28} {new * 1e3:10.1f} ms")
+    print(f"  -> {old / new:.1f}x faster\n")
+
+    # ---------- one large file ----------
+    size = args.file_mb << 20
+    payload = bytes(size)
+    print(f"{args.file_mb} MB file")
+    new = timed(buffered_file, payload, args.recv_bytes, size)
+    legacy_size = args.legacy_file_mb << 20
+    old_small = timed(legacy_file, payload[:legacy_size], args.recv_bytes, legacy_size)
+    old = old_small * (size / legacy_size) ** 2
+    print(f"  {'data += chunk':<28} {old_small * 1e3:10.1f} ms for {args.legacy_file_mb} MB"
+          f" (~{old:.1f} s extrapolated to {args.file_mb} MB, quadratic)")
+    print(f"  {'recv_into file buffer':<28} {new * 1e3:10.1f} ms ({args.file_mb / new:,.0f} MB/s)")
+    print(f"  -> ~{old / new:,.0f}x faster at {args.file_mb} MB")
+
+
+if __name__ == "__main__":
+    main()
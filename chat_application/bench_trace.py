@@ -0,0 +1,151 @@
+# bench_trace.py
+# Where the time of a chat message goes, hop by hop (tracing.py), in a busy room.
+#
+#   python3 bench_trace.py --clients 50 --messages 2000 --mode threaded --display-ms 0.2
+#
+# The server runs as a subprocess (connection_manager.py --trace-file) with
+# --clients framed clients that offer tracing. Each client sends its share of
+# --messages traced chat lines (so every line is broadcast to everyone else) and,
+# like the GUI, answers every traced line it receives with a TRACE report after
+# "displaying" it: --display-ms of busy work stands in for Tk. The per-hop
+# percentiles are then read back from the trace file the server wrote, which can
+# also be opened in chrome://tracing or ui.perfetto.dev (--keep).
+# Needs server.crt/server.key.
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import frame_codec
+import tracing
+from frame_codec import FrameDecoder
+
+
+def connect(port, name):
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    sock = ctx.wrap_socket(socket.create_connection(("127.0.0.1", port)), server_hostname="localhost")
+    sock.sendall(frame_codec.client_hello(name, tracing.offer()))
+    return sock
+
+
+class Client(threading.Thread):
+    """A chat client that reports every traced line it gets, like client_handler.py."""
+
+    def __init__(self, sock, display):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.display = display
+        self.send_lock = threading.Lock()
+        self.accepted = threading.Event()
+        self.received = 0
+
+    def send(self, text):
+        started = time.perf_counter()
+        with self.send_lock:
+            payload = tracing.encode_sent(tracing.new_trace_id(), started) + text.encode('utf-8')
+            self.sock.sendall(frame_codec.encode_frame(frame_codec.TEXT, payload, flags=frame_codec.FLAG_TRACE))
+
+    def run(self):
+        decoder = FrameDecoder()
+        try:
+            while decoder.recv_into(self.sock):
+                for frame in decoder.frames():
+                    if frame.type == frame_codec.HELLO:
+                        if tracing.accepted(frame_codec.parse_hello_payload(frame.payload)[1]):
+                            self.accepted.set()
+                    elif frame.type == frame_codec.TEXT and frame.flags & frame_codec.FLAG_TRACE:
+                        received, start = time.time(), time.perf_counter()
+                        trace_id = frame_codec.TRACE_ID.unpack_from(frame.payload)[0]
+                        while time.perf_counter() - start < self.display:
+                            pass
+                        report = tracing.encode_report(trace_id, received, time.perf_counter() - start)
+                        with self.send_lock:
+                            self.sock.sendall(frame_codec.encode_frame(frame_codec.TRACE, report))
+                        self.received += 1
+        except OSError:
+            pass
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=1000, help="in total, spread over the clients")
+    parser.add_argument("--rate", type=float, default=200, help="messages per second, all clients together")
+    parser.add_argument("--display-ms", type=float, default=0.2, help="time a client takes to display a line")
+    parser.add_argument("--mode", choices=["threaded", "async"], default="threaded")
+    parser.add_argument("--port", type=int, default=5700)
+    parser.add_argument("--keep", default=None, metavar="PATH", help="copy the trace file here")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as directory:
+        trace_path = os.path.join(directory, "trace.json")
+        for name in ("server.crt", "server.key"):
+            shutil.copy(os.path.join(here, name), directory)
+        server = subprocess.Popen([sys.executable, os.path.join(here, "connection_manager.py"),
+                                   "--port", str(args.port), "--mode", args.mode, "--media-port", "0",
+                                   "--log-level", "warning", "--trace-file", trace_path],
+                                  cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            time.sleep(1.0)
+            clients = [Client(connect(args.port, f"user{i}"), args.display_ms / 1000) for i in range(args.clients)]
+            for client in clients:
+                client.start()
+            if not all(client.accepted.wait(5) for client in clients):
+                print("the server did not accept tracing")
+                return
+            rng = random.Random(1)
+            start = time.perf_counter()
+            for i in range(args.messages):
+                delay = start + i / args.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                rng.choice(clients).send(f"message {i} in the busy room")
+            expected = args.messages * (args.clients - 1)
+            deadline = time.time() + 30
+            while sum(client.received for client in clients) < expected and time.time() < deadline:
+                time.sleep(0.1)
+            time.sleep(0.5)         # the last reports
+        finally:
+            server.send_signal(signal.SIGINT)       # stop() closes the trace file
+            server.wait()
+
+        # one span per hop and delivery (trace id, recipient)
+        deliveries = {}
+        with open(trace_path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip().rstrip(",")
+                if line.startswith("{"):
+                    event = json.loads(line)
+                    if event["ph"] == "X":
+                        key = (event["args"]["trace"], event["args"]["to"])
+                        deliveries.setdefault(key, {})[event["name"]] = event["dur"] / 1000
+        print(f"{args.mode}: {args.clients} clients, {args.messages} messages at {args.rate:.0f}/s, "
+              f"{len(deliveries)} of {expected} deliveries traced")
+        for hop in tracing.HOPS:
+            if hop == "total":
+                values = sorted(sum(spans.values()) for spans in deliveries.values())
+            else:
+                values = sorted(spans[hop] for spans in deliveries.values() if hop in spans)
+            print(f"  {hop:<15} p50 {percentile(values, 0.5):8.3f} ms   p99 {percentile(values, 0.99):8.3f} ms   "
+                  f"max {values[-1] if values else 0:8.3f} ms")
+        if args.keep:
+            shutil.copy(trace_path, args.keep)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# bench_upload.py
+# Loopback upload throughput: the old send_file loop (4 KiB read + sendall per
+# chunk) versus the file_upload engine (readinto with large buffers over TLS,
+# sendfile where the kernel can do the encryption/copy).
+#
+#   python3 bench_upload.py --file-mb 256
+#
+# A local receiver thread reads and discards everything, so the numbers are the
+# sender's cost plus loopback TCP (and TLS where used); "sender CPU" is the
+# uploading thread alone (user + kernel). Needs server.crt/server.key.
+import argparse
+import os
+import socket
+import ssl
+import tempfile
+import threading
+import time
+import file_upload
+
+
+def receiver(listener, tls_context, done):
+    conn, _ = listener.accept()
+    if tls_context:
+        conn = tls_context.wrap_socket(conn, server_side=True)
+    buf = bytearray(1 << 20)
+    total = 0
+    while True:
+        n = conn.recv_into(buf)
+        if not n:
+            break
+        total += n
+    done.append(total)
+    conn.close()
+
+
+def connect(tls):
+    listener = socket.create_server(("127.0.0.1", 0))
+    server_ctx = client_ctx = None
+    if tls:
+        server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_ctx.load_cert_chain(certfile="server.crt", keyfile="server.key")
+        client_ctx = ssl.create_default_context()
+        client_ctx.check_hostname = False
+        client_ctx.verify_mode = ssl.CERT_NONE
+    done = []
+    thread = threading.Thread(target=receiver, args=(listener, server_ctx, done), daemon=True)
+    thread.start()
+    sock = socket.create_connection(listener.getsockname())
+    if tls:
+        sock = client_ctx.wrap_socket(sock, server_hostname="localhost")
+    return sock, thread, listener
+
+
+# the pre-engine send_file loop
+def legacy_send(sock, f, size, chunk_size=4096):
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        sock.sendall(chunk)
+
+
+def run(label, path, size, tls, send):
+    sock, thread, listener = connect(tls)
+    with open(path, 'rb') as f:
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        send(sock, f, size)
+        cpu = time.thread_time() - cpu_start
+        # plain EOF (no close_notify): the receiver treats it as end of data
+        sock.shutdown(socket.SHUT_WR)
+        thread.join()
+        elapsed = time.perf_counter() - start
+    sock.close()
+    listener.close()
+    print(f"  {label:<34} {elapsed:7.2f} s  {size / (1 << 20) / elapsed:8.1f} MB/s"
+          f"  sender CPU {cpu:5.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file-mb", type=int, default=256)
+    parser.add_argument("--chunk-kb", type=int, nargs="+", default=[64, 256, 1024])
+    args = parser.parse_args()
+
+    size = args.file_mb << 20
+    with tempfile.NamedTemporaryFile(delete=False) as tmp:
+        block = os.urandom(1 << 20)
+        for _ in range(args.file_mb):
+            tmp.write(block)
+        path = tmp.name
+
+    lock = threading.Lock()
+    try:
+        print(f"{args.file_mb} MB upload over loopback TLS")
+        run("old loop (4 KiB read + sendall)", path, size, True, legacy_send)
+        for kb in args.chunk_kb:
+            run(f"readinto, {kb} KiB chunks", path, size, True,
+                lambda s, f, n, kb=kb: file_upload.upload(s, f, n, 1, lock, kb * 1024, use_sendfile=False))
+
+        print(f"\n{args.file_mb} MB upload over loopback plain TCP (kernel-side path, as with kTLS)")
+        run("readinto, 256 KiB chunks", path, size, False,
+            lambda s, f, n: file_upload.upload(s, f, n, 1, lock, 256 * 1024, use_sendfile=False))
+        if hasattr(os, "sendfile"):
+            run("sendfile, 256 KiB frames", path, size, False,
+                lambda s, f, n: file_upload.upload(s, f, n, 1, lock, 256 * 1024, use_sendfile=True))
+            # what a client's (resumable) upload takes: every chunk hashed, its body still sent by the kernel
+            run("sendfile + chunk sha256", path, size, False,
+                lambda s, f, n: file_upload.upload(s, f, n, 1, lock, 256 * 1024, use_sendfile=True,
+                                                   checksum=True))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
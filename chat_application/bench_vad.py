@@ -0,0 +1,119 @@
+# bench_vad.py
+# Silence suppression (voice_activity.py) on one side of a conversation: how
+# much of the stream stays off the wire, how much speech it cuts, and what the
+# detector costs per frame.
+#
+#   python3 bench_vad.py --seconds 60 --codec adpcm
+#
+# The input alternates talkspurts of voice-like audio (bench_codecs.voice, with
+# the short dips between words speech has) and pauses, exponentially distributed
+# around --talk and --pause seconds (about the on/off pattern of one side of a
+# conversation), over background noise:
+#   quiet  - a quiet room
+#   office - steady background noise
+#   fan    - a quiet room until a fan comes on half-way through
+# Every frame is labelled speech or pause by how it was generated.
+#   sent      - frames sent, of all frames
+#   clipped   - speech frames that were suppressed (cut syllables)
+#   pauses    - pause frames that were sent anyway (mostly the hangover)
+#   packets/s - what the relay forwards for this side, comfort noise included
+#   wire      - kbit/s on the network (UDP/IPv4 + media header + tag + payload)
+import argparse
+import array
+import random
+import time
+import audio_codec
+import media
+import voice_activity
+from bench_codecs import IP_UDP_HEADERS, voice
+
+# background noise in dBov before and after half-way
+PROFILES = {
+    "quiet": (-65, -65),
+    "office": (-50, -50),
+    "fan": (-65, -42),
+}
+
+WORD = (0.25, 0.6)              # seconds from one dip between words to the next
+DIP = (0.04, 0.12)              # seconds a dip lasts
+DIP_GAIN = 0.03                 # level during a dip (about -30 dB)
+
+
+# (pcm, labels): labels[i] is True if frame i is speech
+def conversation(codec, seconds, talk, pause, noise, seed):
+    rng = random.Random(seed)
+    frame = codec.frame
+    n_frames = int(seconds * codec.rate / frame)
+    labels = []
+    talking = False
+    while len(labels) < n_frames:
+        length = max(1, int(rng.expovariate(1 / (talk if talking else pause)) * codec.rate / frame))
+        labels.extend([talking] * length)
+        talking = not talking
+    labels = labels[:n_frames]
+
+    speech = voice(codec.rate, seconds, seed)
+    out = array.array("h")
+    word_left = 0                   # samples until the next dip between words
+    for i, is_speech in enumerate(labels):
+        level = noise[0] if i < n_frames // 2 else noise[1]
+        rms = 32768 * 10 ** (level / 20)
+        chunk = array.array("h")
+        chunk.frombytes(speech[i * frame * 2:(i + 1) * frame * 2])
+        for s in chunk:
+            if word_left <= 0:
+                word_left = int(rng.uniform(WORD[0], WORD[1]) * codec.rate)
+                dip = int(rng.uniform(DIP[0], DIP[1]) * codec.rate)
+            word_left -= 1
+            gain = DIP_GAIN if word_left < dip else 1.0
+            out.append(max(-32768, min(32767, int((s * gain if is_speech else 0) + rng.gauss(0, rms)))))
+    return out.tobytes(), labels
+
+
+def run(name, codec, pcm, labels):
+    frame_bytes = codec.frame * 2
+    frames = [pcm[i * frame_bytes:(i + 1) * frame_bytes] for i in range(len(labels))]
+    vad = voice_activity.VoiceActivityDetector(codec.rate, codec.frame)
+    start = time.process_time()
+    decisions = [vad.update(f) for f in frames]
+    cpu = (time.process_time() - start) / len(frames)
+
+    speech = sum(labels)
+    pauses = len(labels) - speech
+    sent = [d == voice_activity.SEND for d in decisions]
+    clipped = sum(1 for s, l in zip(sent, labels) if l and not s)
+    noise_sent = sum(1 for s, l in zip(sent, labels) if s and not l)
+    seconds = len(labels) * codec.frame / codec.rate
+
+    encoder = codec.encoder()
+    payload = sum(len(encoder.encode(f)) for f in frames[:50]) / 50
+    overhead = IP_UDP_HEADERS + media.HEADER.size + media.TAG_SIZE
+    before = len(frames) * (payload + overhead)
+    after = sum(sent) * (payload + overhead) + vad.comfort_sent * (1 + overhead)
+    packets = sum(sent) + vad.comfort_sent
+    print(f"  {name:<7} sent {sum(sent) / len(frames):6.1%}  clipped {clipped / max(speech, 1):5.1%}  "
+          f"pauses {noise_sent / max(pauses, 1):5.1%}  packets/s {len(frames) / seconds:5.1f} -> "
+          f"{packets / seconds:5.1f}  wire {before * 8 / seconds / 1000:6.1f} -> {after * 8 / seconds / 1000:6.1f} kbit/s"
+          f"  vad {cpu * 1e6:5.1f} us/frame")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--talk", type=float, default=1.2, help="mean talkspurt (s)")
+    parser.add_argument("--pause", type=float, default=1.8, help="mean pause (s)")
+    parser.add_argument("--codec", default="adpcm", choices=sorted(audio_codec.BY_NAME))
+    parser.add_argument("--profile", choices=sorted(PROFILES), action="append")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    codec = audio_codec.BY_NAME[args.codec]
+
+    print(f"{codec.name}, {args.seconds:.0f} s, talkspurts {args.talk} s / pauses {args.pause} s "
+          f"(numpy {'available' if voice_activity.numpy else 'not installed'})")
+    for name in args.profile or PROFILES:
+        pcm, labels = conversation(codec, args.seconds, args.talk, args.pause, PROFILES[name], args.seed)
+        run(name, codec, pcm, labels)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# call_manager.py
+import itertools
+import threading
+import time
+
+REQUEST_TTL = 60.0      # seconds a callee has to accept a /call_request
+
+
+class CallSession:
+    """One call: two participants, or a conference room people join and leave."""
+
+    def __init__(self, call_id, participants, codec="pcm", room=None):
+        self.id = call_id
+        self.participants = list(participants)
+        self.codec = codec          # audio_codec name the call uses
+        self.room = room            # conference room name; None for a two-party call
+        self.media = None           # MediaCall on the UDP media relay, None: audio over the chat connections
+        self.entries = {}           # username -> ClientEntry, for two-party calls relayed over TCP
+        self.started = time.time()
+        self.ended = None
+        self.joined = len(self.participants)    # participants over the call's life
+        # audio bytes each participant sent (TCP relay, and UDP legs that left); only that
+        # participant's own handler adds to its counter, so they need no lock
+        self.bytes_from = dict.fromkeys(self.participants, 0)
+
+    # the other participant of a two-party call
+    def partner(self, username):
+        for name in self.participants:
+            if name != username:
+                return name
+        return None
+
+    def count(self, username, nbytes):
+        self.bytes_from[username] = self.bytes_from.get(username, 0) + nbytes
+
+    def duration(self):
+        return (self.ended or time.time()) - self.started
+
+    # audio the server took in for this call, chat connections and media relay together
+    def bytes_total(self):
+        total = sum(self.bytes_from.values())
+        media = self.media
+        if media is not None:
+            total += sum(leg.bytes_in for leg in list(media.legs))
+        return total
+
+    def bitrate(self):
+        seconds = self.duration()
+        return self.bytes_total() * 8 / seconds if seconds > 0 else 0.0
+
+    def stats(self):
+        return {
+            "id": self.id,
+            "room": self.room,
+            "participants": list(self.participants),
+            "codec": self.codec,
+            "transport": "udp" if self.media is not None else "tcp",
+            "duration": round(self.duration(), 1),
+            "bytes": self.bytes_total(),
+            "bitrate": round(self.bitrate()),
+        }
+
+    def summary(self):
+        who = f"conference {self.room} ({self.joined} joined)" if self.room else " <-> ".join(self.participants)
+        return (f"#{self.id} {who}, {self.codec} over {'udp' if self.media is not None else 'tcp'}, "
+                f"{self.duration():.1f}s, {self.bytes_total()} bytes, {self.bitrate() / 1000:.1f} kbit/s")
+
+
+class CallManager:
+    """
+    Every call on the server, by id, by participant and by conference room.
+
+    Lookups (session_for, partner_of: once per relayed audio chunk) are single
+    dict reads and take no lock. Every change of who is in which call happens
+    under `lock` in one step, and hands back the sessions it ended or left: only
+    the thread that made the change gets them, so only it tells the others.
+
+    A two-party call only starts from a request (request()) the callee answers:
+    start() takes the pending request away, so nobody can put a user in a call
+    they weren't asked into, and a request is accepted once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._by_id = {}
+        self._by_user = {}          # username -> CallSession
+        self._by_room = {}          # conference room -> CallSession
+        self._requests = {}         # (caller, callee) -> deadline (time.monotonic()), ringing calls
+        self._ids = itertools.count(1)
+
+        # finished calls, for the metrics
+        self.calls_ended = 0
+        self.seconds_ended = 0.0
+        self.bytes_ended = 0
+
+    # ---------- lookups ----------
+
+    def session_for(self, username):
+        return self._by_user.get(username)
+
+    # the other side of username's two-party call (None if not in one)
+    def partner_of(self, username):
+        session = self._by_user.get(username)
+        if session is None or session.room is not None:
+            return None
+        return session.partner(username)
+
+    def room(self, name):
+        return self._by_room.get(name)
+
+    def sessions(self):
+        with self.lock:
+            return list(self._by_id.values())
+
+    def __contains__(self, username):
+        return username in self._by_user
+
+    def __len__(self):
+        return len(self._by_id)
+
+    # ---------- transitions ----------
+
+    # caller asked callee for a call (forwarded to callee); it rings until accepted, rejected or REQUEST_TTL
+    def request(self, caller, callee):
+        now = time.monotonic()
+        with self.lock:
+            # expire requests nobody answered
+            for key in [key for key, deadline in self._requests.items() if deadline <= now]:
+                del self._requests[key]
+            self._requests[(caller, callee)] = now + REQUEST_TTL
+
+    # take back caller's request to callee (rejected); True if there was one
+    def cancel_request(self, caller, callee):
+        with self.lock:
+            return self._pop_request(caller, callee)
+
+    # requests to and from username are void (disconnected)
+    def forget(self, username):
+        with self.lock:
+            for key in [key for key in self._requests if username in key]:
+                del self._requests[key]
+
+    def _pop_request(self, caller, callee):
+        deadline = self._requests.pop((caller, callee), None)
+        return deadline is not None and deadline > time.monotonic()
+
+    # callee accepted caller's request: a two-party call between them. Calls either was in end first.
+    # Returns (session, [(session, username, ended)] for what they left), or (None, [])
+    # if caller has no request ringing at callee.
+    def start(self, caller, callee, codec="pcm", entries=None):
+        with self.lock:
+            if not self._pop_request(caller, callee):
+                return None, []
+            left = [r for r in (self._leave(caller), self._leave(callee)) if r]
+            session = CallSession(next(self._ids), (caller, callee), codec)
+            session.entries = dict(entries or {})
+            self._by_id[session.id] = session
+            self._by_user[caller] = session
+            self._by_user[callee] = session
+        return session, left
+
+    # username into conference room (opened in codec if it doesn't exist; open_room(session)
+    # then sets it up before anyone else can join). The call username was in ends first.
+    # Returns (session, created, [(session, username, ended)]).
+    def join(self, room, username, codec="pcm", open_room=None):
+        with self.lock:
+            left = [r for r in (self._leave(username),) if r]
+            session = self._by_room.get(room)
+            created = session is None
+            if created:
+                session = CallSession(next(self._ids), (), codec, room)
+                if open_room:
+                    open_room(session)
+                self._by_id[session.id] = session
+                self._by_room[room] = session
+            session.participants.append(username)
+            session.joined += 1
+            session.bytes_from.setdefault(username, 0)
+            self._by_user[username] = session
+        return session, created, left
+
+    # username leaves their call: a two-party call ends for both, a conference ends
+    # with its last participant. Returns (session, username, ended), or None.
+    def leave(self, username):
+        with self.lock:
+            return self._leave(username)
+
+    def _leave(self, username):
+        session = self._by_user.pop(username, None)
+        if session is None:
+            return None
+        if session.room is None:
+            for name in session.participants:
+                if self._by_user.get(name) is session:
+                    del self._by_user[name]
+            ended = True
+        else:
+            session.participants.remove(username)
+            ended = not session.participants
+            if ended and self._by_room.get(session.room) is session:
+                del self._by_room[session.room]
+        if ended:
+            session.ended = time.time()
+            self._by_id.pop(session.id, None)
+            self.calls_ended += 1
+            self.seconds_ended += session.duration()
+            self.bytes_ended += session.bytes_total()
+        return session, username, ended
+
+    # ---------- metrics ----------
+
+    def stats(self):
+        sessions = self.sessions()
+        return {
+            "active": len(sessions),
+            "in_calls": sum(len(s.participants) for s in sessions),
+            "conferences": sum(1 for s in sessions if s.room is not None),
+            "bitrate": round(sum(s.bitrate() for s in sessions)),
+            "ended": self.calls_ended,
+            "ended_seconds": round(self.seconds_ended, 1),
+            "ended_bytes": self.bytes_ended,
+            "calls": [s.stats() for s in sessions],
+        }
+
+    def summary(self):
+        sessions = self.sessions()
+        parts = [f"[SYSTEM] Calls: {len(sessions)} active, {self.calls_ended} ended "
+                 f"({self.seconds_ended / 60:.1f} min)"]
+        parts.extend(s.summary() for s in sessions)
+        return " | ".join(parts)
@@ -1,15 +1,21 @@
 # chat_gui.py
 import socket
 import ssl
+import time
 import tkinter as tk
 from tkinter import simpledialog, scrolledtext, messagebox, filedialog
 from client_handler import MessageHandler
+import compression
+import media
+import tracing
+import frame_codec
 from datetime import datetime
 import os
 
 
 class ChatGUI:
-    def __init__(self, host='127.0.0.1', port=5557):
+    # trace: share of our chat lines sent with a trace id, if the server accepts tracing (see tracing.py)
+    def __init__(self, host='127.0.0.1', port=5557, trace=0.0):
         # ---------- Username ----------
         root = tk.Tk()
         root.withdraw()
@@ -39,6 +45,11 @@ class ChatGUI:
         self.chat_display.tag_config("private", foreground="#6a1b9a")
         self.chat_display.tag_config("file", foreground="#bf360c")
 
+        # ---------- Download Progress ----------
+        self.progress_label = tk.Label(self.window, text="", anchor="w", bg="#e3f2e1",
+                                       fg="#bf360c", font=("Segoe UI", 11))
+        self.progress_label.pack(fill=tk.X, padx=20)
+
         # ---------- Entry + Send ----------
         entry_frame = tk.Frame(self.window, bg="#e3f2e1")
         entry_frame.pack(fill=tk.X, padx=20, pady=(5, 10))
@@ -86,6 +97,13 @@ class ChatGUI:
         )
         self.btn_call.pack(side=tk.LEFT, padx=6)
 
+        self.btn_conference = tk.Button(
+            btn_frame, text="👥 Conference", command=self.join_conference,
+            bg="#1976d2", fg="white", font=("Segoe UI", 12, "bold"),
+            relief="flat", width=16, height=2
+        )
+        self.btn_conference.pack(side=tk.LEFT, padx=6)
+
         self.btn_end_call = tk.Button(
             btn_frame, text="📴 End Call", command=self.end_call,
             bg="#d32f2f", fg="white", font=("Segoe UI", 12, "bold"),
@@ -110,7 +128,8 @@ class ChatGUI:
             self.client_socket = context.wrap_socket(raw_sock, server_hostname=host)
 
             self.client_socket.connect((host, port))
-            self.client_socket.send(self.username.encode('utf-8'))
+            offer = {**compression.offer(), **media.offer(), **(tracing.offer() if trace > 0 else {})}
+            self.client_socket.sendall(frame_codec.client_hello(self.username, offer))
 
         except Exception as e:
             messagebox.showerror("Connection Error", f"Could not connect to server:\n{e}")
@@ -122,13 +141,19 @@ class ChatGUI:
             self.client_socket,
             gui_callback=self.display_message,
             window=self.window,
-            file_save_dir="received_files"
+            file_save_dir="received_files",
+            username=self.username,
+            progress_callback=self.show_progress,
+            trace_share=trace
         )
 
         self.window.protocol("WM_DELETE_WINDOW", self.on_close)
 
         self.display_message(f"[SYSTEM] Connected securely to {host}:{port} as {self.username}", tag="system")
 
+        # uploads a previous connection lost continue where the server got them
+        self.handler.resume_uploads()
+
     # ---------- Display Messages ----------
     def display_message(self, message, tag="other"):
         self.chat_display.configure(state='normal')
@@ -147,12 +172,21 @@ class ChatGUI:
         self.chat_display.configure(state='disabled')
         self.chat_display.yview(tk.END)
 
+    # ---------- Download Progress (called from the receiver thread) ----------
+    def show_progress(self, filename, received, total):
+        if received >= total:
+            text = ""
+        else:
+            text = f"⬇ {filename}: {received * 100 // max(total, 1)}% ({received:,} / {total:,} bytes)"
+        self.window.after(0, lambda: self.progress_label.config(text=text))
+
     # ---------- Send Normal Message ----------
     def send_message(self):
+        started = time.perf_counter()
         msg = self.msg_entry.get().strip()
         if not msg:
             return
-        self.handler.send_text_message(msg)
+        self.handler.send_text_message(msg, started)
         self.display_message(f"[You]: {msg}", tag="self")
         self.msg_entry.delete(0, tk.END)
 
@@ -178,9 +212,16 @@ class ChatGUI:
             return
 
         try:
-            self.handler.send_file(recipient, file_path)
+            result = self.handler.send_file(recipient, file_path)
             fname = os.path.basename(file_path)
-            self.display_message(f"[You → {recipient}] Sent file: {fname}", tag="file")
+            if result.method == "cache":
+                # the server already had this exact file: nothing was uploaded
+                self.display_message(f"[You → {recipient}] Sent file: {fname} (already on the server, "
+                                     f"nothing uploaded)", tag="file")
+                return
+            self.display_message(f"[You → {recipient}] Sent file: {fname} "
+                                 f"({result.bytes:,} bytes in {result.seconds:.2f}s, "
+                                 f"{result.mb_per_s:.1f} MB/s via {result.method})", tag="file")
         except Exception as e:
             messagebox.showerror("File Error", f"Failed to send file:\n{e}")
 
@@ -193,9 +234,16 @@ class ChatGUI:
         recipient = simpledialog.askstring("Voice Call", "Enter username to call:")
         if not recipient:
             return
-        self.handler.send_text_message(f"/call_request:{recipient}")
+        self.handler.request_call(recipient)
         self.display_message(f"[SYSTEM] Calling {recipient}...", tag="system")
 
+    def join_conference(self):
+        room = simpledialog.askstring("Conference", "Enter room to join:")
+        if not room:
+            return
+        self.handler.join_conference(room.strip())
+        self.display_message(f"[SYSTEM] Joining conference {room.strip()}...", tag="system")
+
     def end_call(self):
         self.handler.stop_call()
         self.display_message(f"[SYSTEM] Call ended.", tag="system")
@@ -215,5 +263,13 @@ class ChatGUI:
 
 
 if __name__ == "__main__":
-    app = ChatGUI()
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5557)
+    parser.add_argument("--trace", type=float, default=0.0, metavar="SHARE",
+                        help="send SHARE (0-1) of chat lines with a trace id; the server (--trace) records "
+                             "where their time goes")
+    args = parser.parse_args()
+    app = ChatGUI(args.host, args.port, trace=args.trace)
     app.run()
\ No newline at end of file
@@ -1,7 +1,27 @@
 # client_handler.py
+import errno
+import hashlib
+import itertools
+import json
+import socket
+import tempfile
 import threading
+import time
 import os
+import random
+import secrets
+import uuid
 import pyaudio
+import audio_codec
+import compression
+import file_upload
+import frame_codec
+import media
+import tracing
+import voice_activity
+from frame_codec import FrameDecoder
+from jitter_buffer import JitterBuffer
+from voice_channel import VoiceChannel
 from tkinter import messagebox
 
 # -------------------- Audio Settings --------------------
@@ -11,17 +31,110 @@ CHANNELS = 1
 RATE = 44100
 p = pyaudio.PyAudio()
 
+# -------------------- File Receive Settings --------------------
+PROGRESS_STEP = 256 * 1024      # report download progress at most every this many bytes (or 1%)
+
+# -------------------- File Send Settings --------------------
+UPLOAD_JOURNAL = ".pending_uploads.json"   # in the save folder: unfinished uploads, resumed after a reconnect
+RECEIVED_INDEX = ".received_index.json"    # in the save folder: sha256 -> files received, for FILE_HAVE
+ACK_TIMEOUT = 30.0              # seconds the server may go without acknowledging upload progress
+PARALLEL_MIN_SIZE = 64 << 20    # smaller files always go over one stream (upload_streams > 1)
+
+# -------------------- Latency Tracing (see tracing.py) --------------------
+TRACE_SHARE = 1.0               # share of chat lines sent with a trace id once the server accepts tracing
+
+
+class IncomingFile:
+    """A file being received: its bytes go straight into a temp file in the save folder."""
+
+    def __init__(self, save_dir, sender, filename, size, digest=None):
+        self.sender = sender
+        self.digest = digest            # sha256 announced by the server, if any
+        self.hasher = hashlib.sha256() if digest else None
+        # never let the sender pick a path outside the download folder
+        self.filename = os.path.basename(filename) or "file"
+        self.size = size
+        self.received = 0
+        self.reported = 0
+        fd, self.temp_path = tempfile.mkstemp(dir=save_dir, prefix=".incoming-", suffix=".part")
+        self.file = os.fdopen(fd, 'wb')
+        # reserve the space up front: a full disk fails now rather than mid-transfer,
+        # and the ranges of a parallel transfer are written in place
+        if size:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError) as e:
+                if getattr(e, "errno", None) == errno.ENOSPC:
+                    self.discard()
+                    raise
+                os.ftruncate(fd, size)
+
+    def write(self, data):
+        self.file.write(data)
+        if self.hasher:
+            self.hasher.update(data)
+        self.received += len(data)
+
+    # a chunk of a parallel transfer (they arrive out of order)
+    def write_at(self, offset, data):
+        if offset + len(data) > self.size or os.pwrite(self.file.fileno(), data, offset) != len(data):
+            raise OSError(f"bad chunk at byte {offset}")
+        # out of order: the announced digest can't be checked on the way
+        self.hasher = None
+        self.received += len(data)
+
+    # True if the bytes received were checked against the announced digest and match
+    def verified(self):
+        return self.hasher is not None and self.hasher.digest() == self.digest
+
+    # move the complete file to a free name in save_dir (atomic rename); returns its path
+    def commit(self, save_dir):
+        self.file.close()
+        save_path = os.path.join(save_dir, self.filename)
+        base, ext = os.path.splitext(save_path)
+        i = 1
+        while os.path.exists(save_path):
+            save_path = f"{base}_{i}{ext}"
+            i += 1
+        os.replace(self.temp_path, save_path)
+        return save_path
+
+    def discard(self):
+        try:
+            self.file.close()
+            os.remove(self.temp_path)
+        except:
+            pass
+
 
 class MessageHandler:
-    def __init__(self, client_socket, gui_callback=None, window=None, file_save_dir="received_files"):
+    def __init__(self, client_socket, gui_callback=None, window=None, file_save_dir="received_files",
+                 username=None, progress_callback=None, upload_chunk_size=file_upload.UPLOAD_CHUNK,
+                 upload_streams=1, suppress_silence=True, trace_share=TRACE_SHARE):
         self.client_socket = client_socket
+        self.username = username        # updated from the server's HELLO
+        self.send_lock = threading.Lock()
+        self.deflater = None            # set once the server's HELLO accepts compression
+        self.tracing = False            # set once the server's HELLO accepts tracing (the hello must offer it)
+        self.trace_share = trace_share
+        self.inflater = compression.Inflater()
         self.gui_callback = gui_callback
+        self.progress_callback = progress_callback  # (filename, bytes received, size) while downloading
         self.window = window
         self.running = True
 
         # ---- File Handling ----
         self.file_save_dir = file_save_dir
-        self.buffer = b""
+        self.incoming_files = {}        # stream id -> IncomingFile
+        self.stream_ids = itertools.count(1)
+        self.upload_chunk_size = upload_chunk_size
+        self.upload_streams = upload_streams      # > 1: large files go over that many connections at once
+        self.acks = {}                  # transfer id -> (offset, digest of the last chunk) from FILE_ACK
+        self.uploading = {}             # transfer id -> path of the file, to answer the server's FILE_PROVE
+        self.ack_cond = threading.Condition()
+        self.journal_path = os.path.join(file_save_dir, UPLOAD_JOURNAL)
+        self.index_path = os.path.join(file_save_dir, RECEIVED_INDEX)
+        self.json_lock = threading.Lock()
 
         if not os.path.exists(self.file_save_dir):
             os.makedirs(self.file_save_dir, exist_ok=True)
@@ -30,202 +143,671 @@ class MessageHandler:
         self.calling = False
         self.stream_out = None
         self.stream_in = None
+        self.voice = None               # VoiceChannel once the server put the call on its UDP media relay
+        self.jitter = None              # JitterBuffer between received audio and the playback thread
+        self.codec = None               # audio_codec.Codec of the current call
+        self.decoder = None
+        self.decode_lock = threading.Lock()     # audio can arrive over UDP and TCP at once while a call starts
+        self.call_offers = {}           # caller -> codecs it offered, until we answer
+        self.suppress_silence = suppress_silence    # don't send what voice_activity.py calls silence
+        self.vad = None                 # VoiceActivityDetector of the current call
 
         # Start receiving thread
         threading.Thread(target=self.receive_messages, daemon=True).start()
 
+    # --------------------------------------------------------------
+    # SEND (one frame at a time; GUI and audio threads share the socket)
+    # --------------------------------------------------------------
+    def _send_frame(self, *pieces):
+        with self.send_lock:
+            # compressed in send order, under the lock: the server inflates text in the order it arrives
+            if self.deflater:
+                pieces = self.deflater.pack(pieces)
+            for piece in pieces:
+                self.client_socket.sendall(piece)
+
     # --------------------------------------------------------------
     # SEND TEXT MESSAGE
     # --------------------------------------------------------------
-    def send_text_message(self, message):
+    # started: time.perf_counter() when the user sent it (a traced message measures from there)
+    def send_text_message(self, message, started=None):
+        data = message.encode('utf-8')
         try:
-            self.client_socket.sendall((message + "\n").encode('utf-8'))
+            # only chat lines are traced, not commands
+            if self.tracing and not message.startswith("/") and random.random() < self.trace_share:
+                with self.send_lock:
+                    # stamped right before the write: waiting for the socket counts as client time
+                    payload = tracing.encode_sent(tracing.new_trace_id(), started) + data
+                    self.client_socket.sendall(frame_codec.encode_frame(frame_codec.TEXT, payload,
+                                                                        flags=frame_codec.FLAG_TRACE))
+            else:
+                self._send_frame(frame_codec.encode_frame(frame_codec.TEXT, data))
         except Exception as e:
             print(f"[ERROR] Failed to send message: {e}")
 
     # --------------------------------------------------------------
     # SEND FILE
     # --------------------------------------------------------------
-    def send_file(self, recipient, filepath, chunk_size=4096):
+    # returns a file_upload.UploadResult (bytes, seconds, method) for throughput reporting.
+    # Uploads are resumable: every chunk carries its sha256, the server acknowledges
+    # what it relayed, and an upload cut off by a lost connection stays in the
+    # journal until resume_uploads() finishes it on the next connection.
+    #
+    # With upload_streams > 1, files of PARALLEL_MIN_SIZE and up are split into
+    # ranges sent over that many connections instead (not resumable).
+    #
+    # The sha256 of the whole file goes with the header: if the server has the file
+    # cached nothing is uploaded at all (method "cache"), once we have answered its
+    # FILE_PROVE with the hash of the range it asked for.
+    def send_file(self, recipient, filepath, chunk_size=None, streams=None):
         if not os.path.isfile(filepath):
             raise FileNotFoundError(filepath)
 
+        filepath = os.path.abspath(filepath)
+        st = os.stat(filepath)
+        digest = file_upload.file_digest(filepath)
+        streams = streams or self.upload_streams
+        if streams > 1 and st.st_size >= PARALLEL_MIN_SIZE:
+            return self._upload_parallel(recipient, filepath, chunk_size or self.upload_chunk_size, streams, digest)
+
+        # the server matches a resumed upload by id, size, name and chunk size, so all of them are kept;
+        # the key proves it is ours (after a reconnect the server may have given us another username)
+        chunk_size = file_upload.clamp_chunk(chunk_size or self.upload_chunk_size, checksum=True)
+        transfer_id = uuid.uuid4().hex
+        key = secrets.token_hex(16)
+        self._journal_update(transfer_id, {"path": filepath, "recipient": recipient, "key": key,
+                                           "size": st.st_size, "mtime": st.st_mtime, "chunk_size": chunk_size,
+                                           "digest": digest.hex()})
+        return self._upload(transfer_id, key, recipient, filepath, chunk_size, digest)
+
+    # FILE_RESUME, then FILE_DATA from the offset the server acknowledges
+    def _upload(self, transfer_id, key, recipient, filepath, chunk_size, file_digest):
+        fname = os.path.basename(filepath)
+        with open(filepath, 'rb') as f:
+            fsize = os.fstat(f.fileno()).st_size
+            stream_id = next(self.stream_ids)
+            meta = f"{transfer_id} {key} {recipient} {fsize} {chunk_size} {fname}".encode('utf-8')
+
+            try:
+                with self.ack_cond:
+                    self.acks.pop(transfer_id, None)
+                start = time.perf_counter()
+                self.uploading[transfer_id] = filepath
+                self._send_frame(frame_codec.encode_frame(frame_codec.FILE_RESUME, file_digest + meta, stream_id,
+                                                          frame_codec.FLAG_CHECKSUM))
+                # 0 for a new upload, else how far the interrupted one got (all of it: cached on the server)
+                offset, digest = self._wait_ack(transfer_id)
+            except Exception as e:
+                raise RuntimeError(f"Failed to send file header: {e}")
+            finally:
+                self.uploading.pop(transfer_id, None)
+
+            if fsize and offset == fsize and digest == file_digest:
+                self._journal_update(transfer_id, None)
+                return file_upload.UploadResult(0, time.perf_counter() - start, "cache")
+
+            try:
+                if offset and not self._chunk_matches(f, offset, chunk_size, digest):
+                    raise EOFError(f"{fname} changed since the interrupted upload")
+                # FILE_DATA frames; the send lock is taken per chunk, so chat and audio can go out in between
+                f.seek(offset)
+                packer = compression.ChunkPacker(fname, fsize) if self.deflater else None
+                result = file_upload.upload(self.client_socket, f, fsize - offset, stream_id, self.send_lock,
+                                            chunk_size, checksum=True, packer=packer)
+                self._wait_ack(transfer_id, fsize)
+            except EOFError as e:
+                # the local file is the problem: this upload can't be resumed
+                self._journal_update(transfer_id, None)
+                try:
+                    # let the server drop what it relayed so far
+                    self._send_frame(frame_codec.frame_header(frame_codec.FILE_DATA, 0, stream_id,
+                                                              frame_codec.FLAG_ABORT))
+                except:
+                    pass
+                raise RuntimeError(f"Failed to send file bytes: {e}")
+            except Exception as e:
+                raise RuntimeError(f"Failed to send file bytes: {e} (it resumes after reconnecting)")
+            finally:
+                with self.ack_cond:
+                    self.acks.pop(transfer_id, None)
+
+        self._journal_update(transfer_id, None)
+        return result
+
+    # FILE_PARALLEL on this connection, then the ranges over `streams` data connections
+    def _upload_parallel(self, recipient, filepath, chunk_size, streams, file_digest):
         fname = os.path.basename(filepath)
         fsize = os.path.getsize(filepath)
-        header = f"/file {recipient} {fname} {fsize}\n"
+        chunk_size = file_upload.clamp_chunk(chunk_size, checksum=True, ranged=True)
+        transfer_id = uuid.uuid4().hex
+        meta = f"{transfer_id} {recipient} {fsize} {chunk_size} {fname}".encode('utf-8')
 
+        start = time.perf_counter()
         try:
-            self.client_socket.sendall(header.encode('utf-8'))
+            self.uploading[transfer_id] = filepath
+            self._send_frame(frame_codec.encode_frame(frame_codec.FILE_PARALLEL, file_digest + meta,
+                                                      next(self.stream_ids), frame_codec.FLAG_CHECKSUM))
+            offset, digest = self._wait_ack(transfer_id)
         except Exception as e:
             raise RuntimeError(f"Failed to send file header: {e}")
+        finally:
+            self.uploading.pop(transfer_id, None)
+        if fsize and offset == fsize and digest == file_digest:
+            return file_upload.UploadResult(0, time.perf_counter() - start, "cache")
 
+        socks = []
         try:
-            with open(filepath, 'rb') as f:
-                while True:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-                    self.client_socket.sendall(chunk)
+            socks = file_upload.upload_ranges(lambda: self._open_data_connection(transfer_id),
+                                              filepath, fsize, chunk_size, streams)
+            # data connections stay open until the server has everything
+            self._wait_ack(transfer_id, fsize)
         except Exception as e:
             raise RuntimeError(f"Failed to send file bytes: {e}")
+        finally:
+            for sock in socks:
+                try:
+                    sock.close()
+                except:
+                    pass
+            with self.ack_cond:
+                self.acks.pop(transfer_id, None)
+        return file_upload.UploadResult(fsize, time.perf_counter() - start, f"readinto x{streams}")
+
+    # helper: another TLS connection to our server, attached to a parallel transfer
+    def _open_data_connection(self, transfer_id):
+        sock = socket.create_connection(self.client_socket.getpeername()[:2])
+        sock = self.client_socket.context.wrap_socket(sock, server_hostname=self.client_socket.server_hostname)
+        sock.sendall(frame_codec.client_hello(self.username, {"transfer": transfer_id}))
+        return sock
+
+    # helper: the server's digest of the last chunk before offset matches our file
+    def _chunk_matches(self, f, offset, chunk_size, digest):
+        start = (offset - 1) // chunk_size * chunk_size
+        f.seek(start)
+        return frame_codec.chunk_digest(f.read(offset - start)) == digest
+
+    # helper: wait for a FILE_ACK (any, or one reaching `target` bytes); only a
+    # server that stops making progress for ACK_TIMEOUT counts as a failure
+    def _wait_ack(self, transfer_id, target=None):
+        with self.ack_cond:
+            while True:
+                ack = self.acks.get(transfer_id)
+                if ack is not None and (target is None or ack[0] >= target):
+                    return ack
+                if not self.running:
+                    raise ConnectionError("Disconnected from server")
+                if not self.ack_cond.wait_for(lambda: self.acks.get(transfer_id) != ack or not self.running,
+                                              ACK_TIMEOUT):
+                    raise TimeoutError("Server stopped acknowledging the upload")
+
+    # continue the uploads that a lost connection cut off; call once connected. The server
+    # knows them by their keys, not by username (a reconnect can come back as "name_1")
+    def resume_uploads(self):
+        with self.json_lock:
+            pending = self._load_json(self.journal_path)
+        if pending:
+            threading.Thread(target=self._resume_pending, args=(pending,), daemon=True).start()
+
+    def _resume_pending(self, pending):
+        for transfer_id, job in pending.items():
+            fname = os.path.basename(job["path"])
+            try:
+                st = os.stat(job["path"])
+                if (st.st_size, st.st_mtime) != (job["size"], job["mtime"]):
+                    raise OSError("file changed")
+            except OSError as e:
+                self._journal_update(transfer_id, None)
+                if self.gui_callback:
+                    self.gui_callback(f"[SYSTEM] Not resuming upload of {fname}: {e}")
+                continue
 
-    # --------------------------------------------------------------
-    # EXACT BYTE RECEIVER (used for file download)
-    # --------------------------------------------------------------
-    def _recv_exact(self, num_bytes):
-        data = b''
-        remaining = num_bytes
-        while remaining > 0:
-            chunk = self.client_socket.recv(min(4096, remaining))
-            if not chunk:
-                raise ConnectionError("Connection lost while receiving file")
-            data += chunk
-            remaining -= len(chunk)
-        return data
+            if self.gui_callback:
+                self.gui_callback(f"[SYSTEM] Resuming upload of {fname} to {job['recipient']}...")
+            try:
+                digest = bytes.fromhex(job["digest"]) if job.get("digest") else file_upload.file_digest(job["path"])
+                result = self._upload(transfer_id, job["key"], job["recipient"], job["path"], job["chunk_size"],
+                                      digest)
+                if self.gui_callback:
+                    self.gui_callback(f"[SYSTEM] Resumed upload of {fname} finished "
+                                      f"({result.bytes:,} bytes sent after reconnecting)")
+            except Exception as e:
+                if self.gui_callback:
+                    self.gui_callback(f"[SYSTEM] Upload of {fname} not resumed: {e}")
+
+    # helper: the upload journal (transfer id -> what to resume)
+    def _journal_update(self, transfer_id, job):
+        self._update_json(self.journal_path, transfer_id, job)
+
+    # helper: small JSON dicts in the save folder, rewritten atomically
+    def _load_json(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except:
+            return {}
+
+    def _update_json(self, path, key, value):
+        with self.json_lock:
+            data = self._load_json(path)
+            if value is None:
+                if data.pop(key, None) is None:
+                    return
+            else:
+                data[key] = value
+            tmp = path + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp, path)
+
+    # helper: a file we received before with this digest, still unchanged on disk (or None)
+    def _already_have(self, digest, size):
+        with self.json_lock:
+            known = self._load_json(self.index_path).get(digest.hex())
+        if not known:
+            return None
+        try:
+            st = os.stat(known["path"])
+        except OSError:
+            return None
+        if (st.st_size, st.st_mtime) != (size, known["mtime"]):
+            return None
+        return known["path"]
 
     # --------------------------------------------------------------
-    # MAIN RECEIVER — handles: TEXT + FILE + VOICE STREAM
+    # MAIN RECEIVER — decodes frames: TEXT + FILE + VOICE STREAM
     # --------------------------------------------------------------
     def receive_messages(self):
+        # payloads are views into the receive buffer: file bytes go to disk without another copy
+        decoder = FrameDecoder(copy=False)
         while self.running:
             try:
-                chunk = self.client_socket.recv(4096)
-                if not chunk:
+                # received bytes land directly in the decoder's buffer
+                if not decoder.recv_into(self.client_socket):
                     break
 
-                # -----------------------------------
-                # VOICE CALL MODE → treat as audio
-                # -----------------------------------
-                if self.calling and isinstance(chunk, bytes):
-                    if self.stream_out:
-                        self.stream_out.write(chunk)
-                    continue
+                for frame in decoder.frames():
+                    self._handle_frame(frame)
 
-                # -----------------------------------
-                # TEXT / COMMAND MESSAGE
-                # -----------------------------------
-                try:
-                    text = chunk.decode('utf-8', errors='ignore').strip()
-                except:
-                    continue
+            except Exception as e:
+                print(f"[DISCONNECTED] {e}")
+                break
 
-                # Incoming call request
-                if text.startswith("/call_request:"):
-                    caller = text.split(":")[1]
-                    if self.window:
-                        self.window.after(0, lambda: self.handle_incoming_call(caller))
-                    continue
+        # wake uploads waiting for acknowledgements
+        with self.ack_cond:
+            self.running = False
+            self.ack_cond.notify_all()
+        self._discard_incoming()
+
+    def _handle_frame(self, frame):
+        # -----------------------------------
+        # VOICE CALL AUDIO
+        # -----------------------------------
+        if frame.type == frame_codec.AUDIO:
+            self._buffer_audio(bytes(frame.payload))
+
+        elif frame.type == frame_codec.TEXT:
+            payload = frame.payload
+            if frame.flags & frame_codec.FLAG_COMPRESSED:
+                payload = self.inflater.text(payload)
+            if frame.flags & frame_codec.FLAG_TRACE and len(payload) >= frame_codec.TRACE_ID.size:
+                # a traced message: tell the server when it arrived and how long it took to display
+                received, start = time.time(), time.perf_counter()
+                trace_id = frame_codec.TRACE_ID.unpack_from(payload)[0]
+                self._handle_text(str(payload[frame_codec.TRACE_ID.size:], 'utf-8', errors='ignore').strip())
+                report = tracing.encode_report(trace_id, received, time.perf_counter() - start)
+                self._send_frame(frame_codec.encode_frame(frame_codec.TRACE, report))
+                return
+            self._handle_text(str(payload, 'utf-8', errors='ignore').strip())
+
+        # -----------------------------------
+        # FILE HEADER: "sender size filename" (after the file's sha256 with FLAG_CHECKSUM)
+        # -----------------------------------
+        elif frame.type == frame_codec.FILE_META:
+            payload, digest = frame.payload, None
+            if frame.flags & frame_codec.FLAG_CHECKSUM:
+                digest, payload = bytes(payload[:frame_codec.DIGEST_SIZE]), payload[frame_codec.DIGEST_SIZE:]
+            parts = str(payload, 'utf-8', errors='ignore').split(" ", 2)
+            try:
+                sender, filesize, filename = parts[0], int(parts[1]), parts[2]
+            except (IndexError, ValueError):
+                if self.gui_callback:
+                    self.gui_callback("[SYSTEM] Malformed file header.")
+                return
 
-                # Call accepted → start audio
-                if text.startswith("/call_accept:"):
-                    self.start_voice_stream()
-                    if self.gui_callback:
-                        self.gui_callback("[SYSTEM] Voice call connected.")
-                    continue
+            existing = self._already_have(digest, filesize) if digest and filesize else None
+            if existing:
+                # same content already saved: tell the server not to send it again
+                self._send_frame(frame_codec.frame_header(frame_codec.FILE_HAVE, 0, frame.stream_id))
+                if self.gui_callback:
+                    self.gui_callback(f"[SYSTEM] Already have {filename} from {sender}: {existing}")
+                return
 
-                # Call rejected
-                if text.startswith("/call_reject:"):
-                    if self.gui_callback:
-                        self.gui_callback("[SYSTEM] Call rejected.")
-                    continue
+            if self.gui_callback:
+                self.gui_callback(f"[FILE] Incoming from {sender}: {filename} ({filesize} bytes)")
+            try:
+                self.incoming_files[frame.stream_id] = IncomingFile(self.file_save_dir, sender, filename, filesize,
+                                                                    digest)
+            except Exception as e:
+                if self.gui_callback:
+                    self.gui_callback(f"[SYSTEM] Error saving file: {e}")
+                return
+            if filesize == 0:
+                self._save_file(frame.stream_id)
+
+        elif frame.type == frame_codec.FILE_DATA:
+            incoming = self.incoming_files.get(frame.stream_id)
+            if incoming is None:
+                return
+            if frame.flags & frame_codec.FLAG_ABORT:
+                # the sender disconnected mid-transfer
+                del self.incoming_files[frame.stream_id]
+                incoming.discard()
+                if self.gui_callback:
+                    self.gui_callback(f"[SYSTEM] Transfer of {incoming.filename} was interrupted.")
+                return
+            try:
+                if frame.flags & frame_codec.FLAG_OFFSET:
+                    offset = frame_codec.OFFSET.unpack_from(frame.payload)[0]
+                    incoming.write_at(offset, frame.payload[frame_codec.OFFSET.size:])
+                elif frame.flags & frame_codec.FLAG_COMPRESSED:
+                    incoming.write(compression.inflate_chunk(frame.payload))
+                else:
+                    incoming.write(frame.payload)
+            except Exception as e:
+                del self.incoming_files[frame.stream_id]
+                incoming.discard()
+                if self.gui_callback:
+                    self.gui_callback(f"[SYSTEM] Error saving file: {e}")
+                return
+            if incoming.received >= incoming.size:
+                self._save_file(frame.stream_id)
+            else:
+                self._report_progress(incoming)
+
+        # -----------------------------------
+        # UPLOAD ACKNOWLEDGEMENT: "transfer_id offset [digest]"
+        # -----------------------------------
+        elif frame.type == frame_codec.FILE_ACK:
+            transfer_id, offset, digest = frame_codec.parse_file_ack(frame.payload)
+            with self.ack_cond:
+                self.acks[transfer_id] = (offset, digest)
+                self.ack_cond.notify_all()
+
+        # -----------------------------------
+        # CACHE CHALLENGE: "transfer_id offset length nonce" -> hash of that range of the file we upload
+        # -----------------------------------
+        elif frame.type == frame_codec.FILE_PROVE:
+            transfer_id, offset, length, nonce = frame_codec.parse_file_challenge(frame.payload)
+            path = self.uploading.get(transfer_id)
+            if path is None:
+                return
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(length)
+            except OSError:
+                # unanswerable: a wrong proof makes the server fall back to a normal upload
+                data = b""
+            self._send_frame(*frame_codec.encode_file_proof(transfer_id, frame_codec.possession_proof(nonce, data)))
+
+        # -----------------------------------
+        # SERVER HELLO: our final username
+        # -----------------------------------
+        elif frame.type == frame_codec.HELLO:
+            username, options = frame_codec.parse_hello_payload(bytes(frame.payload))
+            if self.username and username != self.username and self.gui_callback:
+                self.gui_callback(f"[SYSTEM] Username taken, you are logged in as {username}")
+            self.username = username
+            if compression.accept(options):
+                # the server takes compressed text and file data from us (see compression.py)
+                with self.send_lock:
+                    self.deflater = compression.Deflater()
+            # the server records where the time of our traced messages goes (see tracing.py)
+            self.tracing = tracing.accepted(options)
+
+    def _handle_text(self, text):
+        # Incoming call request
+        if text.startswith("/call_request:"):
+            # /call_request:<caller>[:<codecs>]
+            caller, _, offered = text.split(":", 1)[1].partition(":")
+            self.call_offers[caller] = offered
+            if self.window:
+                self.window.after(0, lambda: self.handle_incoming_call(caller))
+            return
 
-                # -----------------------------------
-                # FILE HEADER
-                # -----------------------------------
-                if text.startswith("[FILE]"):
-                    parts = text.split(" ", 3)
-                    if len(parts) < 4:
-                        if self.gui_callback:
-                            self.gui_callback("[SYSTEM] Malformed file header.")
-                        continue
+        # Call accepted → start audio in the codec the callee picked
+        if text.startswith("/call_accept:"):
+            _, _, codec = text.split(":", 1)[1].partition(":")
+            self.start_voice_stream(audio_codec.by_name(codec))
+            if self.gui_callback:
+                self.gui_callback("[SYSTEM] Voice call connected.")
+            return
 
-                    _, sender, filename, filesize_str = parts
-                    try:
-                        filesize = int(filesize_str)
-                    except:
-                        if self.gui_callback:
-                            self.gui_callback("[SYSTEM] Invalid file size.")
-                        continue
+        # In a conference room (our media leg came just before): start audio in the room's codec
+        if text.startswith("/conf_joined:"):
+            room, _, codec = text.split(":", 1)[1].partition(":")
+            self.start_voice_stream(audio_codec.by_name(codec))
+            if self.gui_callback:
+                self.gui_callback(f"[SYSTEM] Joined conference {room}.")
+            return
+
+        # Our leg on the server's UDP media relay: audio goes there instead of this connection
+        if text.startswith("/call_media:"):
+            self._open_voice_channel(text)
+            return
 
-                    if self.gui_callback:
-                        self.gui_callback(f"[FILE] Incoming from {sender}: {filename} ({filesize} bytes)")
+        # The other side hung up
+        if text.startswith("/call_end:"):
+            self.stop_call(notify_server=False)
+            return
 
-                    try:
-                        file_bytes = self._recv_exact(filesize)
-                    except Exception as e:
-                        if self.gui_callback:
-                            self.gui_callback(f"[SYSTEM] Failed receiving file: {e}")
-                        continue
+        # Call rejected
+        if text.startswith("/call_reject:"):
+            if self.gui_callback:
+                self.gui_callback("[SYSTEM] Call rejected.")
+            return
 
-                    save_path = os.path.join(self.file_save_dir, filename)
-                    base, ext = os.path.splitext(save_path)
-                    i = 1
-                    while os.path.exists(save_path):
-                        save_path = f"{base}_{i}{ext}"
-                        i += 1
-
-                    try:
-                        with open(save_path, 'wb') as f:
-                            f.write(file_bytes)
-                        if self.gui_callback:
-                            self.gui_callback(f"[SYSTEM] File saved: {save_path}")
-                    except Exception as e:
-                        if self.gui_callback:
-                            self.gui_callback(f"[SYSTEM] Error saving file: {e}")
+        # -----------------------------------
+        # NORMAL TEXT MESSAGE
+        # -----------------------------------
+        if self.gui_callback:
+            self.gui_callback(text)
 
-                    continue
+    def _save_file(self, stream_id):
+        incoming = self.incoming_files.pop(stream_id)
+        self._report_progress(incoming)
+        try:
+            save_path = incoming.commit(self.file_save_dir)
+            if self.gui_callback:
+                self.gui_callback(f"[SYSTEM] File saved: {save_path}")
+            if incoming.verified():
+                st = os.stat(save_path)
+                self._update_json(self.index_path, incoming.digest.hex(),
+                                  {"path": os.path.abspath(save_path), "size": st.st_size, "mtime": st.st_mtime})
+            elif incoming.hasher and self.gui_callback:
+                self.gui_callback(f"[SYSTEM] Warning: {save_path} does not match the checksum the sender announced")
+        except Exception as e:
+            incoming.discard()
+            if self.gui_callback:
+                self.gui_callback(f"[SYSTEM] Error saving file: {e}")
 
-                # -----------------------------------
-                # NORMAL TEXT MESSAGE
-                # -----------------------------------
-                if self.gui_callback:
-                    self.gui_callback(text)
+    # progress to the GUI every PROGRESS_STEP bytes / 1% (and once at the end)
+    def _report_progress(self, incoming):
+        if not self.progress_callback:
+            return
+        step = max(PROGRESS_STEP, incoming.size // 100)
+        if incoming.received - incoming.reported >= step or incoming.received >= incoming.size:
+            incoming.reported = incoming.received
+            self.progress_callback(incoming.filename, incoming.received, incoming.size)
 
-            except Exception as e:
-                print(f"[DISCONNECTED] {e}")
-                self.running = False
-                break
+    # connection gone: drop partial downloads
+    def _discard_incoming(self):
+        incoming, self.incoming_files = self.incoming_files, {}
+        for partial in incoming.values():
+            partial.discard()
+
+    # --------------------------------------------------------------
+    # START A CALL (offering the codecs we have)
+    # --------------------------------------------------------------
+    def request_call(self, recipient):
+        self.send_text_message(f"/call_request:{recipient}:{audio_codec.offer()}")
+
+    # --------------------------------------------------------------
+    # JOIN A CONFERENCE ROOM (the server mixes everyone's audio; left with stop_call)
+    # --------------------------------------------------------------
+    def join_conference(self, room):
+        self.stop_call()
+        self.send_text_message(f"/conf_join:{room}:{audio_codec.offer()}")
 
     # --------------------------------------------------------------
     # INCOMING CALL POPUP
     # --------------------------------------------------------------
     def handle_incoming_call(self, caller):
         response = messagebox.askyesno("Incoming Voice Call", f"{caller} is calling. Accept?")
+        offered = self.call_offers.pop(caller, "")
         if response:
-            self.send_text_message(f"/call_accept:{caller}")
-            self.start_voice_stream()
+            # answer in the first codec of the caller's list we have (callers without a list get PCM)
+            codec = audio_codec.choose(offered)
+            self.send_text_message(f"/call_accept:{caller}:{codec.name}" if offered else f"/call_accept:{caller}")
+            self.start_voice_stream(codec)
         else:
             self.send_text_message(f"/call_reject:{caller}")
 
     # --------------------------------------------------------------
     # START AUDIO STREAM
     # --------------------------------------------------------------
-    def start_voice_stream(self):
+    def start_voice_stream(self, codec=audio_codec.PCM):
         if self.calling:
             return
 
+        self.codec = codec
+        self.decoder = codec.decoder()
+        self.jitter = JitterBuffer(codec.rate, codec.frame)
         self.calling = True
-        self.stream_out = p.open(format=FORMAT, channels=CHANNELS, rate=RATE, output=True, frames_per_buffer=CHUNK)
-        self.stream_in = p.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True, frames_per_buffer=CHUNK)
+        self.stream_out, play_resampler = self._open_audio(codec, output=True)
+        self.stream_in, capture_resampler = self._open_audio(codec, input=True)
 
-        threading.Thread(target=self.send_audio, daemon=True).start()
+        threading.Thread(target=self.send_audio, args=(codec, capture_resampler), daemon=True).start()
+        threading.Thread(target=self.play_audio, args=(self.jitter, self.stream_out, play_resampler),
+                         daemon=True).start()
+
+    # helper: open the device at the codec's rate, or at RATE with a Resampler if it can't do that
+    def _open_audio(self, codec, **direction):
+        try:
+            return p.open(format=FORMAT, channels=CHANNELS, rate=codec.rate, frames_per_buffer=codec.frame,
+                          **direction), None
+        except Exception:
+            if codec.rate == RATE:
+                raise
+        stream = p.open(format=FORMAT, channels=CHANNELS, rate=RATE, frames_per_buffer=CHUNK, **direction)
+        if direction.get("input"):
+            return stream, audio_codec.Resampler(RATE, codec.rate)
+        return stream, audio_codec.Resampler(codec.rate, RATE)
 
     # --------------------------------------------------------------
-    # SEND AUDIO DATA
+    # PLAY AUDIO (one chunk per write; the device's blocking write sets the pace)
     # --------------------------------------------------------------
-    def send_audio(self):
+    def play_audio(self, jitter, stream_out, resampler=None):
         while self.calling:
             try:
-                data = self.stream_in.read(CHUNK)
-                self.client_socket.sendall(data)
+                _, pcm = jitter.pop()
+                stream_out.write(resampler.convert(pcm) if resampler else pcm)
             except:
                 break
 
+    # --------------------------------------------------------------
+    # SEND AUDIO DATA (in codec frames)
+    # --------------------------------------------------------------
+    def send_audio(self, codec, resampler=None):
+        encoder = codec.encoder()
+        vad = None
+        if self.suppress_silence:
+            vad = voice_activity.VoiceActivityDetector(codec.rate, codec.frame)
+        self.vad = vad
+        frame_bytes = codec.frame * audio_codec.SAMPLE_WIDTH
+        pending = bytearray()
+        while self.calling:
+            try:
+                if resampler:
+                    # the device runs at RATE: collect whole codec frames
+                    pending += resampler.convert(self.stream_in.read(CHUNK))
+                    if len(pending) < frame_bytes:
+                        continue
+                    data = bytes(pending[:frame_bytes])
+                    del pending[:frame_bytes]
+                else:
+                    data = self.stream_in.read(codec.frame)
+                decision = vad.update(data) if vad else voice_activity.SEND
+                voice = self.voice
+                if decision != voice_activity.SEND:
+                    # silence: over UDP a comfort noise level now and then, over TCP nothing
+                    if voice:
+                        if decision == voice_activity.COMFORT:
+                            voice.send_audio(bytes((vad.noise_level(),)), 0, media.COMFORT_NOISE)
+                        voice.skip(codec.frame)
+                    continue
+                payload = encoder.encode(data)
+                if voice:
+                    voice.send_audio(payload, codec.frame, codec.ptype)
+                else:
+                    # no media leg (yet): relayed over the chat connection
+                    self._send_frame(frame_codec.frame_header(frame_codec.AUDIO, len(payload)), payload)
+            except:
+                break
+
+    # helper: received audio (timestamp None over TCP) -> decoded into the jitter buffer
+    def _buffer_audio(self, payload, timestamp=None):
+        jitter = self.jitter
+        if not (self.calling and jitter):
+            return
+        try:
+            with self.decode_lock:
+                pcm = self.decoder.decode(payload)
+        except Exception:
+            return
+        jitter.put(pcm, timestamp)
+
+    # --------------------------------------------------------------
+    # UDP MEDIA LEG
+    # --------------------------------------------------------------
+    def _open_voice_channel(self, text):
+        try:
+            port, token, key = media.parse_offer(text)
+            host = self.client_socket.getpeername()[0]
+            voice = VoiceChannel(host, port, token, key, self._receive_audio)
+        except Exception as e:
+            # audio keeps going over the chat connection
+            print(f"[VOICE] No UDP media: {e}")
+            return
+        old, self.voice = self.voice, voice
+        if old:
+            old.close()
+
+    def _receive_audio(self, ptype, seq, timestamp, payload):
+        codec = self.codec
+        if codec and ptype == codec.ptype:
+            self._buffer_audio(payload, timestamp)
+        elif ptype == media.COMFORT_NOISE and payload:
+            # the other side went quiet: play its background noise until it talks again
+            jitter = self.jitter
+            if self.calling and jitter:
+                jitter.comfort_noise(payload[0], timestamp)
+
     # --------------------------------------------------------------
     # END CALL
     # --------------------------------------------------------------
-    def stop_call(self):
-        self.calling = False
+    def stop_call(self, notify_server=True):
+        if self.calling and notify_server:
+            # let the server end the call for the other side and release the media leg
+            self.send_text_message("/call_end")
+        was_calling, self.calling = self.calling, False
+        voice, self.voice = self.voice, None
+        if voice:
+            voice.close()
+        if was_calling and self.jitter:
+            print(f"[VOICE] {self.codec.name}: {self.jitter.summary()}")
+        if was_calling and self.vad:
+            print(f"[VOICE] sent: {self.vad.summary()}")
         try:
             if self.stream_out:
                 self.stream_out.stop_stream()
@@ -0,0 +1,145 @@
+# compression.py
+# Optional compression of framed traffic, negotiated per connection.
+#
+# A framed client offers "compress=zlib" in its hello (offer()); the server
+# accepts by naming the codec in its own hello (accept()). From then on either
+# side may set FLAG_COMPRESSED on two frame types:
+#
+#   TEXT       - the payload comes from the connection's streaming deflate context
+#                (Deflater, one per direction, sync-flushed after every frame), so
+#                a chat line is compressed against the lines sent before it.
+#                Frames under TEXT_MIN bytes go out as they are and never touch
+#                the context. The server compresses when a frame is written, after
+#                the outbound queue has decided what to drop, so both ends of a
+#                context always see the same frames in the same order.
+#   FILE_DATA  - each chunk is deflated on its own (ChunkPacker), so the server can
+#                verify, cache and forward a compressed chunk without compressing it
+#                again, and a chunk that doesn't shrink is simply sent raw. zlib only
+#                looks back 32 KiB anyway, so 256 KiB chunks lose nothing by being
+#                independent. Files with an already-compressed extension aren't tried.
+#
+# Chunks with an offset (parallel uploads) are never compressed.
+import os
+import zlib
+from frame_codec import FLAG_COMPRESSED, HEADER, MAX_PAYLOAD, TEXT, FrameError, frame_header
+
+ZLIB = "zlib"
+CODECS = (ZLIB,)                # in order of preference
+
+# text: a small window of recent chat is enough history, and keeps an active
+# connection's context at about 64 KiB (it is only created once text is compressed)
+TEXT_MIN = 64                   # shorter frames are sent raw
+TEXT_LEVEL = 6
+TEXT_WBITS = 13
+TEXT_MEMLEVEL = 6
+
+# files: level 1 gets most of the ratio on logs and CSV for a fraction of the CPU
+FILE_MIN = 4096                 # smaller files are sent raw
+FILE_LEVEL = 1
+MIN_SAVING = 0.125              # a chunk has to shrink by this much to be sent compressed
+GIVE_UP_AFTER = 4               # chunks in a row that didn't before the rest of the file goes raw
+
+SKIP_EXTENSIONS = frozenset((
+    ".7z", ".aac", ".avi", ".br", ".bz2", ".docx", ".flac", ".gif", ".gz", ".heic", ".jar", ".jpeg", ".jpg",
+    ".lz4", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".odt", ".ogg", ".opus", ".pdf", ".png", ".pptx", ".rar",
+    ".tgz", ".webm", ".webp", ".xlsx", ".xz", ".zip", ".zst",
+))
+
+
+# ---------- negotiation ----------
+
+# hello options of a client that can take compressed frames
+def offer():
+    return {"compress": ",".join(CODECS)}
+
+
+# server side: the codec to use with a client, from its hello options (None: send everything raw)
+def accept(options):
+    for codec in (options or {}).get("compress", "").split(","):
+        if codec.strip() in CODECS:
+            return codec.strip()
+    return None
+
+
+# ---------- text ----------
+
+class Deflater:
+    """Outgoing side of a connection: compresses TEXT frames with one streaming context."""
+
+    def __init__(self):
+        self.context = None
+
+    # a message as queued (tuple of buffers), with a whole TEXT frame replaced by its compressed form
+    def pack(self, pieces):
+        # encode_text() produces the header and payload as one buffer; anything else passes through
+        if len(pieces) != 1 or len(pieces[0]) < HEADER.size + TEXT_MIN:
+            return pieces
+        frame = pieces[0]
+        _, ftype, flags, stream_id, length = HEADER.unpack_from(frame)
+        # room for deflate's worst-case growth on incompressible text
+        if ftype != TEXT or flags or length != len(frame) - HEADER.size or length > MAX_PAYLOAD - 1024:
+            return pieces
+        if self.context is None:
+            self.context = zlib.compressobj(TEXT_LEVEL, zlib.DEFLATED, -TEXT_WBITS, TEXT_MEMLEVEL)
+        payload = memoryview(frame)[HEADER.size:]
+        packed = self.context.compress(payload) + self.context.flush(zlib.Z_SYNC_FLUSH)
+        return (frame_header(TEXT, len(packed), stream_id, FLAG_COMPRESSED) + packed,)
+
+
+class Inflater:
+    """Incoming side of a connection: undoes the peer's Deflater."""
+
+    def __init__(self):
+        self.context = None
+
+    def text(self, payload):
+        if self.context is None:
+            self.context = zlib.decompressobj(-zlib.MAX_WBITS)
+        try:
+            data = self.context.decompress(payload, MAX_PAYLOAD)
+        except zlib.error as e:
+            raise FrameError(f"Bad compressed text: {e}")
+        if self.context.unconsumed_tail:
+            raise FrameError("Compressed text too large")
+        return data
+
+
+# ---------- file chunks ----------
+
+def worth_compressing(filename, size):
+    return size >= FILE_MIN and os.path.splitext(filename)[1].lower() not in SKIP_EXTENSIONS
+
+
+class ChunkPacker:
+    """Deflates the chunks of one file, and stops trying once they don't shrink."""
+
+    def __init__(self, filename, size):
+        self.active = worth_compressing(filename, size)
+        self.misses = 0
+        self.saved = 0              # bytes not sent thanks to compression
+
+    # the chunk deflated on its own, or None if it should go raw
+    def pack(self, chunk):
+        if not self.active or len(chunk) > MAX_PAYLOAD:
+            return None
+        context = zlib.compressobj(FILE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        packed = context.compress(chunk) + context.flush()
+        if len(packed) > len(chunk) * (1 - MIN_SAVING):
+            self.misses += 1
+            if self.misses >= GIVE_UP_AFTER:
+                self.active = False
+            return None
+        self.misses = 0
+        self.saved += len(chunk) - len(packed)
+        return packed
+
+
+def inflate_chunk(packed):
+    context = zlib.decompressobj(-zlib.MAX_WBITS)
+    try:
+        chunk = context.decompress(packed, MAX_PAYLOAD)
+    except zlib.error as e:
+        raise FrameError(f"Bad compressed chunk: {e}")
+    if context.unconsumed_tail or not context.eof:
+        raise FrameError("Bad compressed chunk")
+    return chunk
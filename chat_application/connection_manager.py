@@ -2,16 +2,256 @@
 import socket
 import threading
 import ssl
-from message_handler import handle_client
+import time
+import heapq
+import queue
+import selectors
+import compression
+import media
+import metrics
+import tracing
+import frame_codec
+from file_relay import FILE_WINDOW
+import message_handler
+from message_handler import TransferStreamHandler, handle_client
+from client_registry import ClientRegistry
+from outbound_queue import OutboundQueue, skipped_notice
 from logger_utility import Logger
 
 logger = Logger()
 
+connections = metrics.counter("chat_connections_total", "TCP connections accepted")
+handshakes = metrics.histogram("chat_handshake_seconds", "Time from accept to TLS done and username received")
+handshake_timeouts = metrics.counter("chat_handshake_timeouts_total", "Connections that didn't finish the handshake in time")
+handshake_failures = metrics.counter("chat_handshake_failures_total", "Connections whose handshake failed")
+
+
+# the server's gauges, read from its client registry when the metrics are scraped
+def register_metrics(registry):
+    metrics.gauge("chat_clients", "Connected clients", fn=lambda: len(registry))
+    metrics.gauge("chat_outbound_queued_bytes", "Bytes waiting in client send queues",
+                  fn=lambda: sum(entry.outbound.size for entry in registry.entries() if entry.outbound))
+    metrics.gauge("chat_log_queued_lines", "Log lines waiting for the log writer", fn=lambda: logger.stats()["queued"])
+    metrics.counter("chat_log_dropped_total", "Log lines dropped (log queue full)", fn=lambda: logger.stats()["dropped"])
+
+
+class HandshakeStats:
+    """Counters for the TLS handshake + username stage (thread-safe)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def record_accept(self):
+        with self.lock:
+            self.accepted += 1
+        connections.inc()
+
+    def record_success(self, latency):
+        with self.lock:
+            self.completed += 1
+            self.latency_total += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+        handshakes.observe(latency)
+
+    def record_timeout(self):
+        with self.lock:
+            self.timeouts += 1
+        handshake_timeouts.inc()
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+        handshake_failures.inc()
+
+    def snapshot(self):
+        with self.lock:
+            avg = self.latency_total / self.completed if self.completed else 0.0
+            return {
+                "accepted": self.accepted,
+                "completed": self.completed,
+                "timeouts": self.timeouts,
+                "failures": self.failures,
+                "in_flight": self.accepted - self.completed - self.timeouts - self.failures,
+                "latency_avg_ms": round(avg * 1000, 3),
+                "latency_max_ms": round(self.latency_max * 1000, 3),
+            }
+
+
+class HandshakeWorker(threading.Thread):
+    """
+    Drives TLS handshakes + username reads for many connections at once.
+    Sockets are non-blocking and multiplexed on one selector, so a slow or silent
+    client only holds its own slot until its deadline, never the whole stage.
+    """
+
+    def __init__(self, server, name):
+        super().__init__(name=name, daemon=True)
+        self.server = server
+        self.selector = selectors.DefaultSelector()
+        self.incoming = queue.SimpleQueue()
+        self.deadlines = []     # heap of (deadline, seq, sock)
+        self.seq = 0
+
+        # self-pipe so submit() can wake the selector
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+
+    def submit(self, conn, addr, accepted_at):
+        self.incoming.put((conn, addr, accepted_at))
+        try:
+            self.wake_w.send(b"\0")
+        except OSError:
+            pass
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.deadlines:
+                timeout = max(0, self.deadlines[0][0] - time.monotonic())
+
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    self._take_incoming()
+                else:
+                    self._step(key.fileobj, key.data)
+
+            self._expire()
+
+    def _take_incoming(self):
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        while True:
+            try:
+                conn, addr, accepted_at = self.incoming.get_nowait()
+            except queue.Empty:
+                return
+            deadline = accepted_at + self.server.handshake_timeout
+            try:
+                # Wrap with TLS; the handshake is driven step by step in _step()
+                conn.setblocking(False)
+                secure_conn = self.server.context.wrap_socket(conn, server_side=True,
+                                                              do_handshake_on_connect=False)
+            except Exception as e:
+                self._fail(conn, addr, e)
+                continue
+            state = {"addr": addr, "accepted_at": accepted_at, "deadline": deadline, "tls_done": False,
+                     "hello": b""}
+            self.selector.register(secure_conn, selectors.EVENT_READ, state)
+            self.seq += 1
+            heapq.heappush(self.deadlines, (deadline, self.seq, secure_conn))
+            self._step(secure_conn, state)
+
+    def _step(self, sock, state):
+        try:
+            if not state["tls_done"]:
+                sock.do_handshake()
+                state["tls_done"] = True
+                logger.log_event(f"[TLS OK] Handshake completed with {state['addr']}")
+
+            # First message = username (bare, legacy) or a framed hello
+            while True:
+                data = sock.recv(1024)
+                if not data:
+                    raise ConnectionError("Connection closed before username")
+                state["hello"] += data
+                hello = frame_codec.parse_client_hello(state["hello"])
+                if hello:
+                    break
+                if len(state["hello"]) > frame_codec.MAX_HELLO:
+                    raise frame_codec.FrameError("Client hello too large")
+        except ssl.SSLWantReadError:
+            self.selector.modify(sock, selectors.EVENT_READ, state)
+            return
+        except ssl.SSLWantWriteError:
+            self.selector.modify(sock, selectors.EVENT_WRITE, state)
+            return
+        except Exception as e:
+            self.selector.unregister(sock)
+            self._fail(sock, state["addr"], e)
+            return
+
+        self.selector.unregister(sock)
+        protocol, username, options, leftover = hello
+        if not username:
+            self.server.handshake_stats.record_failure()
+            sock.close()
+            return
+
+        sock.setblocking(True)
+        self.server.handshake_stats.record_success(time.monotonic() - state["accepted_at"])
+        self.server.admit(sock, state["addr"], username, protocol, leftover, options)
+
+    def _expire(self):
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, _, sock = heapq.heappop(self.deadlines)
+            try:
+                key = self.selector.get_key(sock)
+            except (KeyError, ValueError):
+                continue  # already finished
+            self.selector.unregister(sock)
+            self.server.handshake_stats.record_timeout()
+            logger.log_event(f"[HANDSHAKE TIMEOUT] {key.data['addr']} after {self.server.handshake_timeout}s")
+            try:
+                sock.close()
+            except:
+                pass
+
+    def _fail(self, sock, addr, error):
+        self.server.handshake_stats.record_failure()
+        logger.log_event(f"[HANDSHAKE ERROR] {addr} {error}")
+        try:
+            sock.close()
+        except:
+            pass
+
+
+# helper: options of the server's HELLO, telling a framed client what it may use
+def hello_options(codec, udp_media, trace=False):
+    options = {}
+    if codec:
+        options["compress"] = codec
+    if udp_media:
+        options["media"] = media.UDP
+    if trace:
+        options.update(tracing.offer())
+    return options or None
+
+
 class Server:
-    def __init__(self, host='127.0.0.1', port=5557):  # ✅ double underscores
+    def __init__(self, host='127.0.0.1', port=5557, handshake_timeout=10.0, handshake_workers=2,
+                 outbound_max_bytes=1 << 20, overflow_policy="drop", file_window=FILE_WINDOW,
+                 compress=True):  # ✅ double underscores
         self.host = host
         self.port = port
 
+        # Per-client outbound queues: bound in bytes + what to do with clients that can't keep up
+        self.outbound_max_bytes = outbound_max_bytes
+        self.overflow_policy = overflow_policy
+        # Bytes of a relayed file allowed in a recipient's queue before the sender is slowed down
+        self.file_window = file_window
+        # Accept compression from framed clients that offer it (see compression.py)
+        self.compress = compress
+
+        # Handshake stage: TLS + username run on HandshakeWorker threads, never on the accept loop.
+        # handshake_timeout is an absolute deadline per connection, counted from accept().
+        self.handshake_timeout = handshake_timeout
+        self.handshake_stats = HandshakeStats()
+        self.handshake_workers = [HandshakeWorker(self, f"handshake-{i}") for i in range(handshake_workers)]
+        self.next_worker = 0
+
         # TCP socket
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -20,9 +260,9 @@ class Server:
         self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         self.context.load_cert_chain(certfile="server.crt", keyfile="server.key")
 
-        # Clients
-        self.clients = {}
-        self.clients_lock = threading.Lock()
+        # Clients (socket <-> username)
+        self.registry = ClientRegistry()
+        register_metrics(self.registry)
 
     def start(self):
         self.server_socket.bind((self.host, self.port))
@@ -30,55 +270,69 @@ class Server:
 
         logger.log_event(f"[SECURE SERVER STARTED] Listening on {self.host}:{self.port}")
 
-        # Accept loop
+        for worker in self.handshake_workers:
+            worker.start()
+
+        # UDP media relay for voice calls (its own thread)
+        message_handler.media_relay.start(self.host)
+
+        # Accept loop: only accept() here, everything that can block goes to the handshake stage
         while True:
             try:
                 conn, addr = self.server_socket.accept()
-
-                # Wrap with TLS
-                secure_conn = self.context.wrap_socket(conn, server_side=True)
-                logger.log_event(f"[TLS OK] Handshake completed with {addr}")
-
-                # First message = username
-                username = secure_conn.recv(1024).decode("utf-8").strip()
-                if not username:
-                    secure_conn.close()
-                    continue
-
-                # Ensure username uniqueness
-                with self.clients_lock:
-                    existing = set(self.clients.values())
-                    original = username
-                    i = 1
-                    while username in existing:
-                        username = f"{original}_{i}"
-                        i += 1
-
-                    self.clients[secure_conn] = username
-
-                logger.log_event(f"[NEW USER] {username} ({addr}) connected.")
-
-                # Start handler thread
-                thread = threading.Thread(
-                    target=handle_client,
-                    args=(secure_conn, addr, self.clients, self.clients_lock),
-                    daemon=True
-                )
-                thread.start()
+                self.handshake_stats.record_accept()
+                worker = self.handshake_workers[self.next_worker]
+                self.next_worker = (self.next_worker + 1) % len(self.handshake_workers)
+                worker.submit(conn, addr, time.monotonic())
 
             except Exception as e:
                 logger.log_event(f"[SERVER ERROR] {e}")
 
+    # called by a HandshakeWorker once TLS is up and the username has arrived
+    def admit(self, secure_conn, addr, username, protocol=frame_codec.LINE, leftover=b"", options=None):
+        if protocol == frame_codec.FRAME and (options or {}).get("transfer"):
+            # data connection of a parallel upload: not a chat user, never registered
+            TransferStreamHandler(secure_conn, addr, self.registry, options["transfer"], initial_data=leftover,
+                                  file_window=self.file_window)
+            return
+
+        # Register (the registry keeps usernames unique); all sends go through the client's writer
+        codec = compression.accept(options) if self.compress and protocol == frame_codec.FRAME else None
+        udp_media = protocol == frame_codec.FRAME and message_handler.media_relay.enabled and media.accept(options)
+        trace = protocol == frame_codec.FRAME and message_handler.tracer.enabled and tracing.accepted(options)
+        outbound = OutboundQueue(secure_conn, max_bytes=self.outbound_max_bytes,
+                                 policy=self.overflow_policy, name=username,
+                                 notice=lambda count: skipped_notice(count, protocol),
+                                 deflater=compression.Deflater() if codec else None)
+        username = self.registry.add(secure_conn, username, addr, outbound, protocol, codec, udp_media, trace)
+        if protocol == frame_codec.FRAME:
+            # confirm the framed protocol and tell the client its final username (and what it may use)
+            outbound.put(frame_codec.server_hello(username, hello_options(codec, udp_media, trace)), droppable=False)
+
+        logger.log_event("[NEW USER] %s (%s) connected (%s protocol).", username, addr, protocol,
+                         user=username, peer=addr)
+
+        # Start handler thread
+        thread = threading.Thread(
+            target=handle_client,
+            args=(secure_conn, addr, self.registry, leftover, self.file_window),
+            daemon=True
+        )
+        thread.start()
+
     def stop(self):
         logger.log_event("[SERVER STOPPING] Closing all connections...")
+        logger.log_event(f"[HANDSHAKE STATS] {self.handshake_stats.snapshot()}")
+        logger.log_event(f"[FILE CACHE STATS] {message_handler.file_cache.stats()}")
+        logger.log_event(f"[METRICS] {metrics.registry.summary()}")
+        message_handler.media_relay.stop()
+        message_handler.tracer.close()
 
-        with self.clients_lock:
-            for conn in list(self.clients.keys()):
-                try:
-                    conn.close()
-                except:
-                    pass
-            self.clients.clear()
+        for conn in self.registry.clear():
+            try:
+                conn.close()
+            except:
+                pass
 
         try:
             self.server_socket.close()
@@ -86,15 +340,94 @@ class Server:
             pass
 
         logger.log_event("[SERVER STOPPED]")
+        logger.flush()
 
 if __name__ == "__main__":
     import argparse
+    import logger_utility
+    from logger_utility import LEVELS, LOG_POLICIES
+    from outbound_queue import OVERFLOW_POLICIES
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", default="127.0.0.1")
     parser.add_argument("--port", type=int, default=5557)
+    parser.add_argument("--mode", choices=["threaded", "async"], default="threaded",
+                        help="threaded: one thread per client; async: all clients on one event loop")
+    parser.add_argument("--handshake-timeout", type=float, default=10.0,
+                        help="seconds a new connection gets to finish TLS and send its username")
+    parser.add_argument("--handshake-workers", type=int, default=2,
+                        help="threads driving TLS handshakes (threaded mode)")
+    parser.add_argument("--outbound-queue-kb", type=int, default=1024,
+                        help="per-client send queue limit in KiB")
+    parser.add_argument("--overflow-policy", choices=OVERFLOW_POLICIES, default="drop",
+                        help="what to do when a client's send queue is full")
+    parser.add_argument("--file-window-kb", type=int, default=FILE_WINDOW // 1024,
+                        help="KiB of a relayed file that may queue up per recipient before the sender is slowed down")
+    parser.add_argument("--file-cache-dir", default="file_cache",
+                        help="directory of the content-addressed file cache")
+    parser.add_argument("--file-cache-mb", type=int, default=0,
+                        help="disk space for cached uploads in MiB (default 0: no cache)")
+    parser.add_argument("--compression", choices=["zlib", "off"], default="zlib",
+                        help="compress text and file data for clients that support it")
+    parser.add_argument("--media-port", type=int, default=None,
+                        help="UDP port for call audio (default: --port + 1, 0 relays audio over TCP)")
+    parser.add_argument("--log-max-mb", type=int, default=10,
+                        help="rotate server_log.txt past this size in MiB (0 never rotates)")
+    parser.add_argument("--log-backups", type=int, default=5,
+                        help="rotated log files kept")
+    parser.add_argument("--log-queue", type=int, default=100000,
+                        help="log lines that may wait for the log writer")
+    parser.add_argument("--log-policy", choices=LOG_POLICIES, default="drop",
+                        help="what to do when the log queue is full: drop lines or block the caller")
+    parser.add_argument("--event-log", default=None, metavar="DIR",
+                        help="also write every event as a structured record into DIR (query with event_log.py)")
+    parser.add_argument("--log-level", choices=sorted(LEVELS), default="info",
+                        help="lowest level of events logged")
+    parser.add_argument("--log-sample", action="append", default=[], metavar="TAG=SHARE",
+                        help="log only SHARE (0-1) of [TAG] events, e.g. BROADCAST=0.01 (repeatable)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on http://--metrics-host:PORT/metrics (default: off)")
+    parser.add_argument("--metrics-host", default="127.0.0.1",
+                        help="address of the metrics endpoint (keep it local unless a scraper needs it)")
+    parser.add_argument("--trace", action="store_true",
+                        help="accept trace ids from clients that offer them: per-hop latency histograms of their "
+                             "messages (chat_trace_hop_seconds)")
+    parser.add_argument("--trace-file", default=None, metavar="PATH",
+                        help="also write every traced delivery to PATH as Chrome trace events (implies --trace)")
     args = parser.parse_args()
 
-    server = Server(host=args.host, port=args.port)
+    sample = {}
+    for option in args.log_sample:
+        tag, _, share = option.partition("=")
+        try:
+            sample[tag.strip("[] ").upper()] = float(share)
+        except ValueError:
+            parser.error(f"--log-sample wants TAG=SHARE, got {option}")
+    logger_utility.configure(max_bytes=args.log_max_mb << 20, backups=args.log_backups,
+                             max_queue=args.log_queue, policy=args.log_policy, events=args.event_log,
+                             level=args.log_level, sample=sample)
+
+    message_handler.file_cache.configure(directory=args.file_cache_dir, max_bytes=args.file_cache_mb << 20)
+    message_handler.media_relay.configure(args.port + 1 if args.media_port is None else args.media_port)
+    message_handler.tracer.configure(args.trace, args.trace_file)
+
+    if args.metrics_port is not None:
+        metrics_server = metrics.MetricsServer(args.metrics_host, args.metrics_port)
+        logger.log_event(f"[METRICS] http://{args.metrics_host}:{metrics_server.port}/metrics")
+
+    if args.mode == "async":
+        from async_server import AsyncServer
+        server = AsyncServer(host=args.host, port=args.port, handshake_timeout=args.handshake_timeout,
+                             outbound_max_bytes=args.outbound_queue_kb * 1024,
+                             overflow_policy=args.overflow_policy,
+                             file_window=args.file_window_kb * 1024,
+                             compress=args.compression != "off")
+    else:
+        server = Server(host=args.host, port=args.port, handshake_timeout=args.handshake_timeout,
+                        handshake_workers=args.handshake_workers,
+                        outbound_max_bytes=args.outbound_queue_kb * 1024,
+                        overflow_policy=args.overflow_policy,
+                        file_window=args.file_window_kb * 1024,
+                        compress=args.compression != "off")
     try:
         server.start()
     except KeyboardInterrupt:
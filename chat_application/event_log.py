@@ -0,0 +1,352 @@
+# event_log.py
+# Structured server events next to the text log, and a tool to query them.
+#
+# With an event directory configured (logger_utility.configure(events=...), or
+# --event-log on the server), the log writer also appends every event as one
+# JSON line to the current segment of that directory:
+#   {"t": 1760210968.5, "type": "BROADCAST", "user": "ali", "peer": "127.0.0.1:58176", "text": "..."}
+# "type" is the [TAG] of the text line, "text" the rest of it; "user", "peer",
+# "bytes" and "latency" (ms) are there when the code that logged it passed them,
+# "sample" when only that share of the type's events is logged.
+#
+# Segments (events-000001.jsonl, ...) are started past SEGMENT_BYTES. Next to
+# each one:
+#   .idx  - every INDEX_EVERY records, (latest time so far, byte offset) packed
+#           as INDEX_ENTRY: a query seeks straight to where its time range starts
+#   .meta - written when the segment is finished: first and last time, record
+#           count, users and event types in it, so a query skips whole segments
+# A segment left without .meta (the server was killed) is scanned once and
+# finished when the directory is opened again.
+#
+#   python3 event_log.py query --dir events --user ali --since "2025-10-12 12:00" --until "2025-10-12 13:00"
+#   python3 event_log.py convert server_log.txt --dir events
+#
+# convert turns an existing text log into segments, picking users, addresses
+# and byte counts out of the line formats the server has used.
+import argparse
+import bisect
+import json
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+
+SEGMENT_BYTES = 16 << 20        # start a new segment past this size
+INDEX_EVERY = 128               # records between time index entries
+INDEX_ENTRY = struct.Struct("<dQ")
+CLOCK_SKEW = 1.0                # seconds records may be out of order (stamped by many threads, queued after)
+FIELDS = ("user", "peer", "bytes", "latency", "sample")
+
+SEGMENT_NAME = re.compile(r"^events-(\d+)\.jsonl$")
+TAG = re.compile(r"^\[([A-Z][A-Z0-9 _]*)\] ?(.*)$", re.S)
+
+
+# "host:port" of a socket address, for the "peer" field
+def peer(address):
+    try:
+        return f"{address[0]}:{address[1]}"
+    except:
+        return None
+
+
+# helper: (tag, rest) of "[TAG] rest"
+def split_tag(event):
+    match = TAG.match(event)
+    return (match.group(1), match.group(2)) if match else ("", event)
+
+
+# a record for one logged event: its [TAG] becomes the type
+def record(when, event, fields=None):
+    rec = {"t": round(when, 3)}
+    rec["type"], text = split_tag(event)
+    if fields:
+        for name in FIELDS:
+            value = fields.get(name)
+            if value is not None:
+                rec[name] = peer(value) if name == "peer" and isinstance(value, tuple) else value
+    rec["text"] = text
+    return rec
+
+
+class EventLog:
+    """Append side of an event directory: the current segment, its index and its summary."""
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.file = None
+        self.index = None
+        self.number = 0
+
+        os.makedirs(directory, exist_ok=True)
+        for number in segment_numbers(directory):
+            self.number = number
+            if not os.path.exists(self._path(number, ".meta")):
+                _write_meta(self._path(number, ".meta"), summarize(self._path(number, ".jsonl")))
+
+    def _path(self, number, suffix):
+        return os.path.join(self.directory, f"events-{number:06d}{suffix}")
+
+    # records: dicts from record(), oldest first
+    def append(self, records):
+        with self.lock:
+            if self.file is None:
+                self._start()
+            out = []
+            index = []
+            offset = self.size
+            for rec in records:
+                if self.count % INDEX_EVERY == 0:
+                    index.append(INDEX_ENTRY.pack(self.latest, offset))
+                line = (json.dumps(rec, separators=(",", ":"), ensure_ascii=False) + "\n").encode("utf-8")
+                out.append(line)
+                offset += len(line)
+                self.count += 1
+                t = rec["t"]
+                if self.first is None:
+                    self.first = t
+                self.latest = max(self.latest, t)
+                if "user" in rec:
+                    self.users.add(rec["user"])
+                self.types[rec["type"]] = self.types.get(rec["type"], 0) + 1
+            self.file.write(b"".join(out))
+            self.file.flush()
+            if index:
+                self.index.write(b"".join(index))
+                self.index.flush()
+            self.size = offset
+            if self.size >= self.segment_bytes:
+                self._finish()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self._finish()
+
+    # helper: a new segment after the last one
+    def _start(self):
+        self.number += 1
+        self.file = open(self._path(self.number, ".jsonl"), "ab")
+        self.index = open(self._path(self.number, ".idx"), "ab")
+        self.size = 0
+        self.count = 0
+        self.first = None
+        self.latest = 0.0
+        self.users = set()
+        self.types = {}
+
+    # helper: close the current segment and write its summary
+    def _finish(self):
+        self.file.close()
+        self.index.close()
+        self.file = self.index = None
+        _write_meta(self._path(self.number, ".meta"), {
+            "first": self.first, "last": self.latest, "count": self.count,
+            "users": sorted(self.users), "types": self.types,
+        })
+
+
+# ---------- reading ----------
+
+def segment_numbers(directory):
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(int(m.group(1)) for m in map(SEGMENT_NAME.match, names) if m)
+
+
+# helper: the records of a segment file from offset on (stops at a half-written last line)
+def _read(path, offset=0):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                return
+
+
+# the .meta of a segment, rebuilt by scanning it
+def summarize(path):
+    first, last, count, users, types = None, 0.0, 0, set(), {}
+    for rec in _read(path):
+        if first is None:
+            first = rec["t"]
+        last = max(last, rec["t"])
+        count += 1
+        if "user" in rec:
+            users.add(rec["user"])
+        types[rec["type"]] = types.get(rec["type"], 0) + 1
+    return {"first": first, "last": last, "count": count, "users": sorted(users), "types": types}
+
+
+def _write_meta(path, meta):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp, path)
+
+
+# helper: byte offset in a segment before which every record is older than since
+def _seek(index_path, since):
+    try:
+        with open(index_path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return 0
+    entries = [INDEX_ENTRY.unpack_from(data, i) for i in range(0, len(data) - len(data) % INDEX_ENTRY.size,
+                                                                 INDEX_ENTRY.size)]
+    # entry times are the latest record before the offset, so they only go up
+    i = bisect.bisect_left([latest for latest, _ in entries], since) - 1
+    return entries[i][1] if i >= 0 else 0
+
+
+# records of user (or anyone) and of types (or any) with since <= t <= until, oldest first
+def query(directory, user=None, since=None, until=None, types=None):
+    since = float("-inf") if since is None else since
+    until = float("inf") if until is None else until
+    types = set(types) if types else None
+    for number in segment_numbers(directory):
+        base = os.path.join(directory, f"events-{number:06d}")
+        try:
+            with open(base + ".meta", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            meta = None             # the segment being written
+        if meta is not None:
+            if not meta["count"] or meta["last"] < since or meta["first"] > until + CLOCK_SKEW:
+                continue
+            if user is not None and user not in meta["users"]:
+                continue
+            if types is not None and not types.intersection(meta["types"]):
+                continue
+        for rec in _read(base + ".jsonl", _seek(base + ".idx", since)):
+            t = rec["t"]
+            if t > until + CLOCK_SKEW:
+                break
+            if t < since or t > until:
+                continue
+            if user is not None and rec.get("user") != user:
+                continue
+            if types is not None and rec["type"] not in types:
+                continue
+            yield rec
+
+
+def format_record(rec):
+    stamp = datetime.fromtimestamp(rec["t"]).strftime("%Y-%m-%d %H:%M:%S")
+    return f"[{stamp}] [{rec['type']}] {rec['text']}" if rec["type"] else f"[{stamp}] {rec['text']}"
+
+
+# ---------- converting text logs ----------
+
+LINE = re.compile(r"^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\] (.*)$")
+# the line formats of the server's text log that name a user or an address
+SENDER = re.compile(r"^\[([^\]]+)\] \(([^)]+)\): ")                      # [BROADCAST] [ali] (127.0.0.1:5817): hi
+USER_ADDR = re.compile(r"^(\S+) \(\('([^']+)', (\d+)\)\)")              # [CONNECTED] ali (('127.0.0.1', 5817))
+ADDR = re.compile(r"^\('([^']+)', (\d+)\)")                             # [DISCONNECTED] ('127.0.0.1', 5817)
+USER_ARROW = re.compile(r"^(\S+) -> ")                                  # [PRIVATE] ali -> sara: hi
+USER_FIRST = re.compile(r"^([^\s(\[]+)[ :]")                             # [DISCONNECTED] ali (...)
+BYTES = re.compile(r"\((\d+) bytes\)")
+USER_TYPES = {"NEW USER", "CONNECTED", "NEW CONNECTION", "DISCONNECTED", "PRIVATE"}
+
+
+# helper: user, peer and bytes of an old text line
+def parse_fields(type_, text):
+    fields = {}
+    match = SENDER.match(text)
+    if match:
+        fields["user"], fields["peer"] = match.group(1), match.group(2)
+    elif USER_ADDR.match(text):
+        match = USER_ADDR.match(text)
+        fields["user"], fields["peer"] = match.group(1), f"{match.group(2)}:{match.group(3)}"
+    elif ADDR.match(text):
+        match = ADDR.match(text)
+        fields["peer"] = f"{match.group(1)}:{match.group(2)}"
+    elif type_ in USER_TYPES:
+        match = USER_ARROW.match(text) or USER_FIRST.match(text)
+        if match and match.group(1) != "Unknown":
+            fields["user"] = match.group(1)
+    match = BYTES.search(text)
+    if match:
+        fields["bytes"] = int(match.group(1))
+    return fields
+
+
+# text log -> event segments; returns the number of records written
+def convert(text_path, directory, batch=4096):
+    log = EventLog(directory)
+    pending = []
+    count = 0
+    with open(text_path, encoding="utf-8", errors="replace", newline="\n") as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            match = LINE.match(line)
+            if not match:
+                # continuation of a message with a newline in it
+                if pending and line:
+                    pending[-1]["text"] += "\n" + line
+                continue
+            when = time.mktime(time.strptime(match.group(1), "%Y-%m-%d %H:%M:%S"))
+            event = match.group(2)
+            pending.append(record(when, event, parse_fields(*split_tag(event))))
+            if len(pending) >= batch:
+                log.append(pending)
+                count += len(pending)
+                pending = []
+    if pending:
+        log.append(pending)
+        count += len(pending)
+    log.close()
+    return count
+
+
+# helper: a time on the command line: epoch seconds, "YYYY-mm-dd", "YYYY-mm-dd HH:MM" or "... HH:MM:SS"
+def parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"not a time: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query or build the structured server event log.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    q = commands.add_parser("query", help="events for a user and/or time range")
+    q.add_argument("--dir", default="events")
+    q.add_argument("--user")
+    q.add_argument("--since", type=parse_time)
+    q.add_argument("--until", type=parse_time)
+    q.add_argument("--type", action="append", help="event type, e.g. BROADCAST (repeatable)")
+    q.add_argument("--json", action="store_true", help="print the records as JSON lines")
+    c = commands.add_parser("convert", help="turn a text log into event segments")
+    c.add_argument("text_log")
+    c.add_argument("--dir", default="events")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        start = time.perf_counter()
+        count = convert(args.text_log, args.dir)
+        print(f"{count} events from {args.text_log} into {args.dir}/ in {time.perf_counter() - start:.2f}s")
+        return
+    out = sys.stdout
+    try:
+        for rec in query(args.dir, args.user, args.since, args.until, args.type):
+            out.write((json.dumps(rec, ensure_ascii=False) if args.json else format_record(rec)) + "\n")
+    except BrokenPipeError:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+# file_cache.py
+# Content-addressed cache of uploaded files on the server: sha256 -> file on disk.
+#
+# Uploads that announce the sha256 of the whole file (FLAG_CHECKSUM on
+# FILE_RESUME / FILE_PARALLEL) are looked up here first. On a hit the sender
+# has to prove it has the bytes (FILE_PROVE, a hash over a random range of the
+# cached copy), since a digest alone would let anyone who learned it fetch the
+# file; if it does, it uploads nothing and the server relays the cached copy
+# (file_relay.FilePump). On a miss, or a failed proof, the upload is written to
+# the cache while it is relayed, and kept only if its bytes really hash to the
+# announced digest, so one client can't plant content under another file's hash.
+#
+# The cache is off unless the server is given --file-cache-mb: it keeps copies
+# of relayed files, private transfers included, on the server's disk. It is
+# bounded by total bytes; the least recently used files are evicted first. The
+# index is rebuilt from the directory on first use.
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+from logger_utility import Logger
+
+logger = Logger()
+
+CACHE_DIR = "file_cache"
+CACHE_MAX_BYTES = 0             # --file-cache-mb; 0 (the default) disables the cache
+CACHE_MIN_SIZE = 64 * 1024      # smaller files aren't worth a disk round trip
+
+
+class CacheWriter:
+    """A file being added to the cache while it is relayed."""
+
+    def __init__(self, cache, digest, size):
+        self.cache = cache
+        self.digest = digest
+        self.size = size
+        self.hasher = hashlib.sha256()
+        self.written = 0
+        fd, self.temp_path = tempfile.mkstemp(dir=cache.directory, prefix=".incoming-", suffix=".part")
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.hasher.update(chunk)
+        self.written += len(chunk)
+
+    # keep the file if it is complete and matches its digest; returns True if it was kept
+    def commit(self):
+        self.file.close()
+        if self.written != self.size or self.hasher.digest() != self.digest:
+            logger.log_event(f"[FILE CACHE] digest mismatch for {self.digest.hex()[:16]}, not cached")
+            self.discard()
+            return False
+        self.cache._add(self)
+        return True
+
+    def discard(self):
+        try:
+            self.file.close()
+            os.remove(self.temp_path)
+        except:
+            pass
+
+
+class FileCache:
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, min_size=CACHE_MIN_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self.lock = threading.Lock()
+        self.entries = None             # digest -> size, least recently used first (loaded lazily)
+        self.total = 0
+
+        # stats
+        self.lookups = 0
+        self.hits = 0
+        self.bytes_saved = 0            # upload + download bytes that didn't have to move
+
+    def configure(self, directory=None, max_bytes=None):
+        with self.lock:
+            if directory is not None:
+                self.directory = directory
+                self.entries = None
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+
+    def enabled_for(self, size):
+        return self.max_bytes > 0 and self.min_size <= size <= self.max_bytes
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest.hex())
+
+    # ---------- lookups ----------
+
+    # an open binary file with the cached content, or None (counts as a lookup; record_hit() once it is served)
+    def open(self, digest, size):
+        if not self.enabled_for(size):
+            return None
+        with self.lock:
+            self._load()
+            self.lookups += 1
+            if self.entries.get(digest) != size:
+                return None
+            try:
+                # once open, eviction (unlink) can't pull the bytes from under the reader
+                f = open(self.path(digest), 'rb')
+            except OSError:
+                self._forget(digest)
+                return None
+            self.entries.move_to_end(digest)
+        return f
+
+    def record_hit(self, size):
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += size
+
+    # a CacheWriter for an upload that isn't cached yet, or None
+    def writer(self, digest, size):
+        if not self.enabled_for(size):
+            return None
+        with self.lock:
+            self._load()
+            if digest in self.entries:
+                return None
+        try:
+            return CacheWriter(self, digest, size)
+        except OSError as e:
+            logger.log_event(f"[FILE CACHE ERROR] {e}")
+            return None
+
+    def record_saved(self, nbytes):
+        with self.lock:
+            self.bytes_saved += nbytes
+
+    def stats(self):
+        with self.lock:
+            return {
+                "files": len(self.entries or ()),
+                "bytes": self.total,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+            }
+
+    def summary(self):
+        if self.max_bytes <= 0:
+            return "[SYSTEM] File cache is off (--file-cache-mb)."
+        s = self.stats()
+        return (f"[SYSTEM] File cache: {s['files']} files, {s['bytes'] / (1 << 20):.1f} MB, "
+                f"hit rate {s['hit_rate']:.0%} ({s['hits']}/{s['lookups']}), "
+                f"{s['bytes_saved'] / (1 << 20):.1f} MB not transferred")
+
+    # ---------- index ----------
+
+    def _add(self, writer):
+        path = self.path(writer.digest)
+        with self.lock:
+            self._load()
+            os.replace(writer.temp_path, path)
+            if writer.digest not in self.entries:
+                self.total += writer.size
+            self.entries[writer.digest] = writer.size
+            self.entries.move_to_end(writer.digest)
+            # evict least recently used files until we fit again
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                victim = next(iter(self.entries))
+                self._forget(victim)
+                try:
+                    os.remove(self.path(victim))
+                except OSError:
+                    pass
+                logger.log_event(f"[FILE CACHE] evicted {victim.hex()[:16]}")
+
+    def _forget(self, digest):
+        self.total -= self.entries.pop(digest, 0)
+
+    # build the index from the directory (oldest access first); call with the lock held
+    def _load(self):
+        if self.entries is not None:
+            return
+        self.entries = collections.OrderedDict()
+        self.total = 0
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".incoming-"):
+                # left over from an upload that was cut off when the server stopped
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                digest = bytes.fromhex(name)
+                st = os.stat(path)
+            except (ValueError, OSError):
+                continue
+            found.append((st.st_atime, digest, st.st_size))
+        for _, digest, size in sorted(found):
+            self.entries[digest] = size
+            self.total += size
@@ -0,0 +1,241 @@
+# file_relay.py
+# Cut-through file relay: an upload is forwarded to its recipient(s) chunk by
+# chunk as it arrives, instead of being buffered whole in server memory.
+import asyncio
+import itertools
+import threading
+import time
+import compression
+import frame_codec
+from frame_codec import FRAME, LINE
+from logger_utility import Logger
+
+logger = Logger()
+
+# bytes of one transfer that may wait in a recipient's outbound queue before the
+# sender is slowed down (--file-window-kb)
+FILE_WINDOW = 256 * 1024
+
+# stream ids for server -> client file transfers
+_stream_ids = itertools.count(1)
+
+# relays in progress whose recipients were told the file's digest, by stream id:
+# a recipient that already has the file answers FILE_HAVE and is skipped
+active_relays = {}
+
+PUMP_CHUNK = 256 * 1024     # bytes per chunk when relaying from a file on the server
+
+
+class FileRelay:
+    """
+    One file on its way from a sender to one or more recipients.
+
+    write() queues each received chunk for every recipient (encoded once per wire
+    protocol, the chunk itself is shared). Backpressure keeps at most `window`
+    bytes queued per recipient: the threaded server blocks the sender's reader in
+    wait(), the event-loop server stops reading from the sender while congested()
+    is non-empty. Memory per transfer is therefore bounded by the window, not by
+    the file size.
+
+    A ranged relay (parallel upload) takes chunks out of order through write_at(),
+    possibly from several reader threads at once, and forwards them with their
+    offset; only framed recipients can place them.
+
+    Recipients that negotiated compression get each chunk deflated (compressed
+    once, shared by all of them); the others get it raw.
+    """
+
+    def __init__(self, sender, recipient, filename, size, entries, window=FILE_WINDOW, ranged=False, digest=None):
+        self.stream_id = next(_stream_ids)
+        self.sender = sender
+        self.recipient = recipient      # as the sender named it (a username or "all")
+        self.filename = filename
+        self.size = size
+        self.window = window
+        self.received = 0
+        self.started = time.perf_counter()
+
+        self.targets = []       # registry entries still receiving
+        self.failed = []        # usernames the file could not be delivered to
+        self.busy = []          # newline-protocol recipients already receiving another file
+        self.unsupported = []   # newline-protocol recipients of a ranged relay
+        self.have = []          # recipients that already had the file (FILE_HAVE)
+        self.lock = threading.Lock()
+
+        for entry in entries:
+            if not entry.outbound:
+                continue
+            if ranged and entry.protocol == LINE:
+                self.unsupported.append(entry.username)
+                continue
+            # the newline protocol can't interleave a file with anything else
+            if entry.protocol == LINE and not entry.outbound.begin_stream(self):
+                self.busy.append(entry.username)
+                continue
+            header = frame_codec.encode_file_header(entry.protocol, self.stream_id, sender, filename, size, digest)
+            if entry.outbound.put(header, droppable=False, owner=self):
+                self.targets.append(entry)
+            else:
+                self._lost(entry)
+        if digest and self.targets:
+            active_relays[self.stream_id] = self
+        self.packer = None
+        if not ranged and any(entry.compression for entry in self.targets):
+            self.packer = compression.ChunkPacker(filename, size)
+
+    @property
+    def remaining(self):
+        return self.size - self.received
+
+    # forward one chunk (a buffer the relay may keep: recipient queues reference it).
+    # packed: the chunk as the sender already compressed it, if it did
+    def write(self, chunk, packed=None):
+        self.received += len(chunk)
+        if packed is None and self.packer:
+            packed = self.packer.pack(chunk)
+        encoded = {}
+        for entry in list(self.targets):
+            key = "packed" if packed is not None and entry.compression else entry.protocol
+            pieces = encoded.get(key)
+            if pieces is None:
+                if key == "packed":
+                    pieces = encoded[key] = frame_codec.encode_packed_file_data(self.stream_id, packed)
+                else:
+                    pieces = encoded[key] = frame_codec.encode_file_data(entry.protocol, self.stream_id, chunk)
+            if not entry.outbound.put(pieces, droppable=False, owner=self):
+                self._lost(entry)
+
+    # forward a chunk that belongs at `offset`; returns True once the whole file has been relayed
+    def write_at(self, offset, chunk):
+        with self.lock:
+            self.received += len(chunk)
+            pieces = frame_codec.encode_file_data_at(self.stream_id, offset, chunk)
+            for entry in list(self.targets):
+                if not entry.outbound.put(pieces, droppable=False, owner=self):
+                    self._lost(entry)
+            return not self.remaining
+
+    # threaded server: block until every recipient is back under the window
+    def wait(self):
+        for entry in list(self.targets):
+            if not entry.outbound.wait_below(self.window):
+                entry.outbound.abort("file relay stalled")
+                self._lost(entry)
+
+    # event-loop server: outbound queues currently over the window
+    def congested(self):
+        return [entry.outbound for entry in self.targets if entry.outbound.pending_bytes() > self.window]
+
+    # a recipient answered FILE_HAVE: stop sending it the rest; returns the bytes it was spared
+    def skip(self, entry):
+        with self.lock:
+            if entry not in self.targets:
+                return 0
+            self.targets.remove(entry)
+            self.have.append(entry.username)
+            return self.remaining
+
+    # all bytes relayed: release newline-protocol recipients; returns the usernames reached
+    def finish(self):
+        active_relays.pop(self.stream_id, None)
+        for entry in self.targets:
+            entry.outbound.end_stream(self)
+        return [entry.username for entry in self.targets] + self.have
+
+    # the sender went away mid-upload
+    def abort(self):
+        active_relays.pop(self.stream_id, None)
+        for entry in self.targets:
+            if entry.protocol == FRAME:
+                entry.outbound.put(frame_codec.encode_file_abort(self.stream_id), droppable=False)
+            else:
+                # its byte stream now expects data that will never come
+                entry.outbound.abort(f"file from {self.sender} interrupted")
+        self.targets = []
+
+    # the sender paused (a resumable upload was suspended, see transfer_spool.py): a
+    # newline-protocol recipient would have its connection held for the file's rest
+    # (its chat parked or dropped) for as long as the sender stays away, and nothing
+    # else can go into its byte stream meanwhile, so it is cut off as in abort().
+    # Framed recipients keep their partial file and wait for the resume.
+    def release_streams(self):
+        for entry in [entry for entry in self.targets if entry.protocol == LINE]:
+            self.targets.remove(entry)
+            self.failed.append(entry.username)
+            entry.outbound.abort(f"file from {self.sender} paused")
+            entry.outbound.end_stream(self)
+
+    def _lost(self, entry):
+        if entry in self.targets:
+            self.targets.remove(entry)
+        self.failed.append(entry.username)
+        entry.outbound.end_stream(self)
+        logger.log_event(f"[FILE SEND ERROR] {self.filename} from {self.sender}: {entry.username} disconnected")
+
+
+class FilePump:
+    """
+    Feeds a FileRelay from a file on the server (a file cache hit) instead of a
+    sender's connection, with the same backpressure: the threaded server pumps on
+    its own thread and waits in relay.wait(), the event-loop server pumps in loop
+    callbacks and waits for congested recipients to drain (ClientConnection calls
+    _recipient_drained, as for a throttled sender). on_done(relay) runs once the
+    file is relayed or nobody is left to receive it.
+    """
+
+    def __init__(self, relay, f, on_done, chunk_size=PUMP_CHUNK):
+        self.relay = relay
+        self.file = f
+        self.on_done = on_done
+        self.chunk_size = chunk_size
+        self.loop = None
+        self.waiting_on = set()
+
+    def start(self, threaded):
+        if threaded:
+            threading.Thread(target=self._run, daemon=True).start()
+        else:
+            self.loop = asyncio.get_running_loop()
+            self.loop.call_soon(self._step)
+
+    def _read(self):
+        chunk = self.file.read(min(self.chunk_size, self.relay.remaining))
+        if not chunk:
+            raise EOFError(f"cached copy of {self.relay.filename} is truncated")
+        return chunk
+
+    def _run(self):
+        relay = self.relay
+        try:
+            while relay.remaining and relay.targets:
+                relay.write(self._read())
+                relay.wait()
+        except Exception as e:
+            logger.log_event(f"[FILE SEND ERROR] {relay.filename} from the file cache: {e}")
+            relay.abort()
+        self._done()
+
+    def _step(self):
+        relay = self.relay
+        try:
+            while relay.remaining and relay.targets:
+                relay.write(self._read())
+                congested = relay.congested()
+                if congested:
+                    self.waiting_on = set(congested)
+                    for conn in congested:
+                        conn.drain_waiters.append(self)
+                    return
+        except Exception as e:
+            logger.log_event(f"[FILE SEND ERROR] {relay.filename} from the file cache: {e}")
+            relay.abort()
+        self._done()
+
+    def _recipient_drained(self, conn):
+        self.waiting_on.discard(conn)
+        if not self.waiting_on:
+            self.loop.call_soon(self._step)
+
+    def _done(self):
+        self.file.close()
+        self.on_done(self.relay)
@@ -0,0 +1,181 @@
+# file_upload.py
+# Upload engine used by client_handler.MessageHandler.send_file: streams a file
+# to the server as FILE_DATA frames.
+#
+# Two ways to move the bytes:
+#   sendfile  - the kernel copies straight from the page cache to the socket.
+#               Only possible when the kernel does the encryption: a plain TCP
+#               socket, or a TLS socket running on kernel TLS (kTLS).
+#   readinto  - user-space TLS: one large reusable buffer is filled with
+#               readinto() and sent as a memoryview, with the frame header
+#               written in front of the payload so each chunk is one sendall().
+#
+# Resumable uploads (checksum=True) put the sha256 of each chunk in front of it
+# (FLAG_CHECKSUM). The chunk is read to be hashed, but with sendfile only the
+# header and digest are written from Python: the body still goes from the page
+# cache to the socket, so the kernel keeps doing the encryption. Compressed
+# uploads (a compression.ChunkPacker) always take the readinto path: chunks that
+# shrink go out deflated (FLAG_COMPRESSED), the digest still covers the raw bytes.
+#
+# Parallel uploads (upload_ranges) split the file into chunk-aligned ranges and
+# send each over its own connection, so the TLS encryption of one file runs on
+# several cores; their chunks also carry their file offset (FLAG_OFFSET).
+import collections
+import hashlib
+import os
+import socket
+import ssl
+import threading
+import time
+from frame_codec import (DIGEST_SIZE, FILE_DATA, FLAG_CHECKSUM, FLAG_COMPRESSED, FLAG_OFFSET, HEADER, MAX_PAYLOAD,
+                         OFFSET, PROTOCOL_VERSION, chunk_digest, frame_header)
+
+UPLOAD_CHUNK = 256 * 1024       # bytes per FILE_DATA frame
+
+
+class UploadResult(collections.namedtuple("UploadResult", "bytes seconds method")):
+
+    @property
+    def mb_per_s(self):
+        return self.bytes / (1 << 20) / self.seconds if self.seconds else 0.0
+
+
+# True if file bytes can go from the page cache to the socket without passing through Python
+def can_sendfile(sock):
+    if not hasattr(os, "sendfile"):
+        return False
+    if isinstance(sock, ssl.SSLSocket):
+        # with kernel TLS the kernel encrypts what is written to the descriptor
+        uses_ktls = getattr(sock._sslobj, "uses_ktls_for_send", None)
+        return bool(uses_ktls and uses_ktls())
+    return sock.type == socket.SOCK_STREAM
+
+
+# send `size` bytes of the open binary file f as FILE_DATA frames of stream_id.
+# lock is taken per chunk, so chat and audio frames can go out in between.
+def upload(sock, f, size, stream_id, lock, chunk_size=UPLOAD_CHUNK, use_sendfile=None, checksum=False,
+           packer=None):
+    chunk_size = clamp_chunk(chunk_size, checksum)
+    if packer:
+        use_sendfile = False
+    elif use_sendfile is None:
+        use_sendfile = can_sendfile(sock)
+
+    start = time.perf_counter()
+    if use_sendfile:
+        _upload_sendfile(sock, f, size, stream_id, lock, chunk_size, checksum)
+        method = "sendfile"
+    else:
+        _upload_readinto(sock, f, size, stream_id, lock, chunk_size, checksum, packer=packer)
+        method = "readinto+zlib" if packer and packer.saved else "readinto"
+    return UploadResult(size, time.perf_counter() - start, method)
+
+
+# sha256 of a whole file, announced with an upload so the server can deduplicate it
+def file_digest(path):
+    hasher = hashlib.sha256()
+    buf = bytearray(1 << 20)
+    view = memoryview(buf)
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                return hasher.digest()
+            hasher.update(view[:n])
+
+
+# largest chunk that still fits one frame
+def clamp_chunk(chunk_size, checksum=False, ranged=False):
+    return max(1, min(chunk_size, MAX_PAYLOAD - (DIGEST_SIZE if checksum else 0) - (OFFSET.size if ranged else 0)))
+
+
+# send [0, size) of the file at path as `streams` ranges in parallel, each over a
+# connection from connect() (already attached to the transfer). Returns the
+# connections still open: the server treats a data connection that closes before
+# the whole file has arrived as a failed transfer.
+def upload_ranges(connect, path, size, chunk_size, streams):
+    if not size:
+        return []
+    chunk_size = clamp_chunk(chunk_size, checksum=True, ranged=True)
+    chunks = -(-size // chunk_size)
+    per_range = -(-chunks // max(1, streams)) * chunk_size
+    socks = []
+    errors = []
+
+    def send_range(start, end):
+        try:
+            sock = connect()
+            socks.append(sock)
+            with open(path, 'rb') as f:
+                f.seek(start)
+                _upload_readinto(sock, f, end - start, 1, threading.Lock(), chunk_size, checksum=True, ranged=True)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=send_range, args=(start, min(start + per_range, size)), daemon=True)
+               for start in range(0, size, per_range)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        for sock in socks:
+            sock.close()
+        raise errors[0]
+    return socks
+
+
+def _upload_sendfile(sock, f, size, stream_id, lock, chunk_size, checksum=False):
+    offset = f.tell()
+    end = offset + size
+    # checksum: each chunk is read once to be hashed (the reusable buffer is never sent)
+    buf = bytearray(chunk_size) if checksum else None
+    while offset < end:
+        n = min(chunk_size, end - offset)
+        if checksum:
+            f.seek(offset)
+            if f.readinto(memoryview(buf)[:n]) != n:
+                raise EOFError("File shrank while sending")
+            header = frame_header(FILE_DATA, DIGEST_SIZE + n, stream_id, FLAG_CHECKSUM) + chunk_digest(
+                memoryview(buf)[:n])
+        else:
+            header = frame_header(FILE_DATA, n, stream_id)
+        with lock:
+            # one frame in two writes: header (+ digest) from here, the body by the kernel
+            sock.sendall(header)
+            # socket.socket.sendfile, not SSLSocket.sendfile: that one always copies
+            # through user space, while on kTLS the descriptor can take the file directly
+            if socket.socket.sendfile(sock, f, offset, n) != n:
+                raise EOFError("File shrank while sending")
+        offset += n
+
+
+def _upload_readinto(sock, f, size, stream_id, lock, chunk_size, checksum=False, ranged=False, packer=None):
+    # payload prefix: [offset] [digest]
+    digest_at = HEADER.size + (OFFSET.size if ranged else 0)
+    prefix = digest_at + (DIGEST_SIZE if checksum else 0)
+    buf = bytearray(prefix + chunk_size)
+    view = memoryview(buf)
+    payload = view[prefix:]
+    flags = (FLAG_CHECKSUM if checksum else 0) | (FLAG_OFFSET if ranged else 0)
+    sent = 0
+    while sent < size:
+        offset = f.tell()
+        n = f.readinto(payload[:min(chunk_size, size - sent)])
+        if not n:
+            raise EOFError("File shrank while sending")
+        HEADER.pack_into(buf, 0, PROTOCOL_VERSION, FILE_DATA, flags, stream_id, prefix - HEADER.size + n)
+        if ranged:
+            OFFSET.pack_into(buf, HEADER.size, offset)
+        if checksum:
+            buf[digest_at:prefix] = chunk_digest(payload[:n])
+        packed = packer.pack(payload[:n]) if packer else None
+        if packed is not None:
+            HEADER.pack_into(buf, 0, PROTOCOL_VERSION, FILE_DATA, flags | FLAG_COMPRESSED, stream_id,
+                             prefix - HEADER.size + len(packed))
+            with lock:
+                sock.sendall(bytes(view[:prefix]) + packed)
+        else:
+            with lock:
+                sock.sendall(view[:prefix + n])
+        sent += n
@@ -0,0 +1,250 @@
+# frame_codec.py
+# Length-prefixed framing shared by the server (message_handler.py) and the
+# client (client_handler.py).
+#
+# Every frame is a 12-byte header followed by the payload:
+#
+#   version u8 | type u8 | flags u16 | stream id u32 | payload length u32 | payload
+#
+# Chat text, file bytes and audio each travel in their own frame type, so they can
+# be interleaved on one connection and are never confused with each other.
+# Files use a stream id so several transfers can be in flight at once.
+#
+# Negotiation: a framed client starts with PREAMBLE followed by a HELLO frame whose
+# payload is "username" plus optional "key=value" lines; the server answers with a
+# HELLO frame carrying the (possibly de-duplicated) username. A client that just
+# sends a bare username speaks the legacy newline protocol instead. Hello options
+# also negotiate compression (see compression.py) and latency tracing (see tracing.py).
+import collections
+import hashlib
+import struct
+from receive_buffer import ReceiveBuffer
+
+PROTOCOL_VERSION = 1
+PREAMBLE = b"\x00CCNF"
+
+HEADER = struct.Struct("!BBHII")
+MAX_PAYLOAD = 1 << 20       # larger file data is split across frames
+MAX_HELLO = 4096
+
+# frame types
+HELLO = 0
+TEXT = 1          # UTF-8 chat line or command (/pm, /list, /call_*, /quit ...)
+FILE_META = 2     # client -> server: "recipient size filename"; server -> client: "sender size filename"
+FILE_DATA = 3     # file bytes of the transfer named by stream id
+AUDIO = 4         # PCM audio while in a call
+FILE_RESUME = 5   # client -> server: "transfer_id key recipient size chunk_size filename", starts or resumes
+                  # a checksummed upload; only the same key (the client's secret for it) can resume it
+FILE_ACK = 6      # server -> client: "transfer_id offset [digest of the last chunk, hex]"
+FILE_PARALLEL = 7 # client -> server: same payload as FILE_RESUME without the key; the file's ranges then arrive over
+                  # extra connections whose hello carries "transfer=<transfer_id>"
+FILE_HAVE = 8     # client -> server: "I already have the file of this stream id (by its digest), stop sending it"
+FILE_PROVE = 9    # server -> client: "transfer_id offset length nonce(hex)": the announced file is cached,
+                  # prove you have it; client -> server: "transfer_id proof(hex)", see possession_proof()
+TRACE = 10        # client -> server: a traced message was displayed (tracing.REPORT)
+
+# flags
+FLAG_ABORT = 1    # FILE_DATA: the transfer was cancelled, discard what arrived of it
+FLAG_CHECKSUM = 2 # FILE_DATA: payload = sha256 digest of the chunk + the chunk
+                  # FILE_META / FILE_RESUME / FILE_PARALLEL: payload starts with the sha256 of the whole file
+FLAG_OFFSET = 4   # FILE_DATA: payload starts with the chunk's file offset (u64), before any digest
+FLAG_COMPRESSED = 8  # TEXT: payload from the connection's deflate stream
+                     # FILE_DATA: the chunk (after any digest) deflated on its own
+FLAG_TRACE = 16   # TEXT: client -> server: payload starts with tracing.SENT; server -> client: with the trace id (u64)
+
+DIGEST_SIZE = hashlib.sha256().digest_size
+OFFSET = struct.Struct("!Q")
+TRACE_ID = struct.Struct("!Q")
+
+# wire protocols a connection can speak
+LINE = "line"     # legacy: newline-terminated text, raw file bytes and raw audio
+FRAME = "frame"
+
+Frame = collections.namedtuple("Frame", "type flags stream_id payload")
+
+
+class FrameError(Exception):
+    pass
+
+
+def frame_header(ftype, length, stream_id=0, flags=0):
+    return HEADER.pack(PROTOCOL_VERSION, ftype, flags, stream_id, length)
+
+
+def encode_frame(ftype, payload=b"", stream_id=0, flags=0):
+    return frame_header(ftype, len(payload), stream_id, flags) + payload
+
+
+# ---------- negotiation ----------
+
+def client_hello(username, options=None):
+    lines = [username] + [f"{k}={v}" for k, v in (options or {}).items()]
+    return PREAMBLE + encode_frame(HELLO, "\n".join(lines).encode('utf-8'))
+
+
+def server_hello(username, options=None):
+    lines = [username] + [f"{k}={v}" for k, v in (options or {}).items()]
+    return encode_frame(HELLO, "\n".join(lines).encode('utf-8'))
+
+
+def parse_hello_payload(payload):
+    lines = payload.decode('utf-8', errors='ignore').split("\n")
+    options = {}
+    for line in lines[1:]:
+        key, _, value = line.partition("=")
+        if key:
+            options[key.strip()] = value.strip()
+    return lines[0].strip(), options
+
+
+# Parse the first bytes a client sent.
+# Returns None while a framed hello is still incomplete, otherwise
+# (protocol, username, options, leftover bytes that follow the hello).
+def parse_client_hello(data):
+    if not data.startswith(PREAMBLE):
+        if PREAMBLE.startswith(data):
+            return None
+        return LINE, data.decode('utf-8', errors='ignore').strip(), {}, b""
+
+    start = len(PREAMBLE)
+    if len(data) < start + HEADER.size:
+        return None
+    version, ftype, _, _, length = HEADER.unpack_from(data, start)
+    if version != PROTOCOL_VERSION or ftype != HELLO or length > MAX_HELLO:
+        raise FrameError("Bad client hello")
+    end = start + HEADER.size + length
+    if len(data) < end:
+        return None
+    username, options = parse_hello_payload(data[start + HEADER.size:end])
+    return FRAME, username, options, data[end:]
+
+
+# ---------- encoding for a given wire protocol ----------
+# Each encoder returns a tuple of buffers that together form one message; an
+# outbound queue keeps them together so a frame header never goes out without its payload.
+
+# trace_id: a traced message for a client that negotiated tracing (FLAG_TRACE, never compressed)
+def encode_text(protocol, text, trace_id=None):
+    data = text.encode('utf-8')
+    if protocol == FRAME:
+        if trace_id is not None:
+            return (encode_frame(TEXT, TRACE_ID.pack(trace_id) + data, flags=FLAG_TRACE),)
+        return (encode_frame(TEXT, data),)
+    return (data + b"\n",)
+
+
+def encode_audio(protocol, chunk):
+    if protocol == FRAME:
+        return (frame_header(AUDIO, len(chunk)), chunk)
+    return (chunk,)
+
+
+# files are relayed as a header followed by any number of data chunks
+def encode_file_header(protocol, stream_id, sender, filename, size, digest=None):
+    if protocol == FRAME:
+        meta = f"{sender} {size} {filename}".encode('utf-8')
+        if digest:
+            return (encode_frame(FILE_META, digest + meta, stream_id, FLAG_CHECKSUM),)
+        return (encode_frame(FILE_META, meta, stream_id),)
+    return (f"[FILE] {sender} {filename} {size}\n".encode('utf-8'),)
+
+
+def encode_file_data(protocol, stream_id, chunk):
+    if protocol != FRAME:
+        return (chunk,)
+    pieces = []
+    view = memoryview(chunk)
+    for offset in range(0, len(view), MAX_PAYLOAD):
+        part = view[offset:offset + MAX_PAYLOAD]
+        pieces.append(frame_header(FILE_DATA, len(part), stream_id))
+        pieces.append(part)
+    return tuple(pieces)
+
+
+# a chunk that belongs at `offset` (parallel uploads arrive out of order); framed recipients only
+def encode_file_data_at(stream_id, offset, chunk):
+    return (frame_header(FILE_DATA, OFFSET.size + len(chunk), stream_id, FLAG_OFFSET) + OFFSET.pack(offset), chunk)
+
+
+# a chunk deflated on its own (compression.ChunkPacker); framed recipients that negotiated compression only
+def encode_packed_file_data(stream_id, packed):
+    return (frame_header(FILE_DATA, len(packed), stream_id, FLAG_COMPRESSED), packed)
+
+
+def encode_file_abort(stream_id):
+    return (frame_header(FILE_DATA, 0, stream_id, FLAG_ABORT),)
+
+
+# ---------- resumable uploads ----------
+
+def chunk_digest(data):
+    return hashlib.sha256(data).digest()
+
+
+def encode_file_ack(transfer_id, offset, digest=b""):
+    text = f"{transfer_id} {offset} {digest.hex()}".rstrip()
+    return (encode_frame(FILE_ACK, text.encode('utf-8')),)
+
+
+def parse_file_ack(payload):
+    parts = str(payload, 'utf-8', errors='ignore').split(" ")
+    return parts[0], int(parts[1]), bytes.fromhex(parts[2]) if len(parts) > 2 else b""
+
+
+# a cache hit is only served to a sender that knows the file's bytes, not just its digest:
+# the server picks a random range and nonce, the sender answers with sha256(nonce + range)
+def possession_proof(nonce, data):
+    return hashlib.sha256(nonce + data).digest()
+
+
+def encode_file_challenge(transfer_id, offset, length, nonce):
+    return (encode_frame(FILE_PROVE, f"{transfer_id} {offset} {length} {nonce.hex()}".encode('utf-8')),)
+
+
+def parse_file_challenge(payload):
+    parts = str(payload, 'utf-8', errors='ignore').split(" ")
+    return parts[0], int(parts[1]), int(parts[2]), bytes.fromhex(parts[3])
+
+
+def encode_file_proof(transfer_id, proof):
+    return (encode_frame(FILE_PROVE, f"{transfer_id} {proof.hex()}".encode('utf-8')),)
+
+
+def parse_file_proof(payload):
+    parts = str(payload, 'utf-8', errors='ignore').split(" ")
+    return parts[0], bytes.fromhex(parts[1])
+
+
+# ---------- decoding ----------
+
+class FrameDecoder:
+    """
+    Incremental decoder: feed() or recv_into() received bytes, then iterate frames().
+    With copy=False payloads are memoryviews into the receive buffer, valid only
+    until the next feed()/recv_into() (for consumers that use them right away).
+    """
+
+    def __init__(self, copy=True):
+        self.buffer = ReceiveBuffer()
+        self.copy = copy
+
+    def feed(self, data):
+        self.buffer.feed(data)
+
+    # receive straight from the socket into the decode buffer; returns the count (0 = EOF)
+    def recv_into(self, sock):
+        return self.buffer.recv_into(sock)
+
+    def frames(self):
+        buf = self.buffer
+        while len(buf) >= HEADER.size:
+            version, ftype, flags, stream_id, length = HEADER.unpack_from(buf.peek(HEADER.size))
+            if version != PROTOCOL_VERSION:
+                raise FrameError(f"Unsupported protocol version {version}")
+            if length > MAX_PAYLOAD:
+                raise FrameError(f"Frame too large ({length} bytes)")
+            if len(buf) < HEADER.size + length:
+                break
+            buf.skip(HEADER.size)
+            payload = buf.read(length)
+            yield Frame(ftype, flags, stream_id, bytes(payload) if self.copy else payload)
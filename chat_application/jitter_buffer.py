@@ -0,0 +1,237 @@
+# jitter_buffer.py
+# Playout buffer for call audio on the client.
+#
+# Received chunks are put() in by the receive side in whatever order and at
+# whatever pace the network delivers them; a playback thread pop()s one chunk
+# per chunk duration (the audio device's blocking write sets the pace). Chunks
+# are ordered by their RTP-style timestamp (in samples, see media.py); AUDIO
+# frames over the chat connection have none and are numbered in arrival order.
+#
+# The buffer holds back about `target` seconds of audio: enough to cover the
+# TARGET_QUANTILE of how late packets arrived relative to the earliest one
+# (over the last HISTORY packets), kept between min_delay and max_delay:
+#   - missing chunk, later ones already here: lost (or hopelessly reordered);
+#     concealed and skipped. If the buffer had run dry waiting for it, the
+#     underrun concealment already took its place, so it is skipped right away
+#     instead of being concealed twice.
+#   - nothing buffered at all: the stream is late; concealed *without* moving
+#     the playout point, so the delay grows by one chunk (a jitter spike makes
+#     the buffer deeper). After MAX_CONCEAL such chunks the sender has probably
+#     gone quiet: play silence and buffer up `target` again before resuming.
+#   - more than target + SHRINK_MARGIN buffered for ADAPT_EVERY chunks in a
+#     row (the least depth over them, so a burst that is about to drain again
+#     doesn't count): one chunk is dropped, until the delay is back at target.
+#     Past max_delay over target it is dropped right away.
+# A chunk that arrives after its turn is dropped as late.
+#
+# Concealment repeats the last chunk at decreasing volume, then falls back to silence.
+#
+# A sender that suppresses silence (voice_activity.py) says so with a comfort
+# noise level: from that timestamp on, running dry is the end of a talkspurt
+# rather than an underrun. The buffer plays noise at that level instead of
+# silence and buffers up again for the next talkspurt.
+import array
+import collections
+import random
+import threading
+import time
+import voice_activity
+
+SAMPLE_WIDTH = 2                # 16-bit mono PCM
+MAX_CONCEAL = 8                 # consecutive concealed chunks before re-buffering
+CONCEAL_GAIN = 0.6              # volume of each repeat relative to the one before
+CONCEAL_REPEATS = 3             # repeats before concealment is silence
+SHRINK_MARGIN = 2               # chunks over target before the buffer drops one
+ADAPT_EVERY = 16                # chunks the surplus must last before one is dropped
+HISTORY = 500                   # packets the target is computed over (about 12 s of 44.1 kHz chunks)
+TARGET_QUANTILE = 0.97          # share of packets the delay should be enough for
+RETARGET_EVERY = 16             # packets between two target updates
+
+
+class JitterBuffer:
+    def __init__(self, rate, chunk, min_delay=0.04, max_delay=0.4):
+        self.rate = rate
+        self.chunk = chunk              # samples per chunk, until packets say otherwise
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.target = min_delay         # seconds of audio held back
+        self.jitter = 0.0               # seconds (RFC 3550 interarrival jitter, for the summary)
+        self.transit = collections.deque(maxlen=HISTORY)   # arrival - send time (+ a constant) per packet
+        self.lock = threading.Lock()
+
+        self.packets = {}               # timestamp (unwrapped) -> pcm
+        self.newest = None              # highest timestamp received
+        self.next_ts = None             # timestamp to play next; None while buffering
+        self.floor = 0                  # anything older has been played or given up on
+        self.last = None                # last chunk played, for concealment
+        self.concealing = 0             # chunks concealed in a row
+        self.stalled = 0                # of those, underruns (the playout point waited)
+        self.since_drop = 0
+        self.low = None                 # least depth since the last drop check
+        self.prev = None                # (arrival, timestamp) of the previous packet
+        self.comfort = None             # comfort noise level (-dBov) while the sender is silent
+        self.comfort_from = None        # timestamp the sender went silent at
+        self.rng = random.Random()
+
+        # counters
+        self.received = 0
+        self.played = 0
+        self.late = 0
+        self.duplicates = 0
+        self.lost = 0                   # concealed because the chunk never came
+        self.underruns = 0              # concealed because nothing was buffered
+        self.dropped = 0                # dropped to bring the delay down
+        self.comfort_played = 0         # chunks of comfort noise while the sender was silent
+
+    # ---------- receive side ----------
+
+    # timestamp: 32-bit from the packet, or None to follow the newest chunk
+    def put(self, pcm, timestamp=None, arrival=None):
+        if arrival is None:
+            arrival = time.monotonic()
+        samples = len(pcm) // SAMPLE_WIDTH
+        if not samples:
+            return
+        if len(pcm) % SAMPLE_WIDTH:
+            pcm = pcm[:samples * SAMPLE_WIDTH]
+        with self.lock:
+            self.received += 1
+            ts = self._unwrap(timestamp)
+            self.chunk = samples
+            self._update_jitter(arrival, ts)
+
+            if ts < self.floor or (self.next_ts is not None and ts < self.next_ts):
+                self.late += 1
+                return
+            if ts in self.packets:
+                self.duplicates += 1
+                return
+            self.packets[ts] = pcm
+            if self.newest is None or ts > self.newest:
+                self.newest = ts
+
+    # the sender went silent at timestamp (None: after the newest chunk) with background noise at level
+    def comfort_noise(self, level, timestamp=None):
+        with self.lock:
+            self.comfort = level
+            self.comfort_from = self._unwrap(timestamp)
+
+    # helper: a packet's 32-bit timestamp as a position in the stream (None: the chunk after the newest)
+    def _unwrap(self, timestamp):
+        if timestamp is None:
+            return 0 if self.newest is None else self.newest + self.chunk
+        if self.newest is None:
+            return timestamp
+        # 32-bit wraparound: the timestamp closest to the newest one
+        return self.newest + ((timestamp - self.newest + (1 << 31)) % (1 << 32)) - (1 << 31)
+
+    def _update_jitter(self, arrival, ts):
+        if self.prev:
+            prev_arrival, prev_ts = self.prev
+            d = (arrival - prev_arrival) - (ts - prev_ts) / self.rate
+            self.jitter += (abs(d) - self.jitter) / 16
+        self.prev = (arrival, ts)
+
+        self.transit.append(arrival - ts / self.rate)
+        if len(self.transit) % RETARGET_EVERY == 0 or len(self.transit) == HISTORY:
+            ordered = sorted(self.transit)
+            spread = ordered[int((len(ordered) - 1) * TARGET_QUANTILE)] - ordered[0]
+            wanted = self.chunk / self.rate + spread
+            self.target = max(self.min_delay, min(self.max_delay, wanted))
+
+    # ---------- playback side ----------
+
+    # seconds of audio buffered ahead of the playout point
+    def depth(self):
+        with self.lock:
+            return self._depth()
+
+    def _depth(self):
+        if not self.packets:
+            return 0.0
+        start = self.next_ts if self.next_ts is not None else min(self.packets)
+        return (self.newest + self.chunk - start) / self.rate
+
+    # next chunk to play: (timestamp, pcm), timestamp None for concealment or silence
+    def pop(self):
+        with self.lock:
+            if self.next_ts is None:
+                if not self.packets or self._depth() < self.target:
+                    return None, self._silence()
+                self.next_ts = min(self.packets)
+
+            # too much buffered for ADAPT_EVERY chunks in a row: drop a chunk (right away if way over)
+            self.since_drop += 1
+            depth = self._depth()
+            self.low = depth if self.low is None else min(self.low, depth)
+            way_over = depth > self.max_delay + self.target
+            if self.since_drop >= ADAPT_EVERY or way_over:
+                over = (depth if way_over else self.low) - self.target - SHRINK_MARGIN * self.chunk / self.rate
+                self.since_drop = 0
+                self.low = None
+                pcm = self.packets.pop(self.next_ts, None) if over > 0 else None
+                if pcm is not None:
+                    self.dropped += 1
+                    self.next_ts += len(pcm) // SAMPLE_WIDTH
+
+            pcm = self.packets.pop(self.next_ts, None)
+            while pcm is None and self.stalled and self.packets:
+                # a later chunk came and this one didn't: it is lost, and the concealment played
+                # while we waited for it already filled its place, so it is skipped without another
+                self.stalled -= 1
+                self.next_ts += self.chunk
+                self.floor = self.next_ts
+                pcm = self.packets.pop(self.next_ts, None)
+            if pcm is not None:
+                ts = self.next_ts
+                if self.comfort is not None and ts >= self.comfort_from:
+                    # the next talkspurt has started
+                    self.comfort = None
+                self.next_ts += len(pcm) // SAMPLE_WIDTH
+                self.floor = self.next_ts
+                self.last = pcm
+                self.concealing = self.stalled = 0
+                self.played += 1
+                return ts, pcm
+
+            if self.comfort is not None and self.next_ts >= self.comfort_from:
+                # the sender said it went silent: comfort noise until the next talkspurt buffers up
+                self.next_ts = None
+                self.last = None
+                self.concealing = self.stalled = 0
+                return None, self._silence()
+            if self.packets:
+                # a later chunk is here: this one is lost
+                self.lost += 1
+                self.next_ts += self.chunk
+                self.floor = self.next_ts
+            else:
+                # nothing here: wait for it (the delay grows), or start over if the sender went quiet
+                self.underruns += 1
+                if self.concealing >= MAX_CONCEAL:
+                    self.next_ts = None
+                    self.last = None
+                    self.concealing = self.stalled = 0
+                    return None, self._silence()
+                self.stalled += 1
+            self.concealing += 1
+            return None, self._conceal()
+
+    def _silence(self):
+        if self.comfort is not None:
+            self.comfort_played += 1
+            return voice_activity.comfort_noise(self.comfort, self.chunk, self.rng)
+        return bytes(self.chunk * SAMPLE_WIDTH)
+
+    def _conceal(self):
+        if self.last is None or self.concealing > CONCEAL_REPEATS:
+            return self._silence()
+        gain = CONCEAL_GAIN ** self.concealing
+        samples = array.array("h")
+        samples.frombytes(self.last)
+        return array.array("h", [int(s * gain) for s in samples]).tobytes()
+
+    def summary(self):
+        return (f"{self.played} chunks played, {self.lost} lost, {self.underruns} underruns, {self.late} late, "
+                f"{self.dropped} dropped, {self.comfort_played} comfort noise, jitter {self.jitter * 1000:.1f} ms, "
+                f"delay {self.target * 1000:.0f} ms")
@@ -1,18 +1,392 @@
+# logger_utility.py
+# Server event log.
+#
+# log_event() only stamps the event and appends it to an in-memory queue, so a
+# handler thread pays microseconds per line. One background writer per log file
+# drains the queue: it formats the lines, writes them in one batch to a file it
+# keeps open, echoes them to stdout, and flushes once FLUSH_LINES lines are
+# waiting or FLUSH_INTERVAL seconds have passed. When the file would grow past
+# max_bytes it is rotated: server_log.txt -> server_log.txt.1 -> ... (backups
+# files are kept).
+#
+# The queue holds at most max_queue lines. When it is full the policy decides:
+#   drop  - the line is discarded and counted; the next batch says how many
+#   block - the caller waits (up to BLOCK_TIMEOUT seconds) for the writer
+# Queued lines are written out when the interpreter exits.
+#
+# With an event directory set (configure(events=...)) the writer also appends
+# each event as a structured record (event_log.py); log_event() then takes the
+# record's fields as keywords: user, peer, bytes, latency.
+#
+# Before anything is queued, an event is filtered by its [TAG]: each tag has a
+# level (level_of(): ERROR for tags with ERROR in them, WARNING for the tags in
+# WARNING_TAGS, INFO otherwise, or what configure(levels=...) says), and tags
+# below the configured level are skipped. What passes can be sampled:
+# configure(sample={"BROADCAST": 0.01}) keeps 1% of [BROADCAST] events. The
+# decision per tag is cached, so it costs a dict lookup. Callers on hot paths
+# pass the event as a %-template plus its arguments,
+#   logger.log_event("[BROADCAST] %s", full_msg)
+# and the line is only formatted, on the writer thread, if it is kept.
 from datetime import datetime
+import atexit
+import collections
+import os
+import random
+import sys
 import threading
+import time
+import event_log
+
+LOG_POLICIES = ("drop", "block")
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+WARNING_TAGS = {"SLOW CLIENT", "HANDSHAKE TIMEOUT", "FILE EXPIRED", "FILE SUSPENDED"}
+
+FLUSH_LINES = 256               # wake the writer once this many lines are waiting
+FLUSH_INTERVAL = 0.5            # seconds a line waits at most before it is written
+BLOCK_TIMEOUT = 5.0             # seconds a caller waits for room with the block policy
+
+# defaults for every log file, see configure()
+settings = {
+    "max_queue": 100000,        # lines
+    "policy": "drop",
+    "max_bytes": 10 << 20,      # rotate past this size (0: never)
+    "backups": 5,               # rotated files kept
+    "echo": True,               # copy lines to stdout
+    "events": None,             # directory for structured event records (None: text only)
+}
+
+# which events are logged, see configure() and the top of this file
+filters = {
+    "level": INFO,              # lowest level logged
+    "levels": {},               # tag -> level, overriding level_of()
+    "sample": {},               # tag -> share of its events kept (0.0 - 1.0)
+}
+_rates = {}                     # tag -> share kept after level and sampling (0.0 skips it), filled on use
+
+_writers = {}                   # absolute path -> LogWriter
+_event_logs = {}                # absolute directory -> event_log.EventLog, shared by the writers
+_writers_lock = threading.Lock()
+
+
+class LogWriter:
+    """Queue and background writer for one log file, shared by every Logger of that file."""
+
+    def __init__(self, path, max_queue, policy, max_bytes, backups, echo, events):
+        if policy not in LOG_POLICIES:
+            raise ValueError(f"Unknown log policy: {policy}")
+        self.path = path
+        self.max_queue = max_queue
+        self.policy = policy
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.echo = echo
+        self.events = events
+
+        # (time, event, args, fields) appended by any thread, popped by the writer;
+        # (None, threading.Event, (), None) is a flush() waiting for the lines before it
+        self.lines = collections.deque()
+        self.wake = threading.Event()
+        self.room = threading.Condition()   # blocked callers wait here for the writer
+        self.write_lock = threading.Lock()  # the writer's; taken by callers only after close()
+        self.file = None
+        self.size = 0
+        self.closed = False
+
+        # counters
+        self.written = 0
+        self.dropped = 0                    # not locked: a rare lost increment only skews the count
+        self.reported = 0                   # drops already noted in the log
+        self.rotations = 0
+
+        # second -> "[YYYY-mm-dd HH:MM:SS] " for the last stamp formatted
+        self.stamp_second = None
+        self.stamp = ""
+
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f"log-{os.path.basename(path)}")
+        self.thread.start()
+
+    # queue one event (args: for its %-template; fields: for its structured record).
+    # False if it was dropped
+    def put(self, event, args=(), fields=None):
+        lines = self.lines
+        if len(lines) >= self.max_queue and not self.closed:
+            self.wake.set()
+            if self.policy == "drop":
+                self.dropped += 1
+                return False
+            with self.room:
+                self.room.wait_for(lambda: len(lines) < self.max_queue or self.closed, BLOCK_TIMEOUT)
+        lines.append((time.time(), event, args, fields))
+        if len(lines) >= FLUSH_LINES:
+            self.wake.set()
+        if self.closed:
+            self._write_batch()
+        return True
+
+    # wait until everything queued so far is on disk
+    def flush(self, timeout=5.0):
+        if self.closed or threading.current_thread() is self.thread:
+            return
+        done = threading.Event()
+        self.lines.append((None, done, (), None))
+        self.wake.set()
+        done.wait(timeout)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wake.set()
+        self.thread.join(timeout=5.0)
+        self._write_batch()
+        with self.room:
+            self.room.notify_all()
+        with self.write_lock:
+            self._close_file()
+
+    def stats(self):
+        return {
+            "queued": len(self.lines),
+            "written": self.written,
+            "dropped": self.dropped,
+            "rotations": self.rotations,
+            "bytes": self.size,
+        }
+
+    # ---------- writer thread ----------
+
+    def _run(self):
+        while not self.closed:
+            self.wake.wait(FLUSH_INTERVAL)
+            self.wake.clear()
+            self._write_batch()
+
+    # helper: "[timestamp] " for a time, formatted once per second
+    def _stamp(self, when):
+        second = int(when)
+        if second != self.stamp_second:
+            self.stamp_second = second
+            self.stamp = datetime.fromtimestamp(second).strftime("[%Y-%m-%d %H:%M:%S] ")
+        return self.stamp
+
+    def _write_batch(self):
+        with self.write_lock:
+            waiting = []
+            try:
+                self._write_lines(waiting)
+            except Exception as e:
+                # keep logging alive (e.g. disk full); the lines of this batch are lost
+                sys.stderr.write(f"[LOG ERROR] {self.path}: {e}\n")
+                self._close_file()
+            for done in waiting:
+                done.set()
+
+    # helper: everything queued into the file; flush() events met on the way go into waiting
+    def _write_lines(self, waiting):
+        lines = self.lines
+        out = []
+        records = [] if self.events else None
+        while lines:
+            when, event, args, fields = lines.popleft()
+            if when is None:
+                waiting.append(event)
+                continue
+            if args:
+                try:
+                    event = event % args
+                except Exception:
+                    event = f"{event} {args!r}"
+            out.append(f"{self._stamp(when)}{event}\n")
+            if records is not None:
+                records.append(event_log.record(when, event, fields))
+        if self.policy == "block":
+            with self.room:
+                self.room.notify_all()
+        dropped = self.dropped - self.reported
+        if dropped:
+            self.reported += dropped
+            out.append(f"{self._stamp(time.time())}[LOG] {dropped} lines dropped (log queue full)\n")
+        if records:
+            event_log_for(self.events).append(records)
+        if not out:
+            return
+        text = "".join(out)
+        if self.echo:
+            try:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            except:
+                pass
+        data = text.encode("utf-8")
+        if self.file is None:
+            self._open_file()
+        elif self.max_bytes and self.size and self.size + len(data) > self.max_bytes:
+            self._rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+        self.written += len(out)
+
+    # helper: open the log for appending, kept open until it is rotated
+    def _open_file(self):
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+        if self.max_bytes and self.size >= self.max_bytes:
+            self._rotate()
+
+    # helper: server_log.txt.(n-1) -> .n, ..., server_log.txt -> .1, start a new one
+    def _rotate(self):
+        self._close_file()
+        if self.backups > 0:
+            for n in range(self.backups - 1, 0, -1):
+                src = f"{self.path}.{n}"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.path}.{n + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+        self.file = open(self.path, "ab")
+        self.size = 0
+
+    def _close_file(self):
+        if self.file:
+            try:
+                self.file.close()
+            except:
+                pass
+        self.file = None
+
+
+# helper: the writer of a log file, started on first use
+def writer_for(log_file):
+    path = os.path.abspath(log_file)
+    writer = _writers.get(path)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(path)
+            if writer is None:
+                writer = LogWriter(path, **settings)
+                _writers[path] = writer
+    return writer
+
+
+# helper: the event log of a directory, opened on first use
+def event_log_for(directory):
+    path = os.path.abspath(directory)
+    log = _event_logs.get(path)
+    if log is None:
+        with _writers_lock:
+            log = _event_logs.get(path)
+            if log is None:
+                log = _event_logs[path] = event_log.EventLog(path)
+    return log
+
+
+# the level of an event tag ("BROADCAST", not "[BROADCAST]")
+def level_of(tag):
+    level = filters["levels"].get(tag)
+    if level is not None:
+        return level
+    if "ERROR" in tag:
+        return ERROR
+    if tag in WARNING_TAGS:
+        return WARNING
+    return INFO
+
+
+# helper: share of a tag's events that is logged
+def _rate(tag):
+    rate = _rates.get(tag)
+    if rate is None:
+        if level_of(tag) < filters["level"]:
+            rate = 0.0
+        else:
+            rate = min(1.0, max(0.0, float(filters["sample"].get(tag, 1.0))))
+        _rates[tag] = rate
+    return rate
+
+
+# change the defaults (see `settings` and `filters`); applies to log files already
+# open too, and takes effect at once (levels and sample rates while the server runs)
+def configure(**options):
+    for name, value in options.items():
+        if name in filters:
+            if value is None:
+                continue
+            if name == "level":
+                value = LEVELS[value.lower()] if isinstance(value, str) else value
+            elif name == "levels":
+                value = {tag: LEVELS[level.lower()] if isinstance(level, str) else level
+                         for tag, level in value.items()}
+            filters[name] = value
+            _rates.clear()
+            continue
+        if name not in settings:
+            raise ValueError(f"Unknown log setting: {name}")
+        if name == "policy" and value not in LOG_POLICIES:
+            raise ValueError(f"Unknown log policy: {value}")
+        if value is not None or name == "events":
+            settings[name] = value
+    with _writers_lock:
+        for writer in _writers.values():
+            for name, value in settings.items():
+                setattr(writer, name, value)
+
+
+# write out everything queued, in every log file
+def flush_all():
+    for writer in list(_writers.values()):
+        writer.flush()
+
+
+@atexit.register
+def close_all():
+    for writer in list(_writers.values()):
+        writer.close()
+    for log in list(_event_logs.values()):
+        log.close()
+
 
 class Logger:
     def __init__(self, log_file="server_log.txt"):
         self.log_file = log_file
-        self.lock = threading.Lock()
-
-    def log_event(self, event):
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_line = f"[{timestamp}] {event}"
-        with self.lock:
-            print(log_line)
-            with open(self.log_file, "a", encoding="utf-8") as f:
-                f.write(log_line + "\n")
+        self.writer = None
+
+    # event: "[TAG] text", or a %-template formatted with args if it is logged.
+    # fields (user, peer, bytes, latency) only go into the structured record.
+    def log_event(self, event, *args, **fields):
+        end = event.find("]")
+        tag = event[1:end] if end > 0 and event[0] == "[" else ""
+        rate = _rates.get(tag)
+        if rate is None:
+            rate = _rate(tag)
+        if rate < 1.0:
+            if rate <= 0.0 or random.random() >= rate:
+                return
+            fields["sample"] = rate
+        writer = self.writer
+        if writer is None:
+            writer = self.writer = writer_for(self.log_file)
+        writer.put(event, args, fields)
+
+    # would an event with this tag be logged (at least sometimes)? For callers
+    # that have to do real work to build one.
+    def enabled(self, tag):
+        return _rate(tag) > 0.0
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def stats(self):
+        return writer_for(self.log_file).stats()
 
     def list_active_clients(self, clients):
         active = []
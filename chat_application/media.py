@@ -0,0 +1,120 @@
+# media.py
+# Packet format of the UDP media plane (voice calls), shared by the server's
+# media_relay.py and the client's voice_channel.py.
+#
+#   version u8 | payload type u8 | seq u16 | timestamp u32 | token u32 | payload | tag (16)
+#
+# The TLS chat connection only carries call signalling. After /call_accept the
+# server gives every leg of the call (one participant) a random token and key in
+# a "/call_media:<port>:<token>:<key>" line; the client then sends and receives
+# audio as UDP datagrams on the server's media port, so a lost packet costs one
+# chunk of audio instead of stalling the chat connection behind it.
+#
+# UDP gets no TLS, so every packet is sealed with the leg's key: the payload is
+# XORed with a keyed-BLAKE2b keystream (the header and direction are the nonce)
+# and the header + ciphertext are authenticated with a keyed-BLAKE2b tag. The
+# server opens what a leg sends with that leg's key and seals what it forwards
+# with the recipient's key. seq and timestamp (in samples) come from the sender
+# and are forwarded unchanged.
+import hashlib
+import hmac
+import os
+import struct
+
+MEDIA_VERSION = 1
+HEADER = struct.Struct("!BBHII")
+TAG_SIZE = 16
+KEY_SIZE = 32
+MAX_PACKET = 8192               # 44.1 kHz PCM chunks don't fit a 1500-byte MTU; they fragment
+
+# payload types
+KEEPALIVE = 0     # no payload: lets the server learn the leg's address (and keeps NAT bindings open)
+PCM16 = 1         # raw 16-bit mono PCM at 44.1 kHz; the other codecs' types are in audio_codec.py
+COMFORT_NOISE = 13  # one byte, the sender's background noise in -dBov: it stopped sending for now (voice_activity.py)
+
+# directions (part of the nonce, so the two directions of a leg never share a keystream)
+UP = b"u"         # client -> server
+DOWN = b"d"       # server -> client
+
+_BLOCK = 64       # BLAKE2b output per keystream block
+
+
+class MediaError(Exception):
+    pass
+
+
+def new_leg_secret():
+    return int.from_bytes(os.urandom(4), "big"), os.urandom(KEY_SIZE)
+
+
+def _keystream(key, nonce, n):
+    blocks = [hashlib.blake2b(nonce + i.to_bytes(4, "big"), key=key, person=b"media-stream").digest()
+              for i in range(-(-n // _BLOCK))]
+    return b"".join(blocks)[:n]
+
+
+def _xor(data, stream):
+    if not data:
+        return b""
+    n = len(data)
+    return (int.from_bytes(data, "big") ^ int.from_bytes(stream, "big")).to_bytes(n, "big")
+
+
+def _tag(key, nonce, body):
+    return hashlib.blake2b(nonce + body, key=key, digest_size=TAG_SIZE, person=b"media-tag").digest()
+
+
+def seal(key, direction, ptype, seq, timestamp, token, payload=b""):
+    header = HEADER.pack(MEDIA_VERSION, ptype, seq & 0xFFFF, timestamp & 0xFFFFFFFF, token)
+    nonce = direction + header
+    body = header + _xor(payload, _keystream(key, nonce, len(payload)))
+    return body + _tag(key, nonce, body)
+
+
+# token of a packet, to find the key it was sealed with; None if it isn't a media packet
+def peek_token(packet):
+    if len(packet) < HEADER.size + TAG_SIZE or packet[0] != MEDIA_VERSION:
+        return None
+    return HEADER.unpack_from(packet)[4]
+
+
+# (ptype, seq, timestamp, token, payload); MediaError if it was not sealed with key
+def open_packet(key, direction, packet):
+    if len(packet) < HEADER.size + TAG_SIZE or len(packet) > MAX_PACKET:
+        raise MediaError("bad packet size")
+    body, tag = packet[:-TAG_SIZE], packet[-TAG_SIZE:]
+    header = body[:HEADER.size]
+    nonce = direction + header
+    if not hmac.compare_digest(tag, _tag(key, nonce, body)):
+        raise MediaError("bad packet tag")
+    version, ptype, seq, timestamp, token = HEADER.unpack(header)
+    ciphertext = body[HEADER.size:]
+    return ptype, seq, timestamp, token, _xor(ciphertext, _keystream(key, nonce, len(ciphertext)))
+
+
+# ---------- signalling ----------
+
+UDP = "udp"
+
+
+# hello options of a client that can take its call audio over UDP
+def offer():
+    return {"media": UDP}
+
+
+# server side: True if a client's hello options say it can
+def accept(options):
+    return (options or {}).get("media") == UDP
+
+
+def format_offer(port, token, key):
+    return f"/call_media:{port}:{token:08x}:{key.hex()}"
+
+
+# "/call_media:<port>:<token>:<key>" -> (port, token, key)
+def parse_offer(text):
+    try:
+        _, port, token, key = text.split(":")
+        return int(port), int(token, 16), bytes.fromhex(key)
+    except ValueError:
+        raise MediaError(f"bad media offer: {text!r}")
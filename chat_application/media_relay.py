@@ -0,0 +1,391 @@
+# media_relay.py
+# Server end of the UDP media plane for voice calls (packet format in media.py).
+#
+# One UDP socket on the media port serves every call. When a call is accepted,
+# message_handler opens a MediaCall: every participant gets a leg (token + key)
+# handed out over its signalling connection. datagram() opens what a leg sends
+# and forwards it, sealed for each other leg, to the address that leg last sent
+# from. A leg's address is learned from its first valid packet (clients send a
+# KEEPALIVE as soon as they have their leg), so clients behind NAT work: we reply
+# to whatever address their packets come from. A valid packet from a new address
+# moves the leg only if it is newer than what the leg sent before, so a replayed
+# packet can't redirect a call.
+#
+# The relay runs on its own thread in threaded mode (start()) or as a datagram
+# endpoint on the event loop in async mode (start_async()). Either way it never
+# touches the chat connections: audio doesn't wait behind chat or file data, and
+# a lost packet is a lost 20 ms of audio instead of a stalled TCP stream.
+#
+# A conference (ConferenceCall) is a call whose audio the relay mixes instead of
+# forwarding: what participants send is decoded into a short per-leg inbox, and
+# a clock per room (a thread, or a task on the event loop) mixes one frame every
+# frame duration (audio_mixer.py) and sends each participant one stream in the
+# room's codec. Participants join and leave while the room goes on.
+import asyncio
+import collections
+import socket
+import threading
+import time
+import media
+import metrics
+from audio_mixer import Mixer
+from logger_utility import Logger
+
+logger = Logger()
+
+udp_packets = metrics.counter("chat_media_packets_total", "UDP media packets accepted from call legs")
+udp_rejected = metrics.counter("chat_media_rejected_total", "UDP media packets rejected (unknown leg, bad seal, replay)")
+udp_audio_bytes = metrics.counter("chat_call_audio_bytes_total", "Call audio bytes relayed", transport="udp")
+udp_relay_seconds = metrics.histogram("chat_call_relay_seconds", "Time to relay one chunk of call audio",
+                                      transport="udp")
+mix_seconds = metrics.histogram("chat_conference_mix_seconds", "Time to mix and send one frame of a conference")
+
+RECV_BUFFER = 1 << 20           # socket receive buffer: bursts from many calls queue here
+INBOX_FRAMES = 4                # conference: frames queued per participant; older ones are dropped
+INBOX_START = 2                 # conference: frames a participant's inbox fills to before it is mixed in
+MAX_LAG = 0.2                   # conference clock: seconds behind after which it skips ahead instead of catching up
+
+
+class MediaLeg:
+    """One participant of a call on the media plane."""
+
+    def __init__(self, call, username):
+        self.call = call
+        self.username = username
+        self.token, self.key = media.new_leg_secret()
+        self.addr = None            # where the client's packets come from (None until the first one)
+        self.newest = None          # (timestamp, seq) of its newest packet
+        self.packets_in = 0
+        self.bytes_in = 0
+        self.packets_out = 0
+        self.bytes_out = 0
+
+
+class MediaCall:
+    """The legs of one call; audio from each leg goes to all the others."""
+
+    room = None                     # conference room name; None for a call the relay just forwards
+
+    def __init__(self, codec="pcm"):
+        self.legs = []
+        self.codec = codec          # audio_codec name the participants agreed on (the relay doesn't decode)
+        self.started = time.time()
+        self.closed = False
+
+    def new_leg(self, username):
+        return MediaLeg(self, username)
+
+    def summary(self):
+        seconds = time.time() - self.started
+        legs = ", ".join(f"{leg.username} sent {leg.packets_in} packets ({leg.bytes_in} bytes), "
+                         f"got {leg.packets_out} ({leg.bytes_out} bytes)" for leg in self.legs)
+        return f"{self.codec}, {seconds:.1f}s: {legs}"
+
+
+class ConferenceLeg(MediaLeg):
+    """A conference participant: its decoded-on-demand inbox and the stream mixed for it."""
+
+    def __init__(self, call, username):
+        super().__init__(call, username)
+        self.inbox = collections.deque(maxlen=INBOX_FRAMES)    # payloads not mixed yet
+        self.primed = False         # inbox has filled up to INBOX_START since it last ran dry
+        self.decoder = call.format.decoder()
+        self.encoder = call.format.encoder()
+        self.seq_out = 0
+        self.timestamp_out = 0
+
+
+class ConferenceCall(MediaCall):
+    """A conference room: the relay mixes everyone's audio and sends each participant one stream."""
+
+    def __init__(self, room, codec):
+        super().__init__(codec.name)
+        self.room = room
+        self.format = codec                     # audio_codec.Codec everyone in the room uses
+        self.interval = codec.frame / codec.rate
+        self.mixer = Mixer(codec.frame)
+        self.listener_encoder = codec.encoder()     # the one mix everyone who isn't talking hears
+        self.joined = 0                         # participants over the room's life
+        self.ticks = 0
+        self.mix_time = 0.0
+
+    def new_leg(self, username):
+        self.joined += 1
+        return ConferenceLeg(self, username)
+
+    # a packet from a participant (relay thread / event loop)
+    def receive(self, leg, ptype, payload):
+        if ptype == self.format.ptype:
+            leg.inbox.append(payload)
+
+    # one frame duration: mix and send; sendto(packet, addr) sends on the media socket
+    def tick(self, sendto):
+        start = time.perf_counter()
+        legs = list(self.legs)
+        frames = []
+        for leg in legs:
+            if not leg.primed and len(leg.inbox) >= INBOX_START:
+                leg.primed = True
+            if leg.primed and leg.inbox:
+                frames.append(leg.decoder.decode(leg.inbox.popleft()))
+            else:
+                leg.primed = False
+                frames.append(None)
+        total, mixes = self.mixer.mix(frames)
+
+        shared = None
+        frame = self.format.frame
+        for leg, mixed in zip(legs, mixes):
+            if total is not None and leg.addr is not None:
+                if mixed is not None:
+                    payload = leg.encoder.encode(mixed)
+                else:
+                    if shared is None:
+                        shared = self.listener_encoder.encode(total)
+                    payload = shared
+                out = media.seal(leg.key, media.DOWN, self.format.ptype, leg.seq_out, leg.timestamp_out,
+                                 leg.token, payload)
+                leg.seq_out = (leg.seq_out + 1) & 0xFFFF
+                try:
+                    sendto(out, leg.addr)
+                    leg.packets_out += 1
+                    leg.bytes_out += len(out)
+                except OSError:
+                    pass
+            # the timestamp runs on through silence, like a sender's does
+            leg.timestamp_out = (leg.timestamp_out + frame) & 0xFFFFFFFF
+        self.ticks += 1
+        elapsed = time.perf_counter() - start
+        self.mix_time += elapsed
+        mix_seconds.observe(elapsed)
+
+    def summary(self):
+        seconds = time.time() - self.started
+        mean = self.mix_time / self.ticks * 1e6 if self.ticks else 0.0
+        return (f"conference {self.room}, {self.codec}, {seconds:.1f}s: {self.joined} joined, "
+                f"{self.ticks} frames mixed, {mean:.0f} us per frame")
+
+
+class MediaRelay:
+    def __init__(self, port=None):
+        self.port = port            # None / 0: no media plane, calls relay audio over the chat connection
+        self.legs = {}              # token -> MediaLeg
+        self.lock = threading.Lock()
+        self.sock = None            # threaded mode
+        self.transport = None       # async mode
+        self.loop = None            # async mode: the event loop conference clocks run on
+        self.rejected = 0           # datagrams that weren't from a live leg
+
+    def configure(self, port):
+        self.port = port
+
+    # True once the UDP socket is up: only then are calls put on the media plane
+    @property
+    def enabled(self):
+        return self.sock is not None or self.transport is not None
+
+    # ---------- calls ----------
+
+    # a call between usernames; the legs come back in the same order
+    def open_call(self, *usernames, codec="pcm"):
+        call = MediaCall(codec)
+        with self.lock:
+            for username in usernames:
+                leg = MediaLeg(call, username)
+                while leg.token in self.legs:
+                    leg.token, leg.key = media.new_leg_secret()
+                self.legs[leg.token] = leg
+                call.legs.append(leg)
+        return call
+
+    def close_call(self, call):
+        call.closed = True
+        with self.lock:
+            for leg in call.legs:
+                if self.legs.get(leg.token) is leg:
+                    del self.legs[leg.token]
+        logger.log_event(f"[CALL MEDIA] {call.summary()}")
+
+    # ---------- conferences ----------
+
+    # an empty room mixing in codec (an audio_codec.Codec); its clock starts right away
+    def open_conference(self, room, codec):
+        call = ConferenceCall(room, codec)
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self._clock_async(call), self.loop)
+        else:
+            threading.Thread(target=self._clock, args=(call,), daemon=True).start()
+        return call
+
+    def join(self, call, username):
+        leg = call.new_leg(username)
+        with self.lock:
+            while leg.token in self.legs:
+                leg.token, leg.key = media.new_leg_secret()
+            self.legs[leg.token] = leg
+            call.legs.append(leg)
+        return leg
+
+    def leave(self, call, username):
+        with self.lock:
+            for leg in call.legs:
+                if leg.username == username:
+                    call.legs.remove(leg)
+                    if self.legs.get(leg.token) is leg:
+                        del self.legs[leg.token]
+                    return leg
+        return None
+
+    # helper: one tick of a room, without letting a bad frame stop its clock
+    def _tick(self, call, sendto):
+        try:
+            call.tick(sendto)
+        except Exception as e:
+            logger.log_event(f"[CONFERENCE ERROR] {call.room}: {e}")
+
+    def _clock(self, call):
+        deadline = time.monotonic()
+        while not call.closed and self.sock is not None:
+            deadline += call.interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -MAX_LAG:
+                deadline = time.monotonic()
+            sock = self.sock
+            if sock is not None:
+                self._tick(call, sock.sendto)
+
+    async def _clock_async(self, call):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while not call.closed and self.transport is not None:
+            deadline += call.interval
+            delay = deadline - loop.time()
+            if delay < -MAX_LAG:
+                deadline = loop.time()
+            await asyncio.sleep(max(delay, 0))
+            transport = self.transport
+            if transport is not None:
+                self._tick(call, transport.sendto)
+
+    # ---------- packets ----------
+
+    # one datagram from addr; sendto(packet, addr) sends on the media socket
+    def datagram(self, packet, addr, sendto):
+        start = time.perf_counter()
+        token = media.peek_token(packet)
+        leg = self.legs.get(token) if token is not None else None
+        if leg is None:
+            self.rejected += 1
+            udp_rejected.inc()
+            return
+        try:
+            ptype, seq, timestamp, _, payload = media.open_packet(leg.key, media.UP, packet)
+        except media.MediaError:
+            self.rejected += 1
+            udp_rejected.inc()
+            return
+
+        order = (timestamp, seq)
+        if addr != leg.addr:
+            if leg.addr is not None and order <= leg.newest:
+                self.rejected += 1
+                udp_rejected.inc()
+                return
+            leg.addr = addr
+        if leg.newest is None or order > leg.newest:
+            leg.newest = order
+        leg.packets_in += 1
+        leg.bytes_in += len(packet)
+        udp_packets.inc()
+        if ptype == media.KEEPALIVE:
+            return
+        udp_audio_bytes.inc(len(payload))
+        if leg.call.room is not None:
+            leg.call.receive(leg, ptype, payload)
+            return
+
+        for other in leg.call.legs:
+            if other is leg or other.addr is None:
+                continue
+            out = media.seal(other.key, media.DOWN, ptype, seq, timestamp, leg.token, payload)
+            try:
+                sendto(out, other.addr)
+            except OSError:
+                continue
+            other.packets_out += 1
+            other.bytes_out += len(out)
+        udp_relay_seconds.observe(time.perf_counter() - start)
+
+    # ---------- threaded mode ----------
+
+    def start(self, host):
+        if not self.port:
+            return
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+            sock.bind((host, self.port))
+        except OSError as e:
+            logger.log_event(f"[MEDIA RELAY ERROR] UDP port {self.port}: {e}; calls stay on TCP")
+            return
+        self.sock = sock
+        threading.Thread(target=self._serve, daemon=True).start()
+        logger.log_event(f"[MEDIA RELAY STARTED] UDP {host}:{self.port}")
+
+    def _serve(self):
+        buf = bytearray(media.MAX_PACKET + 1)     # one byte more: oversized datagrams show up as such
+        view = memoryview(buf)
+        sock = self.sock
+        while self.sock is sock:
+            try:
+                n, addr = sock.recvfrom_into(buf)
+            except OSError:
+                continue
+            self.datagram(bytes(view[:n]), addr, sock.sendto)
+
+    # ---------- async mode ----------
+
+    async def start_async(self, host):
+        if not self.port:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            self.transport, _ = await loop.create_datagram_endpoint(lambda: _MediaProtocol(self),
+                                                                    local_addr=(host, self.port))
+        except OSError as e:
+            logger.log_event(f"[MEDIA RELAY ERROR] UDP port {self.port}: {e}; calls stay on TCP")
+            return
+        self.loop = loop
+        sock = self.transport.get_extra_info("socket")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+        logger.log_event(f"[MEDIA RELAY STARTED] UDP {host}:{self.port} (async mode)")
+
+    def stop(self):
+        sock, self.sock = self.sock, None
+        transport, self.transport = self.transport, None
+        self.loop = None
+        try:
+            if sock:
+                sock.close()
+            if transport:
+                transport.close()
+        except:
+            pass
+        if sock or transport:
+            logger.log_event(f"[MEDIA RELAY STOPPED] {len(self.legs)} legs open, {self.rejected} packets rejected")
+
+
+class _MediaProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, relay):
+        self.relay = relay
+
+    def datagram_received(self, data, addr):
+        transport = self.relay.transport
+        if transport:
+            self.relay.datagram(data, addr, transport.sendto)
+
+    def error_received(self, exc):
+        pass
@@ -1,16 +1,69 @@
 # message_handler.py
+import hmac
+import secrets
 import threading
+import time
+import audio_codec
+import compression
+import frame_codec
+import media
+import metrics
+import tracing
+from call_manager import CallManager
+from file_cache import FileCache
+from file_relay import FILE_WINDOW, FilePump, FileRelay, active_relays
+from media_relay import MediaRelay
+from frame_codec import FRAME, LINE, FrameDecoder, FrameError
+from receive_buffer import ReceiveBuffer
+from transfer_spool import ParallelUpload, PartialUpload, TransferSpool
 from logger_utility import Logger
 
 logger = Logger()
 
-# Shared active calls mapping (username -> partner_username)
-# When A and B are in call:
-#   active_calls['A'] == 'B' and active_calls['B'] == 'A'
-active_calls = {}
+# Every call (two-party or conference room) and who is in it, shared by all handlers (see call_manager.py)
+call_manager = CallManager()
+
+# UDP media plane for calls between clients that support it (see media_relay.py; the server's CLI
+# configures the port). A call's MediaCall is its session's `media`.
+media_relay = MediaRelay()
+
+# Resumable uploads by transfer id, shared by all handlers so a sender that
+# reconnects finds its interrupted upload (see transfer_spool.py)
+transfer_spool = TransferSpool()
+
+# Parallel uploads by transfer id: their data connections attach here (TransferStreamHandler)
+parallel_uploads = {}
+
+# Content-addressed cache of uploaded files (see file_cache.py; the server's CLI configures it)
+file_cache = FileCache()
+PROOF_SIZE = 64 * 1024      # bytes of a cached file a sender hashes to prove it has the file (FILE_PROVE)
+
+# End-to-end latency of traced chat messages (see tracing.py; the server's CLI turns it on)
+tracer = tracing.Tracer()
+
+# ---------- metrics (see metrics.py) ----------
+bytes_received = metrics.counter("chat_bytes_received_total", "Bytes read from client connections")
+messages_received = metrics.counter("chat_messages_received_total", "Chat lines and frames received from clients")
+process_seconds = metrics.histogram("chat_process_seconds", "Time to handle one read from a client connection")
+broadcasts = metrics.counter("chat_broadcasts_total", "Messages broadcast to everyone")
+broadcast_deliveries = metrics.counter("chat_broadcast_deliveries_total", "Broadcast copies queued for recipients")
+broadcast_seconds = metrics.histogram("chat_broadcast_seconds", "Time to queue one broadcast for every recipient")
+private_messages = metrics.counter("chat_private_messages_total", "Private messages delivered")
+files_relayed = metrics.counter("chat_files_total", "File uploads relayed")
+file_bytes = metrics.counter("chat_file_bytes_total", "File bytes received from senders and relayed")
+file_seconds = metrics.histogram("chat_file_transfer_seconds", "Time from a file's header to its last byte relayed")
+tcp_audio_bytes = metrics.counter("chat_call_audio_bytes_total", "Call audio bytes relayed", transport="tcp")
+tcp_relay_seconds = metrics.histogram("chat_call_relay_seconds", "Time to relay one chunk of call audio",
+                                      transport="tcp")
+metrics.gauge("chat_calls_active", "Calls and conference rooms in progress", fn=lambda: len(call_manager))
+metrics.counter("chat_calls_ended_total", "Calls that have ended", fn=lambda: call_manager.calls_ended)
+metrics.counter("chat_file_cache_lookups_total", "File cache lookups", fn=lambda: file_cache.lookups)
+metrics.counter("chat_file_cache_hits_total", "File cache hits", fn=lambda: file_cache.hits)
+metrics.counter("chat_file_cache_saved_bytes_total", "Upload bytes the file cache saved", fn=lambda: file_cache.bytes_saved)
 
 class MessageHandler:
-    def __init__(self, client_socket, client_address, clients, clients_lock):
+    def __init__(self, client_socket, client_address, registry, start_thread=True, initial_data=b"",
+                 file_window=FILE_WINDOW):
         """
         merged message handler supporting:
           - text chat / broadcast
@@ -18,263 +71,775 @@ class MessageHandler:
           - user list (/list)
           - file send: header '/file <recipient> <filename> <size>\\n' followed by raw bytes
           - voice call signalling: /call_request:, /call_accept:, /call_reject:, /call_end
+          - conference calls: /conf_join:<room>[:codecs] (left with /call_end), mixed on the media relay
+          - /calls: the calls in progress with their duration and bitrate (see call_manager.py)
           - raw audio forwarding while in-call (server acts as relay)
+            (clients that offer media=udp get the audio on the UDP media relay instead, see media_relay.py)
+
+        Clients that negotiated the framed protocol (frame_codec.py) send the same
+        commands as TEXT frames and files/audio as FILE_*/AUDIO frames; legacy
+        clients keep the newline protocol above.
+
+        start_thread=False is used by the event-loop server (async_server.py):
+        no reader thread is started and the loop pushes received bytes in
+        through feed() instead.
+        initial_data: bytes that arrived right behind the client's hello; the
+        reader thread processes them before its first recv_into().
+        file_window: bytes of an upload that may be queued per recipient before
+        the sender is slowed down (see file_relay.py).
         """
         self.client_socket = client_socket
         self.client_address = client_address
-        self.clients = clients              # dict: socket -> username
-        self.clients_lock = clients_lock
+        self.registry = registry            # ClientRegistry shared with the server
         self.running = True
+        self.threaded = start_thread
+        self.file_window = file_window
+
+        # upload in progress (legacy protocol): its bytes are relayed as they arrive
+        self.upload = None
+
+        entry = self.registry.entry_for_socket(self.client_socket)
+        self.username = entry.username if entry else "Unknown"
+        self.protocol = entry.protocol if entry else LINE
 
-        # buffer used for assembling text/file headers when not in-call
-        self.buffer = b""
+        # only the negotiated protocol's receive buffer is allocated (an idle connection holds one small buffer):
+        # rbuf assembles text/file headers when not in-call (legacy protocol), the decoder frames (framed protocol)
+        self.rbuf = ReceiveBuffer() if self.protocol == LINE else None
+        self.decoder = FrameDecoder() if self.protocol == FRAME else None
+
+        # framed protocol: uploads in progress by stream id
+        self.inflater = compression.Inflater()     # the client's compressed TEXT frames
+        self.uploads = {}
+        self.resumable = {}     # stream id -> PartialUpload (checksummed, survives a disconnect)
+        self.challenges = {}    # transfer id -> cache hit waiting for the sender's FILE_PROVE answer
+
+        self.initial_data = initial_data
+
+        # latency tracing: when the bytes being processed were read, and the trace of the line being handled
+        self.read_at = 0.0
+        self.trace = None
 
         # start thread
-        t = threading.Thread(target=self.handle_client, daemon=True)
-        t.start()
+        if start_thread:
+            t = threading.Thread(target=self.handle_client, daemon=True)
+            t.start()
 
-    # find socket by username (thread-safe with clients_lock)
+    # find socket by username (O(1) registry lookup)
     def find_socket_by_username(self, username):
-        with self.clients_lock:
-            for sock, user in self.clients.items():
-                if user == username:
-                    return sock
-        return None
-
-    # helper to send a text line (adds newline)
-    def _send_to_client(self, client, message):
-        try:
-            client.send((message + "\n").encode('utf-8'))
-        except Exception as e:
-            logger.log_event(f"[SEND ERROR] {e}")
+        return self.registry.socket_for(username)
 
-    # helper to send raw bytes (no encoding)
-    def _send_bytes(self, client, data):
-        try:
-            client.sendall(data)
-        except Exception as e:
-            logger.log_event(f"[SEND BYTES ERROR] {e}")
-
-    # remove call pairing for a username (cleanup both sides)
-    def _end_call_for(self, username):
-        partner = active_calls.pop(username, None)
-        if partner:
-            # remove partner mapping too
-            active_calls.pop(partner, None)
-            partner_sock = self.find_socket_by_username(partner)
-            if partner_sock:
-                try:
-                    partner_sock.send(f"[SYSTEM] {username} ended the call.\n".encode('utf-8'))
-                except:
-                    pass
-
-    # receive EXACT n bytes (used only when we already know how many bytes to read)
-    def _recv_exact(self, n):
-        data = b""
-        remaining = n
-        while remaining > 0:
-            chunk = self.client_socket.recv(min(4096, remaining))
-            if not chunk:
-                raise ConnectionError("Connection lost while receiving data")
-            data += chunk
-            remaining -= len(chunk)
-        return data
+    # outbound queue of a connected client (None once it is gone)
+    def _outbound(self, client):
+        entry = self.registry.entry_for_socket(client)
+        return entry.outbound if entry else None
+
+    # helper to send a text line in the client's protocol; returns False if the client is gone
+    def _send_to_client(self, client, message, droppable=False):
+        return self._send_encoded(client, frame_codec.encode_text, (message,), droppable)
+
+    # helper to queue one message for a client, encoded for its wire protocol.
+    # Sends are only queued here; the client's writer does the socket I/O, so a
+    # slow reader never blocks us.
+    def _send_encoded(self, client, encode, args, droppable=False):
+        return self._send_to_entry(self.registry.entry_for_socket(client), encode, args, droppable,
+                                   self.registry.username_for(client, 'Unknown'))
+
+    def _send_to_entry(self, entry, encode, args, droppable=False, name=None):
+        if entry is None or entry.outbound is None or not entry.outbound.put(encode(entry.protocol, *args), droppable):
+            logger.log_event(f"[SEND ERROR] {name or (entry.username if entry else 'Unknown')} is not connected")
+            return False
+        return True
+
+    # take a username out of its call (if any): a two-party call ends for both sides,
+    # a conference goes on without them. notify=False: the others aren't told (nothing started yet)
+    def _end_call_for(self, username, notify=True):
+        left = call_manager.leave(username)
+        if left:
+            self._after_leave(*left, notify=notify)
+
+    # helper: clean up after call_manager took `username` out of `session` (ended: nobody is left in it)
+    def _after_leave(self, session, username, ended, notify=True):
+        if session.room is not None:
+            leg = media_relay.leave(session.media, username) if session.media else None
+            if leg:
+                session.count(username, leg.bytes_in)
+            logger.log_event(f"[CONFERENCE LEAVE] {username} left {session.room} "
+                             f"({len(session.participants)} in the room)", user=username)
+            if not ended:
+                self._tell_conference(session, f"[SYSTEM] {username} left conference {session.room}.")
+        elif notify:
+            for partner in session.participants:
+                partner_entry = self.registry.entry_for_user(partner) if partner != username else None
+                if partner_entry:
+                    if partner_entry.media:
+                        # its audio goes over UDP: tell the client to stop sending it
+                        self._send_to_client(partner_entry.sock, f"/call_end:{username}")
+                    self._send_to_client(partner_entry.sock, f"[SYSTEM] {username} ended the call.")
+        if ended:
+            if session.media:
+                media_relay.close_call(session.media)
+            logger.log_event(f"[CALL ENDED] {session.summary()}", user=username, bytes=session.bytes_total())
+
+    # put a call on the UDP media relay if every participant supports it: each gets
+    # its own leg in a /call_media line. Returns the MediaCall, or None (audio stays on TCP).
+    def _open_media(self, session, entries):
+        if not media_relay.enabled or not all(entry and entry.media for entry in entries):
+            return None
+        call = session.media = media_relay.open_call(*session.participants, codec=session.codec)
+        for entry, leg in zip(entries, call.legs):
+            self._send_to_client(entry.sock, media.format_offer(media_relay.port, leg.token, leg.key))
+        return call
+
+    # ---------- conferences ----------
+
+    # put a user in a conference room (opening it in the first codec of their list
+    # the server can mix); the leg goes out before /conf_joined so audio can start right away
+    def _join_conference(self, username, room, codecs):
+        entry = self.registry.entry_for_user(username)
+        if not media_relay.enabled or not (entry and entry.media):
+            self._send_to_client(self.client_socket, "[SYSTEM] Conferences need the UDP media relay.")
+            return
+        offered = [name.strip() for name in codecs.split(",") if name.strip()] or [audio_codec.PCM.name]
+        existing = call_manager.room(room)
+        if existing is not None and existing.codec not in offered:
+            self._send_to_client(self.client_socket,
+                                 f"[SYSTEM] Conference {room} uses {existing.codec}, which your client doesn't offer.")
+            return
+        codec = audio_codec.choose(",".join(offered))
+
+        def open_room(session):
+            session.media = media_relay.open_conference(room, codec)
+
+        # one call at a time: whatever call the user was in ends here
+        session, created, left = call_manager.join(room, username, codec.name, open_room)
+        for previous in left:
+            self._after_leave(*previous)
+        if created:
+            logger.log_event(f"[CONFERENCE OPEN] {room} ({session.codec}) by {username}", user=username)
+        leg = media_relay.join(session.media, username)
+        self._send_to_client(self.client_socket, media.format_offer(media_relay.port, leg.token, leg.key))
+        self._send_to_client(self.client_socket, f"/conf_joined:{room}:{session.codec}")
+        count = len(session.participants)
+        logger.log_event(f"[CONFERENCE JOIN] {username} joined {room} ({count} in the room)", user=username)
+        self._tell_conference(session, f"[SYSTEM] {username} joined conference {room} ({count} in the call).")
+
+    # helper: a system line to everyone in a room
+    def _tell_conference(self, session, message):
+        for name in list(session.participants):
+            entry = self.registry.entry_for_user(name)
+            if entry:
+                self._send_to_client(entry.sock, message)
 
     def handle_client(self):
-        # determine username
-        with self.clients_lock:
-            username = self.clients.get(self.client_socket, "Unknown")
-        logger.log_event(f"[CONNECTED] {username} ({self.client_address})")
+        logger.log_event("[CONNECTED] %s (%s)", self.username, self.client_address,
+                         user=self.username, peer=self.client_address)
 
+        if self.initial_data:
+            self.feed(self.initial_data)
         while self.running:
             try:
-                chunk = self.client_socket.recv(4096)
-                if not chunk:
+                n = self._recv()
+                if not n:
                     break
-
-                # ---------- If this user is currently in a call, treat incoming bytes as audio and forward ----------
-                # audio frames are sent as raw bytes (no newline), so active_calls presence decides audio forwarding
-                if username in active_calls:
-                    partner_name = active_calls.get(username)
-                    if partner_name:
-                        partner_sock = self.find_socket_by_username(partner_name)
-                        if partner_sock:
-                            try:
-                                partner_sock.sendall(chunk)
-                            except Exception as e:
-                                logger.log_event(f"[CALL FORWARD ERROR] {e}")
-                                # if forwarding fails, end call
-                                self._end_call_for(username)
-                        else:
-                            # partner disconnected — end call
-                            self._end_call_for(username)
-                    continue  # done with this chunk
-
-                # ---------- Not in-call: buffer chunk and process newline-terminated text/headers ----------
-                self.buffer += chunk
-
-                # process all complete lines in buffer
-                while b"\n" in self.buffer:
-                    line, self.buffer = self.buffer.split(b"\n", 1)
-                    try:
-                        text = line.decode('utf-8').strip()
-                    except Exception as e:
-                        logger.log_event(f"[DECODE ERROR] {e}")
-                        continue
-
-                    # ---- FILE TRANSFER header: /file <recipient> <filename> <size>
-                    if text.startswith("/file "):
-                        # safe split into 4 parts (cmd, recipient, filename, filesize)
-                        parts = text.split(" ", 3)
-                        if len(parts) < 4:
-                            self._send_to_client(self.client_socket, "[SYSTEM] Malformed /file header.")
-                            continue
-                        _, recipient, filename, size_str = parts
-                        try:
-                            filesize = int(size_str)
-                        except:
-                            self._send_to_client(self.client_socket, "[SYSTEM] Invalid file size.")
-                            continue
-
-                        # ensure buffer has the file bytes; if not, read from socket until we have it
-                        while len(self.buffer) < filesize:
-                            more = self.client_socket.recv(4096)
-                            if not more:
-                                raise ConnectionError("Connection lost during file receive")
-                            self.buffer += more
-
-                        filebytes = self.buffer[:filesize]
-                        self.buffer = self.buffer[filesize:]
-
-                        # forward file to recipient(s)
-                        self._forward_file(username, recipient, filename, filesize, filebytes)
-                        continue
-
-                    # ---- PRIVATE MESSAGE: /pm recipient message...
-                    if text.startswith("/pm "):
-                        parts = text.split(" ", 2)
-                        if len(parts) < 3:
-                            self._send_to_client(self.client_socket, "[SYSTEM] Usage: /pm <username> <message>")
-                            continue
-                        _, target_username, private_msg = parts
-                        self._handle_private_message(username, target_username, private_msg)
-                        continue
-
-                    # ---- LIST USERS
-                    if text == "/list":
-                        self._send_user_list()
-                        continue
-
-                    # ---- QUIT
-                    if text == "/quit":
-                        self._send_to_client(self.client_socket, "[SYSTEM] Goodbye.")
-                        self.running = False
-                        break
-
-                    # ---- Voice call signalling commands (textual) ----
-                    if text.startswith("/call_request:"):
-                        # incoming format: /call_request:target_username
-                        try:
-                            target_username = text.split(":", 1)[1]
-                        except:
-                            self._send_to_client(self.client_socket, "[SYSTEM] Malformed call request.")
-                            continue
-
-                        target_sock = self.find_socket_by_username(target_username)
-                        if target_sock:
-                            # forward request to target (so GUI can prompt)
-                            try:
-                                target_sock.send(f"/call_request:{username}\n".encode('utf-8'))
-                            except Exception as e:
-                                logger.log_event(f"[CALL REQUEST FORWARD ERROR] {e}")
-                                self._send_to_client(self.client_socket, f"[SYSTEM] Could not reach {target_username}.")
-                        else:
-                            self._send_to_client(self.client_socket, f"[SYSTEM] User '{target_username}' not found.")
-                        continue
-
-                    if text.startswith("/call_accept:"):
-                        # format: /call_accept:caller_username  (sent by callee)
-                        try:
-                            caller_username = text.split(":", 1)[1]
-                        except:
-                            continue
-                        caller_sock = self.find_socket_by_username(caller_username)
-                        if caller_sock:
-                            # notify caller that call was accepted; caller will start sending/receiving audio
-                            try:
-                                caller_sock.send(f"/call_accept:{username}\n".encode('utf-8'))
-                            except Exception as e:
-                                logger.log_event(f"[CALL ACCEPT FORWARD ERROR] {e}")
-                                continue
-                            # mark both as in-call
-                            active_calls[username] = caller_username
-                            active_calls[caller_username] = username
-                            # inform callee too (optional)
-                            self._send_to_client(self.client_socket, f"[SYSTEM] Call connected with {caller_username}.")
-                        continue
-
-                    if text.startswith("/call_reject:"):
-                        # format: /call_reject:caller_username
-                        try:
-                            caller_username = text.split(":", 1)[1]
-                        except:
-                            continue
-                        caller_sock = self.find_socket_by_username(caller_username)
-                        if caller_sock:
-                            try:
-                                caller_sock.send(f"/call_reject:{username}\n".encode('utf-8'))
-                            except Exception as e:
-                                logger.log_event(f"[CALL REJECT FORWARD ERROR] {e}")
-                        continue
-
-                    if text == "/call_end":
-                        # end call for this user (if any)
-                        self._end_call_for(username)
-                        continue
-
-                    # ---- Otherwise treat as broadcast chat message ----
-                    with self.clients_lock:
-                        uname = self.clients.get(self.client_socket, "Unknown")
-                    full_msg = f"[{uname}] ({self.client_address[0]}:{self.client_address[1]}): {text}"
-                    logger.log_event(f"[BROADCAST] {full_msg}")
-                    self._broadcast(full_msg)
+                bytes_received.inc(n)
+                self.read_at = start = time.perf_counter()
+                self._process()
+                process_seconds.observe(time.perf_counter() - start)
 
             except Exception as e:
-                logger.log_event(f"[DISCONNECTED] {self.clients.get(self.client_socket,'Unknown')} ({e})")
+                logger.log_event(f"[DISCONNECTED] {self.registry.username_for(self.client_socket, 'Unknown')} ({e})")
                 break
 
         # cleanup and stop
         self.stop()
 
-    # helper: forward file to recipient or broadcast to all
-    def _forward_file(self, sender, recipient, filename, filesize, filebytes):
-        meta = f"[FILE] {sender} {filename} {filesize}\n".encode('utf-8')
+    # threaded reader: receive straight into the buffer the bytes are parsed from.
+    # Returns the byte count (0 = connection closed).
+    def _recv(self):
+        if self.protocol == FRAME:
+            return self.decoder.recv_into(self.client_socket)
+        return self.rbuf.recv_into(self.client_socket)
 
-        if recipient.lower() == "all":
-            with self.clients_lock:
-                for sock in list(self.clients.keys()):
-                    if sock == self.client_socket:
-                        continue
-                    try:
-                        sock.sendall(meta)
-                        sock.sendall(filebytes)
-                    except Exception as e:
-                        logger.log_event(f"[FILE BROADCAST ERROR] {e}")
-            self._send_to_client(self.client_socket, f"[SYSTEM] File broadcasted: {filename}")
+    # process one chunk of received bytes (event-loop server); returns False once the client has quit.
+    def feed(self, chunk):
+        bytes_received.inc(len(chunk))
+        self.read_at = start = time.perf_counter()
+        if self.protocol == FRAME:
+            self.decoder.feed(chunk)
+        else:
+            self.rbuf.feed(chunk)
+        running = self._process()
+        process_seconds.observe(time.perf_counter() - start)
+        return running
+
+    # handle everything buffered so far; shared by the threaded reader and feed()
+    def _process(self):
+        if self.protocol == FRAME:
+            return self._process_frames()
+
+        username = self.username
+        rbuf = self.rbuf
+
+        # ---------- Bytes of a file whose header was already parsed ----------
+        if self.upload and not self._relay_upload():
+            return self.running
+
+        # ---------- If this user is currently in a call, treat incoming bytes as audio and forward ----------
+        # legacy clients send audio as raw bytes (no newline), so being in a call decides audio forwarding
+        if len(rbuf) and username in call_manager:
+            self._relay_audio(bytes(rbuf.read_all()))
+            return self.running  # done with this chunk
+
+        # ---------- Not in-call: process newline-terminated text/headers ----------
+        while self.running and not self.upload:
+            line = rbuf.readline()
+            if line is None:
+                break
+            try:
+                text = str(line, 'utf-8').strip()
+            except Exception as e:
+                logger.log_event(f"[DECODE ERROR] {e}")
+                continue
+            messages_received.inc()
+            self._handle_line(username, text)
+
+        return self.running
+
+    # framed protocol: every frame says what it is, so nothing is guessed from call state
+    def _process_frames(self):
+        try:
+            for frame in self.decoder.frames():
+                self._handle_frame(frame)
+                if not self.running:
+                    break
+        except FrameError as e:
+            logger.log_event(f"[PROTOCOL ERROR] {self.username}: {e}")
+            self.running = False
+        return self.running
+
+    def _handle_frame(self, frame):
+        messages_received.inc()
+        if frame.type == frame_codec.TEXT:
+            payload = frame.payload
+            if frame.flags & frame_codec.FLAG_COMPRESSED:
+                payload = self.inflater.text(payload)
+            trace = None
+            if frame.flags & frame_codec.FLAG_TRACE and len(payload) >= tracing.SENT.size:
+                trace, payload = tracer.begin(self.username, payload, self.read_at)
+            # a traced chat line: _broadcast() picks the trace up
+            self.trace = trace if tracer.enabled else None
+            self._handle_line(self.username, payload.decode('utf-8', errors='replace').strip())
+            self.trace = None
+
+        # a traced message we sent this client is on its screen
+        elif frame.type == frame_codec.TRACE:
+            if tracer.enabled:
+                tracer.report(self.username, frame.payload)
+
+        elif frame.type == frame_codec.AUDIO:
+            self._relay_audio(frame.payload)
+
+        elif frame.type == frame_codec.FILE_META:
+            # payload: "recipient size filename" (filename may contain spaces)
+            parts = frame.payload.decode('utf-8', errors='replace').split(" ", 2)
+            try:
+                recipient, filesize, filename = parts[0], int(parts[1]), parts[2]
+            except (IndexError, ValueError):
+                self._send_to_client(self.client_socket, "[SYSTEM] Malformed file header.")
+                return
+            relay = self.uploads[frame.stream_id] = self._start_upload(recipient, filename, filesize)
+            if filesize == 0:
+                self._finish_upload(self.uploads.pop(frame.stream_id))
+
+        elif frame.type == frame_codec.FILE_RESUME:
+            self._resume_upload(frame)
+
+        elif frame.type == frame_codec.FILE_PARALLEL:
+            self._start_parallel(frame)
+
+        elif frame.type == frame_codec.FILE_PROVE:
+            self._prove_cached(frame)
+
+        elif frame.type == frame_codec.FILE_HAVE:
+            # this client already has the file it is being sent (same digest): stop sending it
+            relay = active_relays.get(frame.stream_id)
+            entry = self.registry.entry_for_socket(self.client_socket)
+            if relay and entry:
+                saved = relay.skip(entry)
+                file_cache.record_saved(saved)
+                logger.log_event("[FILE HAVE] %s already has %s, %d bytes not sent", self.username, relay.filename, saved,
+                                 user=self.username, bytes=saved)
+
+        elif frame.type == frame_codec.FILE_DATA:
+            if frame.stream_id in self.resumable:
+                self._resumable_chunk(frame)
+                return
+            relay = self.uploads.get(frame.stream_id)
+            if relay is None:
+                logger.log_event(f"[PROTOCOL ERROR] {self.username}: data for unknown file stream {frame.stream_id}")
+                return
+            if frame.flags & frame_codec.FLAG_ABORT:
+                # the sender cancelled the upload
+                del self.uploads[frame.stream_id]
+                relay.abort()
+                return
+            chunk, packed = self._unpack_chunk(frame.flags, memoryview(frame.payload))
+            if len(chunk) > relay.remaining:
+                chunk, packed = chunk[:relay.remaining], None
+            self._relay_chunk(relay, chunk, packed)
+            if not relay.remaining:
+                self._finish_upload(self.uploads.pop(frame.stream_id))
+
+        else:
+            logger.log_event(f"[PROTOCOL ERROR] {self.username}: unknown frame type {frame.type}")
+
+    # helper: FILE_RESUME / FILE_PARALLEL payload "transfer_id [key] recipient size chunk_size filename"
+    # (filename may contain spaces, the key is FILE_RESUME's), after the file's sha256 if FLAG_CHECKSUM
+    # is set; None if malformed
+    def _parse_transfer_header(self, frame, max_chunk, keyed=False):
+        payload = frame.payload
+        digest = key = None
+        if frame.flags & frame_codec.FLAG_CHECKSUM:
+            digest, payload = payload[:frame_codec.DIGEST_SIZE], payload[frame_codec.DIGEST_SIZE:]
+        parts = payload.decode('utf-8', errors='replace').split(" ", 5 if keyed else 4)
+        try:
+            if keyed:
+                key = parts.pop(1).encode('utf-8')
+            transfer_id, recipient, filesize, chunk_size, filename = parts[0], parts[1], int(parts[2]), int(parts[3]), parts[4]
+            if filesize < 0 or not 0 < chunk_size <= max_chunk:
+                raise ValueError(parts)
+            if digest is not None and len(digest) != frame_codec.DIGEST_SIZE:
+                raise ValueError(parts)
+        except (IndexError, ValueError):
+            self._send_to_client(self.client_socket, "[SYSTEM] Malformed file header.")
+            return None
+        return transfer_id, recipient, filesize, chunk_size, filename, digest, key
+
+    # helper: an announced file that is in the cache is not uploaded again, but the digest
+    # alone doesn't show the sender has it: ask for the hash of a random range first
+    # (FILE_PROVE). upload() starts the upload instead if the proof fails.
+    # Returns False on a cache miss.
+    def _challenge_cached(self, transfer_id, recipient, filename, filesize, digest, upload):
+        f = file_cache.open(digest, filesize) if digest else None
+        if f is None:
+            return False
+        length = min(PROOF_SIZE, filesize)
+        offset = secrets.randbelow(filesize - length + 1)
+        nonce = secrets.token_bytes(16)
+        try:
+            f.seek(offset)
+            expected = frame_codec.possession_proof(nonce, f.read(length))
+            f.seek(0)
+        except OSError as e:
+            logger.log_event(f"[FILE CACHE ERROR] {e}")
+            f.close()
+            return False
+        self._drop_challenge(transfer_id)
+        self.challenges[transfer_id] = (f, expected, recipient, filename, filesize, digest, upload)
+        outbound = self._outbound(self.client_socket)
+        if outbound:
+            outbound.put(frame_codec.encode_file_challenge(transfer_id, offset, length, nonce), droppable=False)
+        return True
+
+    # FILE_PROVE answer: a correct proof gets the whole file acknowledged right away and the cached copy relayed
+    def _prove_cached(self, frame):
+        try:
+            transfer_id, proof = frame_codec.parse_file_proof(frame.payload)
+        except (IndexError, ValueError):
+            logger.log_event(f"[PROTOCOL ERROR] {self.username}: malformed file proof")
+            return
+        challenge = self.challenges.pop(transfer_id, None)
+        if challenge is None:
+            logger.log_event(f"[PROTOCOL ERROR] {self.username}: proof for unknown transfer {transfer_id}")
             return
+        f, expected, recipient, filename, filesize, digest, upload = challenge
+        if not hmac.compare_digest(proof, expected):
+            # whoever it is only knows the digest: no cache hit, the file has to be uploaded
+            f.close()
+            logger.log_event(f"[FILE CACHE] {self.username} could not prove having {filename}, uploading it",
+                             user=self.username)
+            upload()
+            return
+        logger.log_event("[FILE CACHE HIT] %s (%d bytes) from %s to %s", filename, filesize, self.username, recipient,
+                         user=self.username, bytes=filesize)
+        file_cache.record_hit(filesize)
+        relay = self._start_upload(recipient, filename, filesize, digest=digest)
+        self._send_file_ack(transfer_id, filesize, digest)
+        FilePump(relay, f, self._finish_upload).start(self.threaded)
 
-        target_sock = self.find_socket_by_username(recipient)
-        if not target_sock:
-            self._send_to_client(self.client_socket, f"[SYSTEM] User '{recipient}' not found.")
+    def _drop_challenge(self, transfer_id):
+        challenge = self.challenges.pop(transfer_id, None)
+        if challenge:
+            challenge[0].close()
+
+    # FILE_RESUME: start a resumable upload, or pick up an interrupted one where it stopped
+    def _resume_upload(self, frame):
+        header = self._parse_transfer_header(frame, frame_codec.MAX_PAYLOAD - frame_codec.DIGEST_SIZE, keyed=True)
+        if header is None:
             return
+        transfer_id, recipient, filesize, chunk_size, filename, digest, key = header
 
-        try:
-            target_sock.sendall(meta)
-            target_sock.sendall(filebytes)
-            self._send_to_client(self.client_socket, f"[SYSTEM] File sent to {recipient}: {filename}")
-        except Exception as e:
-            logger.log_event(f"[FILE SEND ERROR] {e}")
-            self._send_to_client(self.client_socket, f"[SYSTEM] Failed to send file: {e}")
+        partial = transfer_spool.get(transfer_id)
+        if partial and not hmac.compare_digest(partial.key, key):
+            # only its sender may resume (or replace) an upload: the one with its key, whatever username
+            # the registry gave the new connection. The partial stays as it is
+            logger.log_event(f"[FILE RESUME ERROR] {self.username} tried to take over {partial.relay.filename} "
+                             f"from {partial.relay.sender} ({transfer_id})", user=self.username)
+            self._send_to_client(self.client_socket, "[SYSTEM] Transfer id already in use.")
+            return
+        if partial and partial.matches(filesize, chunk_size, filename):
+            # the old connection may not have noticed yet that it is dead: take the upload over
+            if partial.owner is not None and partial.owner is not self:
+                partial.owner.resumable = {s: p for s, p in partial.owner.resumable.items() if p is not partial}
+            logger.log_event("[FILE RESUMED] %s from %s at %d/%d bytes", filename, self.username, partial.offset, filesize,
+                             user=self.username, bytes=filesize - partial.offset)
+        else:
+            if partial:
+                # same id, different file: the old one can't be completed any more
+                transfer_spool.remove(partial)
+                partial.abort()
+
+            def upload():
+                partial = PartialUpload(transfer_id, self._start_upload(recipient, filename, filesize, digest=digest),
+                                        chunk_size, key)
+                if digest:
+                    partial.cache_writer = file_cache.writer(digest, filesize)
+                transfer_spool.add(partial)
+                self._attach_resumable(frame.stream_id, partial)
+
+            if not self._challenge_cached(transfer_id, recipient, filename, filesize, digest, upload):
+                upload()
+            return
+
+        self._attach_resumable(frame.stream_id, partial)
+
+    # helper: this connection carries the resumable upload from now on
+    def _attach_resumable(self, stream_id, partial):
+        transfer_spool.attach(partial, self)
+        self.resumable[stream_id] = partial
+        self._send_file_ack(partial.transfer_id, partial.offset, partial.last_digest)
+        if not partial.relay.remaining:
+            self._finish_resumable(stream_id, partial)
+
+    # checksummed FILE_DATA of a resumable upload: verify, relay, acknowledge
+    def _resumable_chunk(self, frame):
+        partial = self.resumable[frame.stream_id]
+        relay = partial.relay
+        if frame.flags & frame_codec.FLAG_ABORT:
+            # cancelled by the sender: nothing to resume
+            del self.resumable[frame.stream_id]
+            transfer_spool.remove(partial)
+            partial.abort()
+            return
+
+        payload = memoryview(frame.payload)
+        digest = payload[:frame_codec.DIGEST_SIZE]
+        chunk, packed = self._unpack_chunk(frame.flags, payload[frame_codec.DIGEST_SIZE:])
+        if (not frame.flags & frame_codec.FLAG_CHECKSUM or len(chunk) != min(partial.chunk_size, relay.remaining)
+                or frame_codec.chunk_digest(chunk) != digest):
+            # nothing past the last good chunk is relayed; the sender resumes from there
+            logger.log_event(f"[FILE CHECKSUM ERROR] {relay.filename} from {self.username} at byte {partial.offset}")
+            self._send_to_client(self.client_socket,
+                                 f"[SYSTEM] Corrupted chunk in {relay.filename} at byte {partial.offset}, upload paused.")
+            del self.resumable[frame.stream_id]
+            transfer_spool.suspend(partial)
+            return
+
+        self._relay_chunk(relay, chunk, packed)
+        if partial.cache_writer:
+            try:
+                partial.cache_writer.write(chunk)
+            except OSError as e:
+                logger.log_event(f"[FILE CACHE ERROR] {e}")
+                partial.cache_writer.discard()
+                partial.cache_writer = None
+        partial.last_digest = bytes(digest)
+        self._send_file_ack(partial.transfer_id, partial.offset, partial.last_digest)
+        if not relay.remaining:
+            self._finish_resumable(frame.stream_id, partial)
+
+    # FILE_PARALLEL: the file's ranges will arrive over extra connections (TransferStreamHandler)
+    def _start_parallel(self, frame):
+        header = self._parse_transfer_header(
+            frame, frame_codec.MAX_PAYLOAD - frame_codec.DIGEST_SIZE - frame_codec.OFFSET.size)
+        if header is None:
+            return
+        transfer_id, recipient, filesize, chunk_size, filename, digest, _ = header
+        if transfer_id in parallel_uploads:
+            self._send_to_client(self.client_socket, "[SYSTEM] Transfer id already in use.")
+            return
+
+        def upload():
+            relay = self._start_upload(recipient, filename, filesize, ranged=True, digest=digest)
+            parallel = parallel_uploads[transfer_id] = ParallelUpload(transfer_id, relay, chunk_size, self)
+            # aborted with the other uploads if this connection goes away
+            self.uploads[frame.stream_id] = relay
+            logger.log_event("[FILE PARALLEL] %s (%d bytes) from %s to %s", filename, filesize, self.username,
+                             recipient, user=self.username, bytes=filesize)
+            self._send_file_ack(transfer_id, 0)
+            if not filesize:
+                self._finish_parallel(parallel)
+
+        # parallel uploads are served from the cache, but not added to it (their
+        # ranges arrive out of order, so they can't be hashed on the way through)
+        if not self._challenge_cached(transfer_id, recipient, filename, filesize, digest, upload):
+            upload()
+
+    # called from the data connection that relayed the last chunk
+    def _finish_parallel(self, upload):
+        if parallel_uploads.get(upload.transfer_id) is upload:
+            del parallel_uploads[upload.transfer_id]
+        self.uploads = {s: r for s, r in self.uploads.items() if r is not upload.relay}
+        self._finish_upload(upload.relay)
+
+    # helper: tell the sender how far its upload got
+    def _send_file_ack(self, transfer_id, offset, digest=b""):
+        outbound = self._outbound(self.client_socket)
+        if outbound:
+            outbound.put(frame_codec.encode_file_ack(transfer_id, offset, digest), droppable=False)
+
+    def _finish_resumable(self, stream_id, partial):
+        del self.resumable[stream_id]
+        transfer_spool.remove(partial)
+        if partial.cache_writer and partial.cache_writer.commit():
+            logger.log_event("[FILE CACHED] %s (%d bytes)", partial.relay.filename, partial.relay.size,
+                             user=partial.relay.sender, bytes=partial.relay.size)
+        self._finish_upload(partial.relay)
+
+    # forward an audio chunk to the call partner (encoded for the partner's protocol)
+    def _relay_audio(self, chunk):
+        start = time.perf_counter()
+        username = self.username
+        session = call_manager.session_for(username)
+        if session is None or session.room is not None:
+            return
+        session.count(username, len(chunk))
+        tcp_audio_bytes.inc(len(chunk))
+        partner_name = session.partner(username)
+        partner_entry = session.entries.get(partner_name)
+        if partner_entry and partner_entry.outbound is not None and not partner_entry.outbound.closed:
+            # audio is droppable: a congested partner loses audio, not the whole call
+            if not self._send_to_entry(partner_entry, frame_codec.encode_audio, (chunk,), droppable=True):
+                logger.log_event(f"[CALL FORWARD ERROR] {partner_name} is gone")
+                # if forwarding fails, end call
+                self._end_call_for(username)
+            else:
+                tcp_relay_seconds.observe(time.perf_counter() - start)
+        else:
+            # partner disconnected — end call
+            self._end_call_for(username)
+
+    # relay the buffered bytes of the legacy upload; returns True once it is complete
+    def _relay_upload(self):
+        relay = self.upload
+        n = min(len(self.rbuf), relay.remaining)
+        if n:
+            # the relay keeps the chunk until every recipient has sent it, so it gets its own copy
+            self._relay_chunk(relay, bytes(self.rbuf.read(n)))
+        if relay.remaining:
+            return False
+
+        self.upload = None
+        self._finish_upload(relay)
+        return True
+
+    # dispatch one newline-terminated command or chat line
+    def _handle_line(self, username, text):
+        # ---- FILE TRANSFER header: /file <recipient> <filename> <size>  (legacy protocol only)
+        if text.startswith("/file ") and self.protocol == LINE:
+            # safe split into 4 parts (cmd, recipient, filename, filesize)
+            parts = text.split(" ", 3)
+            if len(parts) < 4:
+                self._send_to_client(self.client_socket, "[SYSTEM] Malformed /file header.")
+                return
+            _, recipient, filename, size_str = parts
+            try:
+                filesize = int(size_str)
+                if filesize < 0:
+                    raise ValueError(size_str)
+            except:
+                self._send_to_client(self.client_socket, "[SYSTEM] Invalid file size.")
+                return
+
+            # the file bytes follow this line; they are relayed as they arrive
+            self.upload = self._start_upload(recipient, filename, filesize)
+            self._relay_upload()
+            return
+
+        # ---- PRIVATE MESSAGE: /pm recipient message...
+        if text.startswith("/pm "):
+            parts = text.split(" ", 2)
+            if len(parts) < 3:
+                self._send_to_client(self.client_socket, "[SYSTEM] Usage: /pm <username> <message>")
+                return
+            _, target_username, private_msg = parts
+            self._handle_private_message(username, target_username, private_msg)
+            return
+
+        # ---- LIST USERS
+        if text == "/list":
+            self._send_user_list()
+            return
+
+        # ---- FILE CACHE STATS
+        if text == "/cache":
+            self._send_to_client(self.client_socket, file_cache.summary())
+            return
+
+        # ---- CALL STATS (duration and bitrate per call)
+        if text == "/calls":
+            self._send_to_client(self.client_socket, call_manager.summary())
+            return
+
+        # ---- QUIT
+        if text == "/quit":
+            self._send_to_client(self.client_socket, "[SYSTEM] Goodbye.")
+            self.running = False
+            return
+
+        # ---- Voice call signalling commands (textual) ----
+        if text.startswith("/call_request:"):
+            # incoming format: /call_request:target_username[:codecs the caller offers]
+            try:
+                target_username, _, codecs = text.split(":", 1)[1].partition(":")
+            except:
+                self._send_to_client(self.client_socket, "[SYSTEM] Malformed call request.")
+                return
+
+            target_sock = self.find_socket_by_username(target_username)
+            if target_sock:
+                # forward request to target (so GUI can prompt), with the codec offer for it to choose from
+                request = f"/call_request:{username}:{codecs}" if codecs else f"/call_request:{username}"
+                # rings before it is sent: the answer can come back right away
+                call_manager.request(username, target_username)
+                if not self._send_to_client(target_sock, request):
+                    call_manager.cancel_request(username, target_username)
+                    logger.log_event(f"[CALL REQUEST FORWARD ERROR] {target_username} is gone")
+                    self._send_to_client(self.client_socket, f"[SYSTEM] Could not reach {target_username}.")
+            else:
+                self._send_to_client(self.client_socket, f"[SYSTEM] User '{target_username}' not found.")
+            return
+
+        if text.startswith("/call_accept:"):
+            # format: /call_accept:caller_username[:codec]  (sent by callee)
+            try:
+                caller_username, _, codec = text.split(":", 1)[1].partition(":")
+            except:
+                return
+            caller_entry = self.registry.entry_for_user(caller_username)
+            callee_entry = self.registry.entry_for_user(username)
+            if caller_entry and callee_entry:
+                # mark both as in-call (ending whatever calls they were in)
+                session, left = call_manager.start(caller_username, username, codec or "pcm",
+                                                   {caller_username: caller_entry, username: callee_entry})
+                if session is None:
+                    # nothing to accept: only the user a caller asked can answer, once
+                    logger.log_event(f"[CALL ACCEPT ERROR] {username}: no call request from {caller_username}",
+                                     user=username)
+                    self._send_to_client(self.client_socket, f"[SYSTEM] No call request from {caller_username}.")
+                    return
+                for previous in left:
+                    self._after_leave(*previous)
+                # both sides take UDP audio: their media legs go out before the caller starts sending
+                self._open_media(session, (caller_entry, callee_entry))
+                # notify caller that call was accepted (and in which codec); caller will start sending/receiving audio
+                accept = f"/call_accept:{username}:{codec}" if codec else f"/call_accept:{username}"
+                if not self._send_to_client(caller_entry.sock, accept):
+                    logger.log_event(f"[CALL ACCEPT FORWARD ERROR] {caller_username} is gone")
+                    self._end_call_for(username, notify=False)
+                    return
+                logger.log_event(f"[CALL STARTED] {session.summary()}", user=username)
+                # inform callee too (optional)
+                self._send_to_client(self.client_socket, f"[SYSTEM] Call connected with {caller_username}.")
+            return
+
+        if text.startswith("/call_reject:"):
+            # format: /call_reject:caller_username
+            try:
+                caller_username = text.split(":", 1)[1]
+            except:
+                return
+            if not call_manager.cancel_request(caller_username, username):
+                return
+            caller_sock = self.find_socket_by_username(caller_username)
+            if caller_sock and not self._send_to_client(caller_sock, f"/call_reject:{username}"):
+                logger.log_event(f"[CALL REJECT FORWARD ERROR] {caller_username} is gone")
+            return
+
+        if text == "/call_end":
+            # end call for this user (if any)
+            self._end_call_for(username)
+            return
+
+        if text.startswith("/conf_join:"):
+            # format: /conf_join:room[:codecs the client offers]  (left with /call_end)
+            room, _, codecs = text.split(":", 1)[1].partition(":")
+            room = room.strip()
+            if not room:
+                self._send_to_client(self.client_socket, "[SYSTEM] Usage: /conf_join:<room>")
+                return
+            self._join_conference(username, room, codecs)
+            return
+
+        # ---- Otherwise treat as broadcast chat message ----
+        uname = self.registry.username_for(self.client_socket, "Unknown")
+        full_msg = f"[{uname}] ({self.client_address[0]}:{self.client_address[1]}): {text}"
+        logger.log_event("[BROADCAST] %s", full_msg, user=uname, peer=self.client_address)
+        self._broadcast(full_msg)
+
+    # helper: start relaying an upload to recipient (or "all"). Problems that are known
+    # up front are reported right away; the bytes still have to be read, so a relay
+    # with no recipients just discards them.
+    def _start_upload(self, recipient, filename, filesize, ranged=False, digest=None):
+        if recipient.lower() == "all":
+            entries = [e for e in self.registry.entries() if e.sock != self.client_socket]
+        else:
+            entry = self.registry.entry_for_user(recipient)
+            entries = [entry] if entry else []
+            if not entry:
+                self._send_to_client(self.client_socket, f"[SYSTEM] User '{recipient}' not found.")
+
+        relay = FileRelay(self.username, recipient, filename, filesize, entries, self.file_window, ranged, digest)
+        files_relayed.inc()
+        for uname in relay.busy:
+            logger.log_event(f"[FILE SEND ERROR] {uname} is receiving another file, skipped {filename}")
+            if recipient.lower() != "all":
+                self._send_to_client(self.client_socket, f"[SYSTEM] {uname} is receiving another file, try again later.")
+        for uname in relay.unsupported:
+            logger.log_event(f"[FILE SEND ERROR] {uname} can't receive parallel transfers, skipped {filename}")
+            self._send_to_client(self.client_socket, f"[SYSTEM] {uname}'s client can't receive parallel transfers, skipped.")
+        return relay
+
+    # helper: FILE_DATA bytes as (chunk, the chunk as the client compressed it or None)
+    def _unpack_chunk(self, flags, data):
+        if flags & frame_codec.FLAG_COMPRESSED:
+            return compression.inflate_chunk(data), data
+        return data, None
+
+    # helper: hand one chunk to the relay, then apply its backpressure to this sender
+    def _relay_chunk(self, relay, chunk, packed=None):
+        relay.write(chunk, packed)
+        file_bytes.inc(len(chunk))
+        self._apply_backpressure(relay)
+
+    def _apply_backpressure(self, relay):
+        if self.threaded:
+            relay.wait()
+        else:
+            congested = relay.congested()
+            if congested:
+                self.client_socket.throttle(congested)
+
+    # helper: all bytes relayed, tell the sender
+    def _finish_upload(self, relay):
+        delivered = relay.finish()
+        file_seconds.observe(time.perf_counter() - relay.started)
+        if relay.recipient.lower() == "all":
+            self._send_to_client(self.client_socket, f"[SYSTEM] File broadcasted: {relay.filename}")
+        elif delivered:
+            self._send_to_client(self.client_socket, f"[SYSTEM] File sent to {relay.recipient}: {relay.filename}")
+        elif relay.failed:
+            self._send_to_client(self.client_socket, f"[SYSTEM] Failed to send file: {relay.recipient} disconnected")
 
     # helper: private message
     def _handle_private_message(self, sender, target, msg):
@@ -282,50 +847,175 @@ class MessageHandler:
         if not target_sock:
             self._send_to_client(self.client_socket, f"[SYSTEM] User '{target}' not found.")
             return
-        try:
-            target_sock.send(f"[PRIVATE] {sender}: {msg}\n".encode('utf-8'))
+        if self._send_to_client(target_sock, f"[PRIVATE] {sender}: {msg}"):
             self._send_to_client(self.client_socket, f"[SYSTEM] Private message sent to {target}.")
-            logger.log_event(f"[PRIVATE] {sender} -> {target}: {msg}")
-        except Exception as e:
-            logger.log_event(f"[PRIVATE ERROR] {e}")
-            self._send_to_client(self.client_socket, f"[SYSTEM] Failed to deliver private message: {e}")
+            private_messages.inc()
+            logger.log_event("[PRIVATE] %s -> %s: %s", sender, target, msg, user=sender)
+        else:
+            logger.log_event(f"[PRIVATE ERROR] {target} disconnected")
+            self._send_to_client(self.client_socket, f"[SYSTEM] Failed to deliver private message: {target} disconnected")
 
-    # helper: broadcast to everyone (except sender)
+    # helper: broadcast to everyone (except sender).
+    # The registry lock is only held for the snapshot; each recipient's writer does the sending.
     def _broadcast(self, message):
-        with self.clients_lock:
-            for sock in list(self.clients.keys()):
-                if sock != self.client_socket:
-                    try:
-                        sock.send((message + "\n").encode('utf-8'))
-                    except Exception as e:
-                        logger.log_event(f"[BROADCAST ERROR] {e}")
-                        try:
-                            sock.close()
-                        except:
-                            pass
-                        if sock in self.clients:
-                            del self.clients[sock]
+        start = time.perf_counter()
+        trace = self.trace
+        if trace:
+            tracer.add(trace)
+        self._fan_out(lambda protocol, trace_id=None: frame_codec.encode_text(protocol, message, trace_id),
+                      droppable=True, trace=trace)
+        if trace:
+            tracer.fanned_out(trace)
+        broadcasts.inc()
+        broadcast_seconds.observe(time.perf_counter() - start)
+
+    # helper: queue the same message for every client except the sender.
+    # encode(protocol) runs once per wire protocol (not once per recipient) and every
+    # recipient queue gets the same read-only memoryviews, so fan-out cost doesn't
+    # grow with message size. Returns the usernames that could not be reached.
+    # With a trace, recipients that negotiated tracing get encode(protocol, trace id)
+    # instead, and their queueing and writing are stamped (see tracing.py).
+    def _fan_out(self, encode, droppable, trace=None):
+        encoded = {}
+        failed = []
+        queued = 0
+        for entry in self.registry.entries():
+            if entry.sock == self.client_socket or not entry.outbound:
+                continue
+            traced = trace is not None and entry.trace
+            key = "trace" if traced else entry.protocol
+            pieces = encoded.get(key)
+            if pieces is None:
+                pieces = encoded[key] = tuple(memoryview(p) for p in (encode(entry.protocol, trace.id) if traced
+                                                                       else encode(entry.protocol)))
+            if traced:
+                trace.queued(entry.username)
+                sent = entry.outbound.put(pieces, droppable, on_write=trace.writer(entry.username))
+            else:
+                sent = entry.outbound.put(pieces, droppable)
+            if sent:
+                queued += 1
+            else:
+                failed.append(entry.username)
+        broadcast_deliveries.inc(queued)
+        return failed
 
     # helper: send user list back to this client
     def _send_user_list(self):
-        with self.clients_lock:
-            users = list(self.clients.values())
+        users = self.registry.usernames()
         msg = "[SYSTEM] Users online: " + ", ".join(users)
         self._send_to_client(self.client_socket, msg)
 
     def stop(self):
+        # uploads cut off mid-file: recipients must not wait for the rest
+        uploads = list(self.uploads.values()) + ([self.upload] if self.upload else [])
+        self.upload = None
+        self.uploads = {}
+        for transfer_id, upload in list(parallel_uploads.items()):
+            if upload.owner is self:
+                parallel_uploads.pop(transfer_id, None)
+        for relay in uploads:
+            relay.abort()
+        # resumable ones wait for the sender to come back
+        for partial in self.resumable.values():
+            if partial.owner is self:
+                transfer_spool.suspend(partial)
+        self.resumable = {}
+        transfer_spool.purge()
+        for transfer_id in list(self.challenges):
+            self._drop_challenge(transfer_id)
+
         # cleanup: if user was in-call, end the call for both
-        with self.clients_lock:
-            username = self.clients.get(self.client_socket)
+        username = self.registry.username_for(self.client_socket)
+        outbound = self._outbound(self.client_socket)
         if username:
-            # end any active call
-            if username in active_calls:
+            # end any active call (or leave the conference)
+            if username in call_manager:
                 self._end_call_for(username)
+            call_manager.forget(username)
+
+            logger.log_event("[DISCONNECTED] %s %s", username, self.client_address,
+                             user=username, peer=self.client_address)
+            self.registry.remove(self.client_socket)
+
+        try:
+            if outbound:
+                # flush queued replies (e.g. "Goodbye."), then close
+                outbound.close()
+            else:
+                self.client_socket.close()
+        except:
+            pass
+
+
+class TransferStreamHandler(MessageHandler):
+    """
+    A data connection of a parallel upload (hello option transfer=<transfer_id>).
+    It is not a chat user: it only carries FILE_DATA frames with an offset and a
+    checksum, which are verified and relayed in place. Anything else, or the
+    connection closing before the file is complete, fails the whole transfer.
+    """
+
+    def __init__(self, client_socket, client_address, registry, transfer_id, start_thread=True, initial_data=b"",
+                 file_window=FILE_WINDOW):
+        super().__init__(client_socket, client_address, registry, start_thread=False, initial_data=initial_data,
+                         file_window=file_window)
+        self.threaded = start_thread
+        self.protocol = FRAME
+        self.rbuf, self.decoder = None, FrameDecoder()
+        self.parallel = parallel_uploads.get(transfer_id)
+        if self.parallel is None:
+            logger.log_event(f"[PROTOCOL ERROR] {client_address}: data connection for unknown transfer {transfer_id}")
+            self.running = False
+            self.stop()
+        else:
+            self.username = f"{self.parallel.relay.sender} (data)"
 
-            logger.log_event(f"[DISCONNECTED] {username} {self.client_address}")
-            with self.clients_lock:
-                self.clients.pop(self.client_socket, None)
+        if start_thread and self.running:
+            threading.Thread(target=self.handle_client, daemon=True).start()
 
+    def _handle_frame(self, frame):
+        upload = self.parallel
+        if upload is None or parallel_uploads.get(upload.transfer_id) is not upload:
+            # aborted, or completed through another connection
+            self.running = False
+            return
+        if frame.type != frame_codec.FILE_DATA or frame.flags & frame_codec.FLAG_ABORT:
+            self._fail(f"unexpected frame type {frame.type}")
+            return
+
+        payload = memoryview(frame.payload)
+        prefix = frame_codec.OFFSET.size + frame_codec.DIGEST_SIZE
+        if (frame.flags & (frame_codec.FLAG_OFFSET | frame_codec.FLAG_CHECKSUM)
+                != frame_codec.FLAG_OFFSET | frame_codec.FLAG_CHECKSUM or len(payload) < prefix):
+            self._fail("chunk without offset or checksum")
+            return
+        offset = frame_codec.OFFSET.unpack_from(payload)[0]
+        digest, chunk = payload[frame_codec.OFFSET.size:prefix], payload[prefix:]
+        if frame_codec.chunk_digest(chunk) != digest or not upload.claim(offset, len(chunk)):
+            self._fail(f"bad chunk at byte {offset}")
+            return
+
+        complete = upload.relay.write_at(offset, chunk)
+        upload.owner._send_file_ack(upload.transfer_id, upload.offset)
+        if complete:
+            upload.owner._finish_parallel(upload)
+        else:
+            self._apply_backpressure(upload.relay)
+
+    # a broken range: the recipients' files can't be completed
+    def _fail(self, reason):
+        upload = self.parallel
+        logger.log_event(f"[FILE PARALLEL ERROR] {upload.relay.filename} from {upload.relay.sender}: {reason}")
+        self.running = False
+        if parallel_uploads.pop(upload.transfer_id, None) is upload:
+            upload.owner._send_to_client(upload.owner.client_socket,
+                                         f"[SYSTEM] Parallel transfer of {upload.relay.filename} failed: {reason}")
+            upload.relay.abort()
+
+    def stop(self):
+        if self.parallel and parallel_uploads.get(self.parallel.transfer_id) is self.parallel:
+            self._fail("a data connection closed early")
         try:
             self.client_socket.close()
         except:
@@ -333,5 +1023,5 @@ class MessageHandler:
 
 
 # convenience function used by server code to start handler
-def handle_client(client_socket, client_address, clients, clients_lock):
-    MessageHandler(client_socket, client_address, clients, clients_lock)
\ No newline at end of file
+def handle_client(client_socket, client_address, registry, initial_data=b"", file_window=FILE_WINDOW):
+    MessageHandler(client_socket, client_address, registry, initial_data=initial_data, file_window=file_window)
\ No newline at end of file
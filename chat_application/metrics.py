@@ -0,0 +1,273 @@
+# metrics.py
+# In-process metrics for the server, and the HTTP endpoint that exposes them in
+# the Prometheus text format.
+#
+# Modules create their metrics once, at import, and keep the objects:
+#   messages = metrics.counter("chat_messages_received_total", "Chat lines and frames received")
+#   messages.inc()
+# The same name with different labels is another series of the same metric:
+#   metrics.counter("chat_call_audio_bytes_total", "...", transport="tcp")
+# Counters and gauges can also be read from the code that already keeps the
+# number (fn=...), evaluated only when the endpoint is scraped.
+#
+# Histograms are HDR-style: every value lands in one of SUB_BUCKETS buckets per
+# power of two of microseconds, so any quantile is known to within about 6%
+# from 1 us up to days, with a fixed array of counts and no allocation per
+# value. The endpoint shows them as Prometheus histograms over the LE bounds;
+# quantile() gives percentiles in-process (summary() logs them).
+#
+# Recording takes one uncontended lock per call: well under a microsecond
+# (bench_metrics.py), cheap enough to leave on.
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS     # buckets per power of two
+MAX_SHIFT = 40                  # up to 2^44 us (half a year); longer values go in the last bucket
+N_BUCKETS = (MAX_SHIFT + 2) * SUB_BUCKETS
+# histogram bucket bounds on the endpoint (seconds)
+LE = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    """Goes up only."""
+
+    type = "counter"
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def get(self):
+        return self.fn() if self.fn else self.value
+
+    def samples(self, name, labels):
+        return [(name, labels, self.get())]
+
+
+class Gauge(Counter):
+    """Goes up and down."""
+
+    type = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+
+# helper: bucket of a value in microseconds
+def _bucket(us):
+    if us < 2 * SUB_BUCKETS:
+        return us if us > 0 else 0
+    shift = us.bit_length() - SUB_BITS - 1
+    if shift > MAX_SHIFT:
+        return N_BUCKETS - 1
+    return shift * SUB_BUCKETS + (us >> shift)
+
+
+# helper: [lower, upper) microseconds of a bucket
+def _bounds(index):
+    if index < 2 * SUB_BUCKETS:
+        return index, index + 1
+    shift = index // SUB_BUCKETS - 1
+    top = index - shift * SUB_BUCKETS
+    return top << shift, (top + 1) << shift
+
+
+class Histogram:
+    """Distribution of durations (seconds), in log-linear buckets."""
+
+    type = "histogram"
+
+    def __init__(self):
+        self.counts = [0] * N_BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = _bucket(int(seconds * 1e6))
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    # time a block: with histogram.time(): ...
+    def time(self):
+        return _Timer(self)
+
+    # the value (seconds) q of the observations are at or below, to within a bucket
+    def quantile(self, q):
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for index, n in enumerate(counts):
+            seen += n
+            if n and seen >= rank:
+                lower, upper = _bounds(index)
+                return (lower + upper) / 2 / 1e6
+        return _bounds(N_BUCKETS - 1)[1] / 1e6
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            count, total = self.count, self.sum
+        out = []
+        cumulative = 0
+        index = 0
+        for le in LE:
+            limit = le * 1e6
+            # buckets entirely at or below the bound
+            while index < N_BUCKETS and _bounds(index)[1] <= limit:
+                cumulative += counts[index]
+                index += 1
+            out.append((name + "_bucket", labels + (("le", repr(le)),), cumulative))
+        out.append((name + "_bucket", labels + (("le", "+Inf"),), count))
+        out.append((name + "_sum", labels, total))
+        out.append((name + "_count", labels, count))
+        return out
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    """Every metric of the process, by name and labels."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}           # name -> (type, help, {labels: metric})
+
+    def _get(self, cls, name, help, labels, fn=None):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.metrics.get(name)
+            if family is None:
+                family = self.metrics[name] = (cls.type, help, {})
+            elif family[0] != cls.type:
+                raise ValueError(f"Metric {name} is a {family[0]}, not a {cls.type}")
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = cls(fn) if fn is not None else cls()
+            elif fn is not None:
+                metric.fn = fn      # re-registered (e.g. a new server instance): read the new source
+            return metric
+
+    def counter(self, name, help, fn=None, **labels):
+        return self._get(Counter, name, help, labels, fn)
+
+    def gauge(self, name, help, fn=None, **labels):
+        return self._get(Gauge, name, help, labels, fn)
+
+    def histogram(self, name, help, **labels):
+        return self._get(Histogram, name, help, labels)
+
+    # the Prometheus text exposition format (version 0.0.4)
+    def render(self):
+        with self.lock:
+            families = sorted((name, kind, help, list(series.items()))
+                              for name, (kind, help, series) in self.metrics.items())
+        lines = []
+        for name, kind, help, series in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in series:
+                try:
+                    samples = metric.samples(name, labels)
+                except Exception:
+                    continue        # a fn= source that is gone; skip the series this time
+                for sample_name, sample_labels, value in samples:
+                    lines.append(f"{sample_name}{_labels(sample_labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+    # histograms as "name p50/p99/p999" for the log
+    def summary(self):
+        with self.lock:
+            histograms = [(name, labels, metric) for name, (kind, _, series) in self.metrics.items()
+                          if kind == "histogram" for labels, metric in series.items()]
+        parts = []
+        for name, labels, metric in sorted(histograms, key=lambda h: (h[0], h[1])):
+            if metric.count:
+                parts.append(f"{name}{_labels(labels)} n={metric.count} "
+                             f"p50={metric.quantile(0.5) * 1000:.3f}ms p99={metric.quantile(0.99) * 1000:.3f}ms "
+                             f"p999={metric.quantile(0.999) * 1000:.3f}ms")
+        return " | ".join(parts) if parts else "no observations"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value) if value == value else "NaN"
+    return str(value)
+
+
+# the process-wide registry, and shortcuts to it
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+
+start_time = time.time()
+gauge("chat_process_start_time_seconds", "When the server process started (unix time)", fn=lambda: start_time)
+
+
+# ---------- HTTP endpoint ----------
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass                        # scrapes every few seconds would flood the log
+
+
+class MetricsServer:
+    """GET /metrics on host:port, served from its own thread."""
+
+    def __init__(self, host="127.0.0.1", port=9100, registry=registry):
+        self.httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = registry
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True, name="metrics")
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,272 @@
+# outbound_queue.py
+import collections
+import socket
+import threading
+import metrics
+from frame_codec import LINE, encode_text
+from logger_utility import Logger
+
+logger = Logger()
+
+dropped_messages = metrics.counter("chat_outbound_dropped_total", "Messages dropped for slow clients (full send queue)")
+coalesced_messages = metrics.counter("chat_outbound_coalesced_total", "Messages replaced by a 'messages skipped' notice")
+
+OVERFLOW_POLICIES = ("drop", "disconnect", "coalesce")
+
+# the writer sends whatever is queued in one go, up to this many bytes per write
+WRITE_BATCH_BYTES = 64 * 1024
+# pieces at least this big are written as they are instead of being copied into a batch
+DIRECT_WRITE_BYTES = 16 * 1024
+
+
+def skipped_notice(count, protocol=LINE):
+    return b"".join(encode_text(protocol, f"[SYSTEM] {count} messages skipped (connection too slow)."))
+
+
+class OutboundQueue:
+    """
+    Bounded send queue for one client, drained by its own writer thread.
+
+    Everything the server sends to a client goes through here, so senders never
+    block on a slow reader and the writer thread is the only one writing the socket.
+    When queued bytes would exceed max_bytes, the overflow policy decides:
+      drop        - droppable messages (broadcast chat, audio) are discarded
+      disconnect  - the slow client is disconnected
+      coalesce    - the oldest droppable messages are evicted and replaced by one
+                    "[SYSTEM] n messages skipped" notice
+    Messages that must not be dropped (replies, private messages, file bytes) wait
+    up to block_timeout for room; after that the client is disconnected.
+
+    A relayed file to a newline-protocol client is an exclusive stream (its raw
+    bytes can't be interleaved with anything): between begin_stream() and
+    end_stream() only the stream's owner is queued, everything else is parked.
+
+    With a deflater (compression.Deflater) the writer compresses text frames as it
+    sends them, so only messages that really go out pass through the stream context.
+    """
+
+    def __init__(self, sock, max_bytes=1 << 20, policy="drop", block_timeout=10.0, name="",
+                 notice=skipped_notice, deflater=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.sock = sock
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.notice = notice                # builds the "n messages skipped" message in the client's protocol
+        self.deflater = deflater
+
+        self.items = collections.deque()    # (pieces, size, droppable, on_write)
+        self.size = 0
+        self.stream_owner = None            # exclusive stream in progress (see begin_stream)
+        self.held = collections.deque()     # messages parked while it runs
+        self.held_size = 0
+        self.cond = threading.Condition()
+        self.closing = False                # flush what is queued, then close
+        self.closed = False                 # gone: nothing more is sent
+
+        # counters
+        self.dropped = 0
+        self.skipped = 0                    # coalesced away, notice not sent yet
+        self.coalesced = 0
+
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f"writer-{name}")
+        self.thread.start()
+
+    # queue one message for sending: a buffer, or a tuple of buffers that must go out
+    # together (e.g. frame header + payload). Returns False only if the client is gone
+    # (closed or disconnected by the overflow policy); a policy drop still returns True.
+    # owner: the exclusive stream this message belongs to, if any.
+    # on_write: called by the writer right before the message is written (latency tracing, see tracing.py).
+    def put(self, data, droppable=True, owner=None, on_write=None):
+        pieces = data if isinstance(data, tuple) else (data,)
+        size = sum(len(piece) for piece in pieces)
+        with self.cond:
+            if self.closed or self.closing:
+                return False
+            if self.stream_owner is not None and owner is not self.stream_owner:
+                # park it until the stream is done; chat is dropped once the parking space is full
+                if droppable and self.held_size + size > self.max_bytes:
+                    self.dropped += 1
+                    dropped_messages.inc()
+                else:
+                    self.held.append((pieces, size, droppable, on_write))
+                    self.held_size += size
+                return True
+            if self.items and self.size + size > self.max_bytes:
+                if not self._make_room(size, droppable):
+                    return not self.closed
+            self.items.append((pieces, size, droppable, on_write))
+            self.size += size
+            self.cond.notify_all()
+            return True
+
+    # make owner the only sender until end_stream(); False if another stream is in progress
+    def begin_stream(self, owner):
+        with self.cond:
+            if self.stream_owner is not None or self.closed:
+                return False
+            self.stream_owner = owner
+            return True
+
+    # end owner's exclusive stream and queue what was parked meanwhile
+    def end_stream(self, owner):
+        with self.cond:
+            if self.stream_owner is not owner:
+                return
+            self.stream_owner = None
+            self.items.extend(self.held)
+            self.size += self.held_size
+            self.held.clear()
+            self.held_size = 0
+            self.cond.notify_all()
+
+    # block until at most limit bytes are queued (sender-side backpressure);
+    # False if the client went away or did not drain within block_timeout
+    def wait_below(self, limit):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.closed or self.size <= limit,
+                                      timeout=self.block_timeout) and not self.closed
+
+    # bytes queued for the writer (parked messages don't count)
+    def pending_bytes(self):
+        return self.size
+
+    def abort(self, reason):
+        with self.cond:
+            if not self.closed:
+                self._abort(reason)
+
+    # called with cond held; True once data fits, False if it was dropped or the client cut off
+    def _make_room(self, needed, droppable):
+        if self.policy == "disconnect":
+            self._abort("outbound queue full")
+            return False
+
+        if self.policy == "coalesce":
+            kept = collections.deque()
+            for item in self.items:
+                if item[2] and self.size + needed > self.max_bytes:
+                    self.size -= item[1]
+                    self.skipped += 1
+                    self.coalesced += 1
+                    coalesced_messages.inc()
+                else:
+                    kept.append(item)
+            self.items = kept
+            if not self.items or self.size + needed <= self.max_bytes:
+                return True
+
+        if droppable:
+            self.dropped += 1
+            dropped_messages.inc()
+            return False
+
+        # must be delivered: wait for the writer to make room (backpressure on the sender)
+        fits = self.cond.wait_for(
+            lambda: self.closed or not self.items or self.size + needed <= self.max_bytes,
+            timeout=self.block_timeout)
+        if self.closed:
+            return False
+        if not fits:
+            self._abort("outbound queue stalled")
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.items and not self.closing and not self.closed:
+                    self.cond.wait()
+                if self.closed or not self.items:
+                    break
+                # no notice in the middle of an exclusive stream
+                skipped = self.skipped if self.stream_owner is None else 0
+                self.skipped -= skipped
+                batch = [(self.notice(skipped),)] if skipped else []
+                batch_size = 0
+                callbacks = []
+                while self.items and (not batch or batch_size + self.items[0][1] <= WRITE_BATCH_BYTES):
+                    pieces, size, _, on_write = self.items.popleft()
+                    batch.append(pieces)
+                    batch_size += size
+                    if on_write:
+                        callbacks.append(on_write)
+                self.size -= batch_size
+                self.cond.notify_all()      # wake senders waiting for room
+
+            for on_write in callbacks:
+                on_write()
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.log_event(f"[SEND ERROR] {e}")
+                break
+
+        with self.cond:
+            self.closed = True
+            self.items.clear()
+            self.size = 0
+            self.cond.notify_all()
+        self._close_socket()
+
+    # one TLS record + syscall for many small pieces; big (shared) buffers go out uncopied
+    def _write(self, batch):
+        small = []
+        for pieces in batch:
+            if self.deflater:
+                pieces = self.deflater.pack(pieces)
+            for piece in pieces:
+                if len(piece) >= DIRECT_WRITE_BYTES:
+                    if small:
+                        self.sock.sendall(b"".join(small))
+                        small = []
+                    self.sock.sendall(piece)
+                else:
+                    small.append(piece)
+        if small:
+            self.sock.sendall(small[0] if len(small) == 1 else b"".join(small))
+
+    # flush whatever is queued, then close the socket (from the writer thread)
+    def close(self):
+        with self.cond:
+            if self.closing or self.closed:
+                return
+            self.closing = True
+            self.cond.notify_all()
+        try:
+            # the reader is gone by now; don't let a stuck peer keep the writer alive forever
+            self.sock.settimeout(self.block_timeout)
+        except:
+            pass
+
+    # drop everything and cut the client off (called with cond held)
+    def _abort(self, reason):
+        logger.log_event(f"[SLOW CLIENT] {reason}, disconnecting {self._peer()}")
+        self.closed = True
+        self.items.clear()
+        self.size = 0
+        self.held.clear()
+        self.held_size = 0
+        self.cond.notify_all()
+        try:
+            # wakes the client's reader thread, which then runs the normal disconnect cleanup
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+
+    def _close_socket(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        try:
+            self.sock.close()
+        except:
+            pass
+
+    def _peer(self):
+        try:
+            return self.sock.getpeername()
+        except:
+            return "?"
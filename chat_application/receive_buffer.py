@@ -0,0 +1,123 @@
+# receive_buffer.py
+# Reusable receive buffer for the server handler (message_handler.py) and the
+# client receiver (client_handler.py, through frame_codec.FrameDecoder).
+#
+# Unread bytes live in one preallocated bytearray between `start` (next unread
+# byte) and `end` (next free byte). recv_into() lets the socket write straight
+# into the free tail, lines and fixed-size blocks are handed out as memoryviews
+# over the buffer, and consumed space is reclaimed by moving the unread remainder
+# to the front only when the tail runs out. Every received byte is copied a
+# constant number of times, however the data was split across recv() calls.
+#
+# Buffers start small, so an idle connection costs DEFAULT_SIZE bytes; a recv
+# that fills its whole request doubles the next one (up to MAX_RECV) and the
+# buffer grows with it, and once the burst is over both go back to their
+# initial size.
+
+DEFAULT_SIZE = 4 * 1024
+MAX_RECV = 64 * 1024
+
+
+class ReceiveBuffer:
+    """
+    Views returned by readline(), read() and peek() point into the buffer and are
+    only valid until the next call that adds data (recv_into() / feed()); take
+    bytes(view) of anything that has to live longer.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.initial_size = size
+        self.buf = bytearray(size)
+        self.recv_size = size   # next recv_into() request, adapted to how much the socket has
+        self.start = 0
+        self.end = 0
+        self.scanned = 0        # readline() resumes its search here, a partial line is never rescanned
+
+    def __len__(self):
+        return self.end - self.start
+
+    # ---------- filling ----------
+
+    # receive from sock directly into the buffer; returns the count (0 = EOF).
+    # nbytes: fixed request size, instead of the adaptive one
+    def recv_into(self, sock, nbytes=None):
+        want = nbytes or self.recv_size
+        self._reserve(want)
+        n = sock.recv_into(memoryview(self.buf)[self.end:], want)
+        self.end += n
+        if nbytes is None:
+            if n == want:
+                self.recv_size = min(2 * want, MAX_RECV)
+            elif n < self.initial_size:
+                self.recv_size = self.initial_size
+        return n
+
+    # append bytes that were received elsewhere (event-loop server)
+    def feed(self, data):
+        n = len(data)
+        self._reserve(n)
+        self.buf[self.end:self.end + n] = data
+        self.end += n
+
+    # make room for n more bytes after `end`
+    def _reserve(self, n):
+        if len(self.buf) - self.end >= n:
+            return
+        pending = self.end - self.start
+
+        if pending == 0 and len(self.buf) > 4 * self.initial_size and n <= self.initial_size:
+            # done with a burst of large messages: give the memory back
+            self.buf = bytearray(self.initial_size)
+        elif pending + n <= len(self.buf) and pending <= self.start:
+            # slide the unread bytes to the front (the regions don't overlap)
+            self.buf[:pending] = memoryview(self.buf)[self.start:self.end]
+        else:
+            # grow into a new bytearray; views handed out earlier stay intact
+            new = bytearray(max(2 * len(self.buf), pending + n))
+            new[:pending] = memoryview(self.buf)[self.start:self.end]
+            self.buf = new
+
+        self.scanned -= self.start
+        self.start = 0
+        self.end = pending
+
+    # ---------- extraction (zero-copy views) ----------
+
+    # next line without its "\n", or None if no complete line is buffered yet
+    def readline(self):
+        i = self.buf.find(b"\n", self.scanned, self.end)
+        if i < 0:
+            self.scanned = self.end
+            return None
+        line = memoryview(self.buf)[self.start:i]
+        self.start = self.scanned = i + 1
+        return line
+
+    # exactly n bytes, or None if fewer are buffered
+    def read(self, n):
+        if self.end - self.start < n:
+            return None
+        view = memoryview(self.buf)[self.start:self.start + n]
+        self.skip(n)
+        return view
+
+    # everything buffered
+    def read_all(self):
+        return self.read(self.end - self.start)
+
+    # look at the next n bytes without consuming them (None if fewer are buffered)
+    def peek(self, n):
+        if self.end - self.start < n:
+            return None
+        return memoryview(self.buf)[self.start:self.start + n]
+
+    def skip(self, n):
+        self.start += n
+        self.scanned = max(self.scanned, self.start)
+
+    # copy buffered bytes into target (a writable buffer); returns how many were copied
+    def read_into(self, target):
+        n = min(len(target), self.end - self.start)
+        target[:n] = memoryview(self.buf)[self.start:self.start + n]
+        self.skip(n)
+        return n
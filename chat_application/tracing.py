@@ -0,0 +1,236 @@
+# tracing.py
+# End-to-end latency tracing of chat messages, shared by the server
+# (message_handler.py) and the client (client_handler.py).
+#
+# A framed client offers "trace=1" in its hello; a server started with --trace
+# accepts it in its own. From then on the client may send a chat line as a TEXT
+# frame with FLAG_TRACE whose payload starts with SENT:
+#
+#   trace id u64 | sent (client wall clock, f64) | client time (f64) | text
+#
+# "client time" is ChatGUI.send_message -> socket write, on the client's
+# monotonic clock. The server stamps, on its own monotonic clock, when it read
+# the frame, when it queued the broadcast for each recipient and when that
+# recipient's writer took it off the queue. Recipients that also offered tracing
+# get the line with FLAG_TRACE and the trace id in front of the text; once the
+# line is on screen they answer with a TRACE frame (REPORT):
+#
+#   trace id u64 | received (client wall clock, f64) | display time (f64)
+#
+# and the server puts the hops together:
+#   client_send    GUI send -> socket write (sender's clock)
+#   uplink         socket write -> server read (wall clocks of both sides)
+#   server_handle  server read -> queued for the recipient (lock in _broadcast, logging, fan-out)
+#   server_queue   queued -> recipient's writer takes it
+#   downlink       writer -> recipient read (wall clocks of both sides)
+#   client_display recipient read -> display_message() done (recipient's clock)
+#   total          the sum of the above
+# Each hop goes into a chat_trace_hop_seconds{hop=...} histogram (metrics.py);
+# with --trace-file every delivery is also written out as Chrome trace events
+# (open in chrome://tracing or ui.perfetto.dev). uplink and downlink compare two
+# hosts' clocks, so they are only as good as the clock sync between them (exact
+# on one machine); the other hops never mix clocks.
+import atexit
+import itertools
+import json
+import math
+import os
+import random
+import struct
+import threading
+import time
+import metrics
+
+SENT = struct.Struct("!Qdd")
+REPORT = struct.Struct("!Qdd")
+
+HOPS = ("client_send", "uplink", "server_handle", "server_queue", "downlink", "client_display", "total")
+TRACE_TTL = 60.0        # seconds a trace waits for its recipients' reports
+FLUSH_INTERVAL = 1.0    # the trace file is flushed at least this often while traces come in
+
+
+# ---------- negotiation ----------
+
+# hello options of a client that traces (some of) its messages
+def offer():
+    return {"trace": "1"}
+
+
+def accepted(options):
+    return (options or {}).get("trace") == "1"
+
+
+# ---------- client side ----------
+
+def new_trace_id():
+    return random.getrandbits(64)
+
+
+# payload prefix of a traced chat line; started: time.perf_counter() at the GUI's send
+def encode_sent(trace_id, started=None):
+    return SENT.pack(trace_id, time.time(), time.perf_counter() - started if started is not None else 0.0)
+
+
+def encode_report(trace_id, received, display):
+    return REPORT.pack(trace_id, received, display)
+
+
+# ---------- server side ----------
+
+class Trace:
+    """One traced message on the server: its sender's stamps, then one [queued, written] per recipient."""
+
+    __slots__ = ("id", "sender", "sent", "client_send", "read", "anchor", "stamps", "fanning_out")
+
+    def __init__(self, trace_id, sender, sent, client_send, read):
+        self.id = trace_id
+        self.sender = sender
+        self.sent = sent                # client wall clock
+        self.client_send = client_send
+        self.read = read                # time.perf_counter() when the frame was read
+        self.anchor = time.time() - time.perf_counter()     # perf_counter -> wall clock
+        self.stamps = {}
+        self.fanning_out = True         # more recipients may still be queued
+
+    # called right before the message is put in username's outbound queue
+    def queued(self, username):
+        self.stamps[username] = [time.perf_counter(), None]
+
+    # a writer's callback: username's copy is about to be written (OutboundQueue on_write)
+    def writer(self, username):
+        stamp = self.stamps[username]
+
+        def written():
+            stamp[1] = time.perf_counter()
+        return written
+
+
+class Tracer:
+    """Traces in flight, the per-hop histograms and the trace file."""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.pending = {}               # trace id -> (deadline, Trace), oldest first
+        self.hops = {hop: metrics.histogram("chat_trace_hop_seconds", "Latency of one hop of a traced chat message",
+                                            hop=hop) for hop in HOPS}
+        metrics.gauge("chat_trace_pending", "Traced messages waiting for their recipients' reports",
+                      fn=lambda: len(self.pending))
+        self.file = None
+        self.threads = {}               # recipient -> tid in the trace file
+        self.tids = itertools.count(1)
+        self.flushed = 0.0
+
+    # enabled: accept clients' trace offers; path: also write every delivery as Chrome trace events
+    def configure(self, enabled=True, path=None):
+        self.enabled = enabled or bool(path)
+        with self.lock:
+            self._close()
+            if path:
+                fresh = not os.path.exists(path) or os.path.getsize(path) == 0
+                self.file = open(path, "a", encoding="utf-8")
+                if fresh:
+                    # JSON array format; the closing "]" is optional, so the file is valid while it grows
+                    self.file.write("[\n")
+                atexit.register(self.close)
+
+    # payload of a traced TEXT frame -> (Trace, the text's bytes)
+    def begin(self, sender, payload, read):
+        trace_id, sent, client_send = SENT.unpack_from(payload)
+        return Trace(trace_id, sender, sent, client_send, read), payload[SENT.size:]
+
+    # a trace whose message is about to be fanned out (reports can come back before the fan-out is over)
+    def add(self, trace):
+        now = time.monotonic()
+        with self.lock:
+            self.pending[trace.id] = (now + TRACE_TTL, trace)
+            # expire traces whose reports never came (dropped messages, recipients gone)
+            while self.pending:
+                trace_id, (deadline, _) = next(iter(self.pending.items()))
+                if deadline > now:
+                    break
+                del self.pending[trace_id]
+
+    # every recipient is queued: the trace is done once they have all reported
+    def fanned_out(self, trace):
+        with self.lock:
+            trace.fanning_out = False
+            if not trace.stamps:
+                self.pending.pop(trace.id, None)
+
+    # a recipient's TRACE frame: the hops of its copy go into the histograms (and the file)
+    def report(self, username, payload):
+        if len(payload) < REPORT.size:
+            return
+        trace_id, received, display = REPORT.unpack_from(payload)
+        with self.lock:
+            entry = self.pending.get(trace_id)
+            if entry is None:
+                return
+            trace = entry[1]
+            stamp = trace.stamps.pop(username, None)
+            if not trace.stamps and not trace.fanning_out:
+                del self.pending[trace_id]
+        if stamp is None or stamp[1] is None:
+            return
+        # the clients' numbers are untrusted: no inf/nan
+        if not all(math.isfinite(value) for value in (trace.sent, trace.client_send, received, display)):
+            return
+
+        queued, written = stamp
+        read_wall = trace.read + trace.anchor
+        written_wall = written + trace.anchor
+        hops = {"client_send": trace.client_send,
+                "uplink": read_wall - trace.sent,
+                "server_handle": queued - trace.read,
+                "server_queue": written - queued,
+                "downlink": received - written_wall,
+                "client_display": display}
+        # wall clocks that disagree can make a network hop look negative; a hop can't
+        # take longer than the trace lives, so one bogus report can't skew the percentiles far
+        hops = {hop: min(max(0.0, seconds), TRACE_TTL) for hop, seconds in hops.items()}
+        hops["total"] = sum(hops.values())
+        for hop, seconds in hops.items():
+            self.hops[hop].observe(seconds)
+        if self.file:
+            self._write(trace, username, hops)
+
+    # the delivery as one span per hop, laid end to end on the recipient's row
+    def _write(self, trace, username, hops):
+        args = {"trace": f"{trace.id:016x}", "from": trace.sender, "to": username}
+        start = trace.sent - hops["client_send"]
+        events = []
+        with self.lock:
+            if self.file is None:
+                return
+            tid = self.threads.get(username)
+            if tid is None:
+                tid = self.threads[username] = next(self.tids)
+                events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": username}})
+            for hop in HOPS[:-1]:
+                events.append({"name": hop, "cat": "chat", "ph": "X", "pid": 1, "tid": tid,
+                               "ts": round(start * 1e6), "dur": round(hops[hop] * 1e6), "args": args})
+                start += hops[hop]
+            self.file.write("".join(json.dumps(event) + ",\n" for event in events))
+            now = time.monotonic()
+            if now - self.flushed >= FLUSH_INTERVAL:
+                self.file.flush()
+                self.flushed = now
+
+    def flush(self):
+        with self.lock:
+            if self.file:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.file:
+            try:
+                self.file.close()
+            except:
+                pass
+            self.file = None
+            self.threads = {}
@@ -0,0 +1,134 @@
+# transfer_spool.py
+# Server-side state of resumable uploads (FILE_RESUME / checksummed FILE_DATA).
+#
+# A resumable upload is relayed cut-through like any other (file_relay.py). What
+# the spool adds is what survives the sender's connection: the transfer id, the
+# offset acknowledged so far, the digest of the last acknowledged chunk, and the
+# relay itself. When the sender drops, its relay is suspended instead of
+# aborted: recipients keep what they already have, and when the sender comes
+# back with the same transfer id and key it continues from the acknowledged offset.
+# Nothing of the file is kept on disk or in memory here.
+#
+# ParallelUpload is the matching state of a FILE_PARALLEL upload, whose ranges
+# arrive over several connections. It is not resumable: ranges complete out of
+# order, so no single acknowledged offset describes how far it got.
+import threading
+import time
+from logger_utility import Logger
+
+logger = Logger()
+
+SPOOL_TTL = 300.0           # seconds an interrupted upload waits for its sender
+SPOOL_MAX_SUSPENDED = 64    # interrupted uploads kept at most (the oldest go first)
+
+
+class PartialUpload:
+
+    def __init__(self, transfer_id, relay, chunk_size, key):
+        self.transfer_id = transfer_id
+        self.relay = relay
+        self.chunk_size = chunk_size
+        self.key = key              # the sender's secret for this upload, asked for when it is resumed
+        self.last_digest = b""      # sha256 of the last acknowledged chunk
+        self.owner = None           # MessageHandler receiving it, None while suspended
+        self.suspended_at = None
+        self.cache_writer = None    # file_cache.CacheWriter when the upload is being cached
+
+    # bytes received, verified and relayed
+    @property
+    def offset(self):
+        return self.relay.received
+
+    # a resume request describes the same upload
+    def matches(self, size, chunk_size, filename):
+        return (self.relay.size, self.chunk_size, self.relay.filename) == (size, chunk_size, filename)
+
+    # give up on it: recipients discard what they got
+    def abort(self):
+        self.relay.abort()
+        if self.cache_writer:
+            self.cache_writer.discard()
+
+
+class ParallelUpload:
+
+    def __init__(self, transfer_id, relay, chunk_size, owner):
+        self.transfer_id = transfer_id
+        self.relay = relay
+        self.chunk_size = chunk_size
+        self.owner = owner          # MessageHandler of the sender's chat connection
+        self.last_digest = b""
+        self.lock = threading.Lock()
+        self.done = set()           # offsets of the chunks relayed so far
+
+    @property
+    def offset(self):
+        return self.relay.received
+
+    # claim the chunk at offset for relaying; False if it is misaligned, the wrong size or a repeat
+    def claim(self, offset, length):
+        if offset % self.chunk_size or length != min(self.chunk_size, self.relay.size - offset):
+            return False
+        with self.lock:
+            if offset in self.done:
+                return False
+            self.done.add(offset)
+            return True
+
+
+class TransferSpool:
+    """
+    Expiry is lazy: suspended uploads past the TTL are aborted the next time the
+    spool is touched (a resume, a new resumable upload, a disconnect).
+    """
+
+    def __init__(self, ttl=SPOOL_TTL, max_suspended=SPOOL_MAX_SUSPENDED):
+        self.ttl = ttl
+        self.max_suspended = max_suspended
+        self.lock = threading.Lock()
+        self.partial = {}           # transfer_id -> PartialUpload
+
+    def get(self, transfer_id):
+        self.purge()
+        with self.lock:
+            return self.partial.get(transfer_id)
+
+    def add(self, partial):
+        with self.lock:
+            self.partial[partial.transfer_id] = partial
+
+    def remove(self, partial):
+        with self.lock:
+            if self.partial.get(partial.transfer_id) is partial:
+                del self.partial[partial.transfer_id]
+
+    # claim an upload for the connection now sending it
+    def attach(self, partial, owner):
+        partial.owner = owner
+        partial.suspended_at = None
+
+    # the sender's connection went away mid-upload. Newline-protocol recipients are
+    # let go of now rather than held until the resume (FileRelay.release_streams)
+    def suspend(self, partial):
+        partial.owner = None
+        partial.suspended_at = time.monotonic()
+        partial.relay.release_streams()
+        logger.log_event(f"[FILE SUSPENDED] {partial.relay.filename} from {partial.relay.sender} "
+                         f"at {partial.offset}/{partial.relay.size} bytes ({partial.transfer_id})")
+        self.purge()
+
+    # abort suspended uploads that expired or don't fit any more
+    def purge(self):
+        now = time.monotonic()
+        with self.lock:
+            suspended = sorted((p for p in self.partial.values() if p.owner is None),
+                               key=lambda p: p.suspended_at)
+            excess = len(suspended) - self.max_suspended
+            dropped = [p for i, p in enumerate(suspended) if i < excess or now - p.suspended_at > self.ttl]
+            for partial in dropped:
+                del self.partial[partial.transfer_id]
+
+        for partial in dropped:
+            logger.log_event(f"[FILE EXPIRED] {partial.relay.filename} from {partial.relay.sender} "
+                             f"was not resumed ({partial.transfer_id})")
+            partial.abort()
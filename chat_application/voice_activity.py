@@ -0,0 +1,149 @@
+# voice_activity.py
+# Voice activity detection for the sending side of a call, and the comfort noise
+# the receiving side plays in the gaps.
+#
+# Each captured frame is measured for its level (dBov: dB below a full-scale
+# square wave) and its zero-crossing rate. It counts as speech if it is
+# SPEECH_MARGIN_DB over the background noise, or a bit less than that with many
+# zero crossings (unvoiced sounds like "s" and "f" are quiet but noisy). The
+# noise floor is the quietest frame of the last NOISE_WINDOW seconds: speech
+# always has quieter moments between words than that, while a fan that comes on
+# is background again NOISE_WINDOW seconds later instead of speech forever.
+# Until a window's worth has been heard, the floor is at most START_FLOOR_DB, so
+# talking as soon as the call connects isn't taken for the background.
+#
+# Speech frames, and HANGOVER seconds of frames after them (so word endings and
+# short pauses aren't clipped), are sent. The rest are suppressed: nothing goes
+# on the wire except a COMFORT_NOISE packet (media.py) when silence starts and
+# every COMFORT_REFRESH seconds after, carrying the noise level as one byte of
+# -dBov like RTP comfort noise (RFC 3389). The receiver's jitter buffer plays
+# noise at that level instead of dead silence, and the refresh keeps the NAT
+# binding and the relay's idea of our address alive.
+#
+# Measurement uses NumPy when it's installed, plain Python otherwise.
+import array
+import collections
+import math
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SPEECH_MARGIN_DB = 9.0          # over the noise floor: speech
+UNVOICED_MARGIN_DB = 4.0        # over the noise floor with UNVOICED_ZCR crossings: unvoiced speech
+UNVOICED_ZCR = 0.3              # zero crossings per sample
+MIN_SPEECH_DB = -55.0           # anything quieter is never speech
+NOISE_WINDOW = 5.0              # seconds the noise floor is the quietest frame of
+NOISE_BLOCK = 0.5               # seconds per block of that window (one minimum kept per block)
+START_FLOOR_DB = -60.0          # noise floor assumed for the first NOISE_WINDOW seconds
+HANGOVER = 0.3                  # seconds sent after the last speech frame
+COMFORT_REFRESH = 1.0           # seconds between comfort noise updates while silent
+SILENCE_DB = -127.0             # level of digital silence (the lowest a comfort noise byte says)
+FULL_SCALE = 32768.0
+
+# what to do with a frame
+SEND = "send"
+SUPPRESS = "suppress"
+COMFORT = "comfort"             # suppress, and send a comfort noise update
+
+
+class VoiceActivityDetector:
+    """Decides per captured frame whether it goes on the wire; counts what it kept back."""
+
+    def __init__(self, rate, frame):
+        self.frame_s = frame / rate
+        self.floor = None               # noise floor (dBov)
+        self.block_frames = max(1, round(NOISE_BLOCK / self.frame_s))
+        blocks = max(1, round(NOISE_WINDOW / NOISE_BLOCK) - 1)
+        self.blocks = collections.deque([START_FLOOR_DB] * blocks, maxlen=blocks)
+        self.block_min = None           # quietest frame of the current block
+        self.block_len = 0
+        self.hangover = 0               # frames still sent after the last speech frame
+        self.silent_for = None          # seconds since the last comfort noise update; None while sending
+        self.level = SILENCE_DB         # of the last frame, for callers that show a meter
+
+        # counters
+        self.sent = 0
+        self.suppressed = 0
+        self.comfort_sent = 0
+
+    # helper: (level in dBov, zero crossings per sample) of a frame of 16-bit PCM
+    def measure(self, pcm):
+        if numpy is not None:
+            samples = numpy.frombuffer(pcm, dtype=numpy.int16, count=len(pcm) // 2).astype(numpy.float64)
+            n = len(samples)
+            if not n:
+                return SILENCE_DB, 0.0
+            power = float(numpy.dot(samples, samples)) / n
+            crossings = int(numpy.count_nonzero(numpy.signbit(samples[1:]) != numpy.signbit(samples[:-1])))
+        else:
+            samples = array.array("h")
+            samples.frombytes(pcm[:len(pcm) - len(pcm) % 2])
+            n = len(samples)
+            if not n:
+                return SILENCE_DB, 0.0
+            power = sum(s * s for s in samples) / n
+            crossings = sum((a < 0) != (b < 0) for a, b in zip(samples, samples[1:]))
+        level = 10 * math.log10(power / (FULL_SCALE * FULL_SCALE)) if power else SILENCE_DB
+        return max(level, SILENCE_DB), crossings / n
+
+    def update(self, pcm):
+        level, zcr = self.measure(pcm)
+        self.level = level
+        self._track_floor(level)
+        above = level - self.floor
+        speech = level > MIN_SPEECH_DB and (above > SPEECH_MARGIN_DB or
+                                            (above > UNVOICED_MARGIN_DB and zcr > UNVOICED_ZCR))
+
+        if speech:
+            self.hangover = int(HANGOVER / self.frame_s)
+        elif self.hangover:
+            self.hangover -= 1
+            speech = True
+        if speech:
+            self.sent += 1
+            self.silent_for = None
+            return SEND
+
+        self.suppressed += 1
+        if self.silent_for is None or self.silent_for >= COMFORT_REFRESH:
+            self.silent_for = self.frame_s
+            self.comfort_sent += 1
+            return COMFORT
+        self.silent_for += self.frame_s
+        return SUPPRESS
+
+    # helper: the floor is the minimum over the blocks in the window and the current block
+    def _track_floor(self, level):
+        if self.block_min is None or level < self.block_min:
+            self.block_min = level
+        self.block_len += 1
+        self.floor = min(self.block_min, min(self.blocks))
+        if self.block_len >= self.block_frames:
+            self.blocks.append(self.block_min)
+            self.block_min = None
+            self.block_len = 0
+
+    # the background noise as a comfort noise byte (-dBov, 0-127)
+    def noise_level(self):
+        return min(127, max(0, round(-(self.floor if self.floor is not None else SILENCE_DB))))
+
+    def summary(self):
+        total = self.sent + self.suppressed
+        share = self.suppressed / total if total else 0.0
+        return (f"{self.sent} frames sent, {self.suppressed} suppressed ({share:.0%}), "
+                f"{self.comfort_sent} comfort noise updates")
+
+
+# `samples` of white noise at a comfort noise level (-dBov)
+def comfort_noise(level, samples, rng=random):
+    if level >= 127:
+        return bytes(samples * 2)
+    rms = FULL_SCALE * 10 ** (-level / 20)
+    if numpy is not None:
+        noise = numpy.random.default_rng(rng.getrandbits(32)).normal(0, rms, samples)
+        return numpy.clip(noise, -32768, 32767).astype(numpy.int16).tobytes()
+    gauss = rng.gauss
+    return array.array("h", [max(-32768, min(32767, int(gauss(0, rms)))) for _ in range(samples)]).tobytes()
@@ -0,0 +1,82 @@
+# voice_channel.py
+# Client end of a call's UDP media leg (packet format in media.py).
+#
+# The server hands out the leg in a "/call_media:<port>:<token>:<key>" line once
+# the call is accepted. Audio chunks are sealed with the leg's key and sent to the
+# server's media port; what the server forwards from the other participants
+# comes back on the same socket and is passed to on_audio. A few KEEPALIVE
+# packets go out first so the server learns our address before we say anything.
+import socket
+import threading
+import media
+
+KEEPALIVE_BURST = 3             # a lost packet shouldn't keep the server from learning our address
+RECV_TIMEOUT = 0.5              # how often the receive thread checks whether the call is over
+
+
+class VoiceChannel:
+    """Our leg of a call on the server's UDP media relay."""
+
+    # on_audio(ptype, seq, timestamp, payload) runs on the receive thread
+    def __init__(self, host, port, token, key, on_audio):
+        self.token = token
+        self.key = key
+        self.on_audio = on_audio
+        self.seq = 0
+        self.timestamp = 0          # samples captured so far (sent or not)
+        self.sent = 0
+        self.received = 0
+        self.rejected = 0           # datagrams that weren't sealed with our key
+        self.running = True
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect((host, port))
+        self.sock.settimeout(RECV_TIMEOUT)
+        threading.Thread(target=self._receive, daemon=True).start()
+        for _ in range(KEEPALIVE_BURST):
+            self._send(media.KEEPALIVE)
+
+    # one chunk of audio, `samples` long (advances the timestamp)
+    def send_audio(self, payload, samples, ptype=media.PCM16):
+        self._send(ptype, payload)
+        self.timestamp += samples
+
+    # `samples` of audio that weren't sent (silence): the timestamp runs on
+    def skip(self, samples):
+        self.timestamp += samples
+
+    def _send(self, ptype, payload=b""):
+        packet = media.seal(self.key, media.UP, ptype, self.seq, self.timestamp, self.token, payload)
+        self.seq = (self.seq + 1) & 0xFFFF
+        try:
+            self.sock.send(packet)
+            self.sent += 1
+        except OSError:
+            # e.g. ICMP port unreachable from an earlier packet: UDP just loses this one
+            pass
+
+    def _receive(self):
+        while self.running:
+            try:
+                packet = self.sock.recv(media.MAX_PACKET + 1)
+            except socket.timeout:
+                continue
+            except OSError:
+                if not self.running:
+                    break
+                continue
+            try:
+                ptype, seq, timestamp, _, payload = media.open_packet(self.key, media.DOWN, packet)
+            except media.MediaError:
+                self.rejected += 1
+                continue
+            self.received += 1
+            if ptype != media.KEEPALIVE:
+                self.on_audio(ptype, seq, timestamp, payload)
+
+    def close(self):
+        self.running = False
+        try:
+            self.sock.close()
+        except:
+            pass
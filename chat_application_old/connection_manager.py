@@ -2,6 +2,7 @@
 import socket
 import threading
 from message_handler import handle_client
+from client_registry import ClientRegistry
 from logger_utility import Logger
 
 logger = Logger()
@@ -16,8 +17,7 @@ class Server:
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.clients = {}  # key: socket, value: username
-        self.clients_lock = threading.Lock()
+        self.registry = ClientRegistry()  # socket <-> username
 
     def start(self):
         self.server_socket.bind((self.host, self.port))
@@ -33,22 +33,14 @@ class Server:
                     conn.close()
                     continue
 
-                with self.clients_lock:
-                    # prevent duplicate username by appending suffix
-                    existing_usernames = set(self.clients.values())
-                    orig_username = username
-                    i = 1
-                    while username in existing_usernames:
-                        username = f"{orig_username}_{i}"
-                        i += 1
-
-                    self.clients[conn] = username
+                # register; the registry appends a suffix to duplicate usernames
+                username = self.registry.add(conn, username, addr)
 
                 logger.log_event(f"[NEW CONNECTION] {username} ({addr})")
 
                 thread = threading.Thread(
                     target=handle_client,
-                    args=(conn, addr, self.clients, self.clients_lock)
+                    args=(conn, addr, self.registry)
                 )
                 thread.daemon = True
                 thread.start()
@@ -57,13 +49,11 @@ class Server:
 
     def stop(self):
         logger.log_event("[STOPPING SERVER...]")
-        with self.clients_lock:
-            for conn in list(self.clients.keys()):
-                try:
-                    conn.close()
-                except:
-                    pass
-            self.clients.clear()
+        for conn in self.registry.clear():
+            try:
+                conn.close()
+            except:
+                pass
         try:
             self.server_socket.close()
         except:
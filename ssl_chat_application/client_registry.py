@@ -0,0 +1,92 @@
+# client_registry.py
+import threading
+import time
+
+
+class ClientEntry:
+    """Everything the server knows about one connected client."""
+
+    def __init__(self, sock, username, address=None):
+        self.sock = sock
+        self.username = username
+        self.address = address
+        self.connected_at = time.time()
+        self.meta = {}      # free-form per-user metadata
+
+
+class ClientRegistry:
+    """
+    Bidirectional socket <-> username index shared by Server and MessageHandler.
+
+    Every lookup is a dict access, so resolving a username (for /pm, /file, /call_*
+    or each relayed audio chunk) costs the same with 10 or 10,000 users online.
+    Writes take `lock`; single lookups are plain dict reads and don't need it.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._by_socket = {}
+        self._by_name = {}
+
+    # register a client; duplicate names get a _1, _2... suffix. Returns the final username.
+    def add(self, sock, username, address=None):
+        with self.lock:
+            original = username
+            i = 1
+            while username in self._by_name:
+                username = f"{original}_{i}"
+                i += 1
+
+            entry = ClientEntry(sock, username, address)
+            self._by_socket[sock] = entry
+            self._by_name[username] = entry
+        return username
+
+    # unregister a client by socket; returns its entry (or None if it was not registered)
+    def remove(self, sock):
+        with self.lock:
+            entry = self._by_socket.pop(sock, None)
+            if entry and self._by_name.get(entry.username) is entry:
+                del self._by_name[entry.username]
+        return entry
+
+    def socket_for(self, username):
+        entry = self._by_name.get(username)
+        return entry.sock if entry else None
+
+    def username_for(self, sock, default=None):
+        entry = self._by_socket.get(sock)
+        return entry.username if entry else default
+
+    def entry_for_socket(self, sock):
+        return self._by_socket.get(sock)
+
+    def entry_for_user(self, username):
+        return self._by_name.get(username)
+
+    # snapshots (safe to iterate while other threads add/remove clients)
+    def sockets(self):
+        with self.lock:
+            return list(self._by_socket)
+
+    def usernames(self):
+        with self.lock:
+            return list(self._by_name)
+
+    def entries(self):
+        with self.lock:
+            return list(self._by_socket.values())
+
+    # drop everyone; returns the sockets that were registered
+    def clear(self):
+        with self.lock:
+            socks = list(self._by_socket)
+            self._by_socket.clear()
+            self._by_name.clear()
+        return socks
+
+    def __contains__(self, sock):
+        return sock in self._by_socket
+
+    def __len__(self):
+        return len(self._by_socket)
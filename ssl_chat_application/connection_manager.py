@@ -2,6 +2,7 @@ import socket
 import threading
 import ssl
 from message_handler import handle_client
+from client_registry import ClientRegistry
 from logger_utility import Logger
 
 logger = Logger()
@@ -20,8 +21,7 @@ class Server:
         self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         self.context.load_cert_chain(certfile="server.crt", keyfile="server.key")
 
-        self.clients = {}  # key: socket, value: username
-        self.clients_lock = threading.Lock()
+        self.registry = ClientRegistry()  # socket <-> username
 
     def start(self):
         self.server_socket.bind((self.host, self.port))
@@ -42,22 +42,15 @@ class Server:
                     secure_conn.close()
                     continue
 
-                with self.clients_lock:
-                    # Avoid duplicate usernames
-                    existing_usernames = set(self.clients.values())
-                    original_name = username
-                    i = 1
-                    while username in existing_usernames:
-                        username = f"{original_name}_{i}"
-                        i += 1
-                    self.clients[secure_conn] = username
+                # register; the registry appends a suffix to duplicate usernames
+                username = self.registry.add(secure_conn, username, addr)
 
                 logger.log_event(f"[NEW CONNECTION] {username} ({addr})")
 
                 # Start thread for this client
                 thread = threading.Thread(
                     target=handle_client,
-                    args=(secure_conn, addr, self.clients, self.clients_lock)
+                    args=(secure_conn, addr, self.registry)
                 )
                 thread.daemon = True
                 thread.start()
@@ -67,13 +60,11 @@ class Server:
 
     def stop(self):
         logger.log_event("[STOPPING SERVER...]")
-        with self.clients_lock:
-            for conn in list(self.clients.keys()):
-                try:
-                    conn.close()
-                except:
-                    pass
-            self.clients.clear()
+        for conn in self.registry.clear():
+            try:
+                conn.close()
+            except:
+                pass
         try:
             self.server_socket.close()
         except:
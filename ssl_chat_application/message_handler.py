@@ -5,15 +5,13 @@ from logger_utility import Logger
 logger = Logger()
 
 class MessageHandler:
-    def __init__(self, client_socket, client_address, clients, clients_lock):
+    def __init__(self, client_socket, client_address, registry):
         """
-        clients: dict {socket: username}
-        clients_lock: threading.Lock instance guarding clients
+        registry: ClientRegistry shared with the server (socket <-> username)
         """
         self.client_socket = client_socket
         self.client_address = client_address
-        self.clients = clients
-        self.clients_lock = clients_lock
+        self.registry = registry
         self.running = True
 
         thread = threading.Thread(target=self.handle_client)
@@ -21,9 +19,7 @@ class MessageHandler:
         thread.start()
 
     def handle_client(self): 
-        username = None
-        with self.clients_lock:
-            username = self.clients.get(self.client_socket, "Unknown")
+        username = self.registry.username_for(self.client_socket, "Unknown")
         logger.log_event(f"[CONNECTED] {username} ({self.client_address})")
 
         while self.running:
@@ -71,11 +67,7 @@ class MessageHandler:
 
 
     def find_socket_by_username(self, username):
-        with self.clients_lock:
-            for sock, user in self.clients.items():
-                if user == username:
-                    return sock
-        return None
+        return self.registry.socket_for(username)
 
     # inside MessageHandler class
     def send_message_bytes(self, data_bytes):
@@ -132,14 +124,13 @@ class MessageHandler:
             logger.log_event(f"[PRIVATE ERROR] {e}")
 
     def send_user_list(self):
-        with self.clients_lock:
-            users = list(self.clients.values())
+        users = self.registry.usernames()
         user_list_msg = "[SYSTEM] Users online: " + ", ".join(users)
         self._send_to_client(self.client_socket, user_list_msg)
 
     def broadcast(self, message):
-        with self.clients_lock:
-            for client in list(self.clients.keys()):
+        with self.registry.lock:
+            for client in self.registry.sockets():
                 if client != self.client_socket:
                     try:
                         client.send(message.encode('utf-8'))
@@ -149,8 +140,7 @@ class MessageHandler:
                             client.close()
                         except:
                             pass
-                        if client in self.clients:
-                            del self.clients[client]
+                        self.registry.remove(client)
 
     def _send_to_client(self, client, message):
         try:
@@ -160,16 +150,14 @@ class MessageHandler:
 
     def stop(self):
         self.running = False
-        with self.clients_lock:
-            if self.client_socket in self.clients:
-                username = self.clients[self.client_socket]
-                del self.clients[self.client_socket]
-                logger.log_event(f"[DISCONNECTED] {username} {self.client_address}")
+        entry = self.registry.remove(self.client_socket)
+        if entry:
+            logger.log_event(f"[DISCONNECTED] {entry.username} {self.client_address}")
         try:
             self.client_socket.close()
         except:
             pass
 
 
-def handle_client(client_socket, client_address, clients, clients_lock):
-    MessageHandler(client_socket, client_address, clients, clients_lock)
+def handle_client(client_socket, client_address, registry):
+    MessageHandler(client_socket, client_address, registry)